@@ -0,0 +1,159 @@
+import contextlib
+import datetime
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, Iterator, Optional
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+SOURCE_DIR = os.path.join(REPO_DIR, "src")
+DEFAULT_RESULT_DIR = os.path.join(BENCHMARK_DIR, "results")
+# The password of the encrypted test data
+PASSPHRASE = "benchmark-passphrase"
+
+# Make the benchmarks use the code in this repository instead of an installed version
+if SOURCE_DIR not in sys.path:
+    sys.path.insert(0, SOURCE_DIR)
+
+
+def format_size(size: int) -> str:
+    for unit, factor in [("MiB", 1024 * 1024), ("KiB", 1024)]:
+        if size >= factor and size % factor == 0:
+            return f"{size // factor}{unit}"
+    return f"{size}B"
+
+
+def parse_size(value: str) -> int:
+    """
+    Parses sizes like '512', '64KiB' or '16MiB'
+    """
+    for unit, factor in [("MiB", 1024 * 1024), ("KiB", 1024), ("B", 1)]:
+        if value.endswith(unit):
+            return int(value[:-len(unit)]) * factor
+    return int(value)
+
+
+def measure(fn: Callable[[], None], repeat: int = 5, processed_bytes: Optional[int] = None, operations: int = 1, warm_up: bool = True) -> dict:
+    """
+    Calls `fn` `repeat` times (after one warm-up call, unless `warm_up` is False) and returns statistics about the run times.
+    If `processed_bytes` is given, the throughput of the fastest run is included.
+    If each call does `operations` operations, the time per operation is included
+    """
+    if warm_up:
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    result = {
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "mean_s": statistics.mean(times),
+        "repeat": repeat,
+    }
+    if processed_bytes is not None:
+        result["throughput_mb_s"] = processed_bytes / min(times) / 1e6
+    if operations != 1:
+        result["operations"] = operations
+        result["ops_per_s"] = operations / min(times)
+        result["us_per_op"] = min(times) / operations * 1e6
+    return result
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """
+    Returns the value below which `fraction` of the (sorted) values are (nearest rank)
+    """
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_bytes() -> int:
+    """
+    The peak resident set size of this process
+    """
+    # Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def encrypt(data: bytes, passphrase: str = PASSPHRASE) -> bytes:
+    """
+    Encrypts data like a client would (gpg --symmetric)
+    """
+    command = ["gpg", "--batch", "--quiet", "--symmetric", "--pinentry-mode", "loopback", "--passphrase", passphrase,
+        "--cipher-algo", "AES256", "--compress-algo", "none", "--output", "-"]
+    return subprocess.run(command, input=data, stdout=subprocess.PIPE, check=True).stdout
+
+
+@contextlib.contextmanager
+def suppress_output() -> Iterator[None]:
+    """
+    Hides everything written to stdout and stderr, including the output of subprocesses (like gpg's status messages)
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    try:
+        with open(os.devnull, "wb") as devnull:
+            os.dup2(devnull.fileno(), 1)
+            os.dup2(devnull.fileno(), 2)
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved:
+            os.close(fd)
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(benchmark: str, config: dict, results: dict, output: Optional[str] = None) -> str:
+    """
+    Writes the results as JSON, so that they can be compared with compare.py. Returns the file's path.
+    Unless `output` is given, the file is stored in benchmarks/results/ with the benchmark's name and the current time
+    """
+    now = datetime.datetime.now()
+    document = {
+        "benchmark": benchmark,
+        "timestamp": now.isoformat(timespec="seconds"),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "results": results,
+    }
+    if output is None:
+        os.makedirs(DEFAULT_RESULT_DIR, exist_ok=True)
+        output = os.path.join(DEFAULT_RESULT_DIR, f"{benchmark}-{now.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w") as f:
+        json.dump(document, f, indent=2)
+        f.write("\n")
+    return output
+
+
+def print_result(name: str, result: dict) -> None:
+    parts = [f"median {result['median_s'] * 1000:.3f} ms"] if "median_s" in result else []
+    if "throughput_mb_s" in result:
+        parts.append(f"{result['throughput_mb_s']:.1f} MB/s")
+    if "us_per_op" in result:
+        parts.append(f"{result['us_per_op']:.2f} us/op")
+    print(f"{name:<45} {', '.join(parts)}", flush=True)
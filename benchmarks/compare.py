@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Compares two result files of micro.py or load.py.
+Usage: python benchmarks/compare.py OLD.json NEW.json
+"""
+import argparse
+import json
+
+# For these metrics smaller values are better, for all others larger ones
+LOWER_IS_BETTER = ("_s", "_ms", "us_per_op", "_bytes")
+
+
+def is_lower_better(metric: str) -> bool:
+    return metric.endswith(LOWER_IS_BETTER) and not metric.endswith("_per_s")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Compares two benchmark result files")
+    ap.add_argument("old", help="the result file of the baseline run")
+    ap.add_argument("new", help="the result file of the run to compare with the baseline")
+    ap.add_argument("--threshold", type=float, default=5, metavar="PERCENT", help="changes below this are not marked as better or worse. Defaults to 5")
+    args = ap.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old["benchmark"] != new["benchmark"]:
+        print(f"Warning: comparing results of different benchmarks ({old['benchmark']} and {new['benchmark']})")
+    print(f"old: {old['timestamp']} (commit {old.get('git_commit')})")
+    print(f"new: {new['timestamp']} (commit {new.get('git_commit')})")
+    if old.get("config") != new.get("config"):
+        print("Warning: the runs used different configurations")
+
+    for name, new_result in new["results"].items():
+        old_result = old["results"].get(name)
+        if old_result is None:
+            print(f"\n{name}: only in the new results")
+            continue
+        print(f"\n{name}")
+        for metric, new_value in new_result.items():
+            old_value = old_result.get(metric)
+            if not isinstance(new_value, (int, float)) or not isinstance(old_value, (int, float)) or metric in ["repeat", "requests", "operations"]:
+                continue
+            if old_value == 0:
+                change = "n/a"
+                verdict = ""
+            else:
+                percent = (new_value - old_value) / old_value * 100
+                change = f"{percent:+.1f}%"
+                improved = percent < 0 if is_lower_better(metric) else percent > 0
+                verdict = "" if abs(percent) < args.threshold else ("better" if improved else "WORSE")
+            print(f"  {metric:<24} {old_value:>14.4f} -> {new_value:>14.4f}  {change:>8}  {verdict}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test: starts the real server on localhost and uploads encrypted files with concurrent clients.
+Usage: python benchmarks/load.py [--engine asyncio] [--workers N] [--concurrency N] [--requests N] [--size 1MiB] [-- EXTRA SERVER ARGS]
+"""
+import argparse
+import base64
+import http.client
+import itertools
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from common import PASSPHRASE, REPO_DIR, SOURCE_DIR, encrypt, format_size, parse_size, peak_rss_bytes, percentile, save_results
+
+USERNAME = "benchmark"
+PASSWORD = "benchmark"
+BOUNDARY = "benchmark-boundary-7MA4YWxkTrZu0gW"
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, process: subprocess.Popen, timeout: float = 15) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(f"The server exited with status {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise Exception("The server did not start listening in time")
+
+
+def get_child_pids(pid: int) -> list[int]:
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    return children
+
+
+def get_peak_rss(pid: int) -> int:
+    """
+    Returns the peak resident set size (VmHWM) of a process in bytes, or 0 if it can not be read
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class LoadGenerator:
+    def __init__(self, port: int, method: str, path: str, body: bytes, headers: dict[str, str], requests: int, keep_alive: bool) -> None:
+        self.port = port
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers
+        self.requests = requests
+        self.keep_alive = keep_alive
+        # Hands out the request numbers. next() on itertools.count is atomic
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.latencies: list[float] = []
+        self.errors: dict[str, int] = {}
+
+    def run_client(self, client: int) -> None:
+        connection: Optional[http.client.HTTPConnection] = None
+        path = self.path.replace("{client}", str(client))
+        latencies = []
+        while next(self.counter) < self.requests:
+            if connection is None:
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=300)
+            start = time.perf_counter()
+            try:
+                connection.request(self.method, path, body=self.body, headers=self.headers)
+                response = connection.getresponse()
+                response.read()
+                error = None if response.status == 200 else f"HTTP {response.status}"
+                if response.will_close or not self.keep_alive:
+                    connection.close()
+                    connection = None
+            except (OSError, http.client.HTTPException) as e:
+                error = type(e).__name__
+                connection.close()
+                connection = None
+            if error:
+                with self.lock:
+                    self.errors[error] = self.errors.get(error, 0) + 1
+            else:
+                latencies.append(time.perf_counter() - start)
+        if connection:
+            connection.close()
+        with self.lock:
+            self.latencies += latencies
+
+    def run(self, concurrency: int) -> float:
+        """
+        Sends all requests and returns how long it took
+        """
+        threads = [threading.Thread(target=self.run_client, args=(client,)) for client in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+
+def create_request(mode: str, ciphertext: bytes, keep_alive: bool) -> tuple[str, str, bytes, dict[str, str]]:
+    """
+    Returns the method, path (with '{client}' as placeholder for the client's number), body and headers of the uploads
+    """
+    credentials = base64.b64encode(f"{USERNAME}:{PASSWORD}".encode()).decode()
+    headers = {"Authorization": f"Basic {credentials}"}
+    if not keep_alive:
+        headers["Connection"] = "close"
+    if mode == "raw":
+        headers["Content-Type"] = "application/octet-stream"
+        return "PUT", "/gpg/benchmark-{client}.bin", ciphertext, headers
+
+    body = b"".join([
+        f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"filename\"\r\n\r\nbenchmark-form.bin\r\n".encode(),
+        f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"gpg\"; filename=\"benchmark.bin.gpg\"\r\n"
+        "Content-Type: application/octet-stream\r\n\r\n".encode(),
+        ciphertext,
+        f"\r\n--{BOUNDARY}--\r\n".encode(),
+    ])
+    headers["Content-Type"] = f"multipart/form-data; boundary={BOUNDARY}"
+    return "POST", "/gpg", body, headers
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Runs the server on localhost, uploads files with concurrent clients and saves the results as JSON",
+        epilog="Arguments after '--' are passed to the server")
+    ap.add_argument("--engine", choices=["threading", "asyncio"], default="threading", help="the server's --engine. Defaults to 'threading'")
+    ap.add_argument("--workers", type=int, default=1, help="the server's --workers. Defaults to 1")
+    ap.add_argument("--in-process", action="store_true", help="start the server with --gpg-in-process")
+    ap.add_argument("--concurrency", type=int, default=8, help="number of concurrent clients. Defaults to 8")
+    ap.add_argument("--requests", type=int, default=200, help="total number of uploads. Defaults to 200")
+    ap.add_argument("--size", type=parse_size, default="1MiB", help="plaintext size of each upload (like 64KiB or 16MiB). Defaults to 1MiB")
+    ap.add_argument("--mode", choices=["raw", "form"], default="raw", help="upload the file as request body (raw) or as multipart form. Defaults to raw")
+    ap.add_argument("--no-keep-alive", action="store_true", help="open a new connection for every upload")
+    ap.add_argument("--output", metavar="FILE", help="where to save the results. Defaults to benchmarks/results/load-TIMESTAMP.json")
+    argv = sys.argv[1:]
+    server_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = ap.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+    keep_alive = not args.no_keep_alive
+
+    ciphertext = encrypt(os.urandom(args.size))
+    method, path, body, headers = create_request(args.mode, ciphertext, keep_alive)
+    port = get_free_port()
+    # The decrypted uploads are stored in a temporary directory, which is removed afterwards
+    output_dir = tempfile.mkdtemp(prefix="secure-upload-benchmark-")
+    command = [sys.executable, os.path.join(SOURCE_DIR, "secure-upload-server"), "-p", str(port), "-b", "127.0.0.1",
+        "--http-basic", USERNAME, PASSWORD, "--gpg-symmetric", PASSPHRASE, "--engine", args.engine, "--workers", str(args.workers),
+        # The clients must not be blocked, even if something goes wrong
+        "--allow-ips", "127.0.0.1", "--output-dir", output_dir]
+    if args.in_process:
+        command.append("--gpg-in-process")
+    command += server_args
+
+    with tempfile.TemporaryFile() as server_log:
+        env = dict(os.environ, PYTHONPATH=SOURCE_DIR)
+        server = subprocess.Popen(command, cwd=REPO_DIR, env=env, stdout=server_log, stderr=subprocess.STDOUT)
+        try:
+            wait_for_port(port, server)
+            generator = LoadGenerator(port, method, path, body, headers, args.requests, keep_alive)
+            print(f"Uploading {args.requests} x {format_size(args.size)} ({args.mode}) with {args.concurrency} clients to the {args.engine} engine ...", flush=True)
+            duration = generator.run(args.concurrency)
+            # The workers of a prefork server are children of the server process. gpg processes have already exited
+            server_pids = [server.pid] + get_child_pids(server.pid)
+            server_peak_rss = sum(get_peak_rss(pid) for pid in server_pids)
+        except BaseException:
+            server_log.seek(0)
+            sys.stderr.write(server_log.read().decode("utf-8", errors="replace")[-4000:])
+            raise
+        finally:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    latencies = sorted(generator.latencies)
+    succeeded = len(latencies)
+    results = {
+        "requests": args.requests,
+        "succeeded": succeeded,
+        "errors": generator.errors,
+        "duration_s": duration,
+        "requests_per_s": succeeded / duration,
+        # Encrypted bytes sent in request bodies
+        "mb_per_s": succeeded * len(body) / duration / 1e6,
+        "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "latency_max_ms": (latencies[-1] if latencies else 0) * 1000,
+        "server_peak_rss_bytes": server_peak_rss,
+        "client_peak_rss_bytes": peak_rss_bytes(),
+    }
+    for name, value in results.items():
+        print(f"{name:<24} {value:.2f}" if isinstance(value, float) else f"{name:<24} {value}")
+
+    config = {"engine": args.engine, "workers": args.workers, "in_process": args.in_process, "concurrency": args.concurrency,
+        "size": args.size, "mode": args.mode, "keep_alive": keep_alive, "server_args": server_args}
+    name = f"{args.engine}/{args.mode}/{format_size(args.size)}/c{args.concurrency}"
+    print(f"Results saved to {save_results('load', config, {name: results}, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the parts of the upload pipeline that run for every request.
+Usage: python benchmarks/micro.py [GROUP ...] [--quick] [--output FILE]
+"""
+import argparse
+import http.client
+import io
+import logging
+import os
+import tempfile
+from typing import Callable
+
+from common import PASSPHRASE, encrypt, format_size, measure, print_result, save_results, suppress_output
+
+from secure_upload.client_auth import HttpBasicAuthClientAuthenticator
+from secure_upload.http_response import close_request_data, parse_request
+from secure_upload.ip_blocking import IpAddressBlocker
+from secure_upload.upload import openpgp
+from secure_upload.upload.gpg import GpgUploadHandler
+from secure_upload.upload.store import OutputStore
+
+BOUNDARY = "benchmark-boundary-7MA4YWxkTrZu0gW"
+
+
+def create_headers(content_type: str, length: int) -> http.client.HTTPMessage:
+    return http.client.parse_headers(io.BytesIO(f"Content-Type: {content_type}\r\nContent-Length: {length}\r\n\r\n".encode()))
+
+
+def create_multipart_body(size: int) -> bytes:
+    return b"".join([
+        f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"filename\"\r\n\r\nfile.txt\r\n".encode(),
+        f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"gpg\"; filename=\"file.txt.gpg\"\r\n"
+        "Content-Type: application/octet-stream\r\n\r\n".encode(),
+        os.urandom(size),
+        f"\r\n--{BOUNDARY}--\r\n".encode(),
+    ])
+
+
+def bench_parse_request(sizes: list[int], repeat: int) -> dict:
+    results = {}
+    for size in sizes:
+        body = create_multipart_body(size)
+        headers = create_headers(f"multipart/form-data; boundary={BOUNDARY}", len(body))
+
+        def parse_multipart() -> None:
+            close_request_data(parse_request(headers, io.BytesIO(body)))
+        results[f"parse_request/multipart/{format_size(size)}"] = measure(parse_multipart, repeat, processed_bytes=len(body))
+
+    # Forms without files are small, so larger sizes are not interesting
+    for size in [size for size in sizes if size <= 1024 * 1024]:
+        body = b"filename=file.txt&data=" + b"a" * size
+        headers = create_headers("application/x-www-form-urlencoded", len(body))
+        results[f"parse_request/urlencoded/{format_size(size)}"] = measure(lambda: parse_request(headers, io.BytesIO(body)), repeat, processed_bytes=len(body))
+    return results
+
+
+def bench_constant_time_compare(repeat: int) -> dict:
+    authenticator = HttpBasicAuthClientAuthenticator("user", "correct horse battery staple")
+    candidates = {
+        "correct": b"user:correct horse battery staple",
+        "wrong": b"user:wrong",
+        "long": b"user:" + b"x" * 4096,
+    }
+    operations = 100_000
+    results = {}
+    for name, credentials in candidates.items():
+        def compare() -> None:
+            for _ in range(operations):
+                authenticator.constant_time_compare(credentials)
+        results[f"constant_time_compare/{name}"] = measure(compare, repeat, operations=operations)
+    return results
+
+
+def bench_ip_blocker(ip_count: int, repeat: int) -> dict:
+    # Logging every failed attempt would dominate the measurement
+    logging.getLogger("IP blocks").setLevel(logging.WARNING)
+    # Distinct IPv4 addresses starting at 10.0.0.0
+    addresses = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(ip_count)]
+    allowed = ["192.168.0.0/16"]
+    denied = ["172.16.0.0/12"]
+    results = {}
+
+    def failed_auth() -> None:
+        blocker = IpAddressBlocker(allowed, denied, block_threshold=3, block_duration=60)
+        for address in addresses:
+            blocker.increase_failed_auth_count(address)
+    # Each run is long enough (and starts with a new blocker), so there is no need for a warm-up run
+    results[f"ip_blocker/failed_auth/{ip_count}_ips"] = measure(failed_auth, repeat, operations=ip_count, warm_up=False)
+
+    blocker = IpAddressBlocker(allowed, denied, block_threshold=1, block_duration=60)
+    for address in addresses:
+        blocker.increase_failed_auth_count(address)
+
+    def should_drop() -> None:
+        for address in addresses:
+            blocker.should_drop_connection(address)
+    results[f"ip_blocker/should_drop_connection/{ip_count}_ips"] = measure(should_drop, repeat, operations=ip_count, warm_up=False)
+    results[f"ip_blocker/should_drop_connection/{ip_count}_ips"]["evicted_entries"] = blocker.evicted_entries
+    return results
+
+
+def bench_gpg_decrypt(sizes: list[int], repeat: int) -> dict:
+    results = {}
+    modes = [("gpg", False)]
+    if openpgp.is_available():
+        modes.append(("in_process", True))
+    with tempfile.TemporaryDirectory() as output_dir:
+        for size in sizes:
+            ciphertext = encrypt(os.urandom(size))
+            for mode, in_process in modes:
+                # Random names, so that finding a free name does not get slower with every run
+                handler = GpgUploadHandler(PASSPHRASE, in_process=in_process, store=OutputStore(output_dir, "{random}_{name}"))
+
+                def decrypt() -> None:
+                    handler.handle_file("benchmark.bin", io.BytesIO(ciphertext))
+                # Hides gpg's status messages
+                with suppress_output():
+                    result = measure(decrypt, repeat, processed_bytes=size)
+                results[f"gpg_decrypt/{mode}/{format_size(size)}"] = result
+                for file_name in os.listdir(output_dir):
+                    os.unlink(os.path.join(output_dir, file_name))
+    return results
+
+
+def main() -> None:
+    groups: dict[str, Callable[[argparse.Namespace], dict]] = {
+        "parse": lambda args: bench_parse_request(args.sizes, args.repeat),
+        "auth": lambda args: bench_constant_time_compare(args.repeat),
+        "ip": lambda args: bench_ip_blocker(args.ip_count, args.ip_repeat),
+        "gpg": lambda args: bench_gpg_decrypt(args.sizes, args.repeat),
+    }
+    ap = argparse.ArgumentParser(description="Runs micro-benchmarks and saves the results as JSON")
+    ap.add_argument("groups", nargs="*", default=[], metavar="GROUP",
+        help=f"the benchmarks to run ({', '.join(groups)}). Defaults to all of them")
+    ap.add_argument("--quick", action="store_true", help="use fewer repetitions, smaller sizes and fewer IP addresses")
+    ap.add_argument("--repeat", type=int, default=None, help="number of measured runs per benchmark")
+    ap.add_argument("--ip-count", type=int, default=None, help="number of distinct IP addresses for the IP blocker benchmark. Defaults to 1000000")
+    ap.add_argument("--ip-repeat", type=int, default=1, help="number of runs of the (slow) IP blocker benchmark. Defaults to 1")
+    ap.add_argument("--output", metavar="FILE", help="where to save the results. Defaults to benchmarks/results/micro-TIMESTAMP.json")
+    args = ap.parse_args()
+    for name in args.groups:
+        if name not in groups:
+            ap.error(f"unknown benchmark group '{name}'")
+
+    if args.repeat is None:
+        args.repeat = 3 if args.quick else 7
+    if args.ip_count is None:
+        args.ip_count = 100_000 if args.quick else 1_000_000
+    args.sizes = [1024, 64 * 1024, 1024 * 1024] if args.quick else [1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+
+    results = {}
+    for name in args.groups or list(groups):
+        group_results = groups[name](args)
+        for benchmark, result in group_results.items():
+            print_result(benchmark, result)
+        results.update(group_results)
+
+    config = {"groups": args.groups or list(groups), "repeat": args.repeat, "ip_count": args.ip_count, "ip_repeat": args.ip_repeat, "sizes": args.sizes}
+    print(f"Results saved to {save_results('micro', config, results, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,491 @@
+import asyncio
+import contextlib
+from email.utils import formatdate
+from http import HTTPStatus
+import http.client
+import io
+import signal
+import ssl
+import time
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Optional
+
+# local
+from secure_upload.upload.handler import ModuleHandler
+from secure_upload.upload.scheduler import SchedulerBusyError
+from .client_auth import BaseClientAuthenticator
+from .ip_blocking import IpAddressBlocker
+from .http_response import (DEFAULT_CHUNK_SIZE, DEFAULT_MAX_FIELD_SIZE, DEFAULT_MIN_TRANSFER_RATE, DEFAULT_READ_GRACE_PERIOD, DEFAULT_SPOOL_THRESHOLD,
+    MAX_CHUNK_LINE_SIZE, MAX_TRAILER_LINES, BodyDecoder, DecodingLimits, FieldSink, FieldValue, ReadDeadline, RequestBodyError, check_urlencoded_length,
+    close_request_data, create_body_decoder, create_default_sink, get_announced_length, get_content_length, get_multipart_boundary,
+    get_urlencoded_limits, is_chunked, is_raw_upload, parse_chunk_size, parse_urlencoded, raise_unknown_content_type, send_http_response, store_field_value)
+from .log import Capped, get_logger
+from .metrics import (AUTH_DURATION, FAILED_AUTHENTICATIONS, RECEIVE_DURATION, RECEIVED_BYTES, REQUEST_DURATION, REQUESTS_IN_FLIGHT, RESPONSES,
+    SLOW_CLIENTS)
+from .quota import UNKNOWN_CLIENT, QuotaReservation, StorageQuota, UncountedReservation
+from .multipart import MultipartError, MultipartParser, MultipartPart, PartBegin, PartData, PartEnd
+
+logger = get_logger("AsyncServer")
+
+# Maximum size of the request line and headers
+MAX_HEADER_SIZE = 64 * 1024
+# Number of connections that the kernel queues for us before they are accepted
+LISTEN_BACKLOG = 1024
+
+
+class AsyncRequest:
+    """
+    The request/response abstraction of the asyncio engine.
+    It provides the parts of BaseHTTPRequestHandler's interface that the authenticators, upload modules and send_http_response use.
+    The response is buffered in `wfile` and sent by the server once the (synchronous) code that produced it is done.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, client_address: tuple[str, int], command: str, path: str, request_version: str, headers: http.client.HTTPMessage) -> None:
+        self.client_address = client_address
+        self.client_ip = client_address[0]
+        self.command = command
+        self.path = path
+        self.request_version = request_version
+        self.requestline = f"{command} {path} {request_version}"
+        self.headers = headers
+        self.wfile = io.BytesIO()
+        # The client's TLS certificate, if it sent one that could be verified
+        self.peer_certificate: Optional[dict] = None
+        # Set once a response has been started
+        self.status_code: Optional[int] = None
+        # Set by the authenticator
+        self.client_name: Optional[str] = None
+        # Set by the server (see AsyncUploadServer.receive)
+        self.read_deadline: Optional[ReadDeadline] = None
+        # Like BaseHTTPRequestHandler: HTTP/1.1 connections are kept open by default, HTTP/1.0 connections only if the client asks for it
+        connection = headers.get("Connection", "").lower()
+        if connection == "close":
+            self.close_connection = True
+        elif connection == "keep-alive":
+            self.close_connection = False
+        else:
+            self.close_connection = request_version < "HTTP/1.1"
+
+    def send_response(self, code: int, message: Optional[str] = None) -> None:
+        if message is None:
+            message = HTTPStatus(code).phrase
+        self.status_code = code
+        RESPONSES.labels(code=int(code)).inc()
+        logger.info('%s "%s" %d', self.client_ip, self.requestline, code)
+        self.wfile.write(f"{self.protocol_version} {code} {message}\r\n".encode("latin-1", errors="strict"))
+        self.send_header("Date", formatdate(usegmt=True))
+
+    def send_header(self, keyword: str, value) -> None:
+        # Like CustomRequestHandler, we do not send a Server header
+        if keyword.lower() != "server":
+            self.wfile.write(f"{keyword}: {value}\r\n".encode("latin-1", errors="strict"))
+        if keyword.lower() == "connection":
+            if value.lower() == "close":
+                self.close_connection = True
+            elif value.lower() == "keep-alive":
+                self.close_connection = False
+
+    def end_headers(self) -> None:
+        self.wfile.write(b"\r\n")
+
+    def take_response(self) -> bytes:
+        """
+        Returns and clears the buffered response
+        """
+        response = self.wfile.getvalue()
+        self.wfile = io.BytesIO()
+        return response
+
+
+class AsyncUploadServer:
+    """
+    An alternative to ThreadingHTTPServer + CustomRequestHandler based on asyncio streams.
+    Connections do not need their own thread, so idle and slow clients are cheap.
+    Decryption subprocesses are run with asyncio's subprocess API, other blocking module code is run in a thread pool.
+    """
+
+    def __init__(self, authenticator: BaseClientAuthenticator, ip_address_blocker: IpAddressBlocker, upload_module_handler: ModuleHandler,
+                    timeout: float = 60, idle_timeout: float = 15, tls_context: Optional[ssl.SSLContext] = None,
+                    decoding_limits: DecodingLimits = DecodingLimits(), storage_quota: Optional[StorageQuota] = None,
+                    min_transfer_rate: float = DEFAULT_MIN_TRANSFER_RATE, read_grace_period: float = DEFAULT_READ_GRACE_PERIOD) -> None:
+        self.authenticator = authenticator
+        self.ip_address_blocker = ip_address_blocker
+        self.upload_module_handler = upload_module_handler
+        # Connections that do not send any data for this many seconds while a request is being received are closed
+        self.timeout = timeout
+        # Connections are closed if no (complete) request header arrives within this many seconds
+        self.idle_timeout = idle_timeout
+        self.tls_context = tls_context
+        # Limits for request bodies with Content-Encoding
+        self.decoding_limits = decoding_limits
+        self.storage_quota = storage_quota or StorageQuota()
+        # Requests are aborted, if the client sends their body slower than this (see ReadDeadline)
+        self.min_transfer_rate = min_transfer_rate
+        self.read_grace_period = read_grace_period
+        # Since Python 3.11, we can do the TLS handshake ourselves after checking the client's IP address.
+        # Older versions do the handshake before handle_connection is called
+        self.upgrade_to_tls = tls_context is not None and hasattr(asyncio.StreamWriter, "start_tls")
+
+    async def serve_forever(self, host: Optional[str], port: int, reuse_port: bool = False) -> None:
+        server_tls_context = None
+        if self.tls_context and not self.upgrade_to_tls:
+            server_tls_context = self.tls_context
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_SIZE, backlog=LISTEN_BACKLOG, reuse_port=reuse_port or None,
+            ssl=server_tls_context, ssl_handshake_timeout=self.idle_timeout if server_tls_context else None)
+        addresses = ", ".join(f"{sock.getsockname()[0]} port {sock.getsockname()[1]}" for sock in server.sockets)
+        print(f"Serving {'HTTPS' if self.tls_context else 'HTTP'} on {addresses} (asyncio engine) ...")
+        # Raising SystemExit from a signal handler (see exit_on_sigterm) would end up in whatever callback the loop is running.
+        # Instead SIGTERM stops serving, so that the caller can clean up once the loop is done
+        terminated = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, terminated.set)
+        async with server:
+            await terminated.wait()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        client_address = writer.get_extra_info("peername")
+        try:
+            # Connections from blocked addresses are closed before anything is read from them
+            if self.ip_address_blocker.should_drop_connection(client_address[0]):
+                return
+            if self.tls_context and self.upgrade_to_tls:
+                await writer.start_tls(self.tls_context, ssl_handshake_timeout=self.idle_timeout)
+            peer_certificate = writer.get_extra_info("peercert")
+
+            # Handle requests until the client or a response closes the connection
+            while True:
+                request = await self.read_request(reader, client_address)
+                if not request:
+                    return
+                request.peer_certificate = peer_certificate
+                # The request headers are limited by the idle timeout, the body by the read deadline
+                request.read_deadline = ReadDeadline(self.min_transfer_rate, self.read_grace_period, self.timeout)
+
+                REQUESTS_IN_FLIGHT.inc()
+                start = time.perf_counter()
+                try:
+                    try:
+                        await self.handle_request(request, reader, writer)
+                    except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                        raise
+                    except RequestBodyError as e:
+                        logger.info("Invalid request from %s: %s", request.client_ip, e)
+                        if request.status_code is None:
+                            send_http_response(request, e.status, headers={"Connection": "close"}, content=str(e))
+                        # We do not know where the next request would start
+                        request.close_connection = True
+                    except Exception:
+                        logger.exception("Error while handling %s from %s", request.requestline, request.client_ip)
+                        if request.status_code is None:
+                            send_http_response(request, HTTPStatus.INTERNAL_SERVER_ERROR, headers={"Connection": "close"})
+                        # We do not know how much of the request body was read
+                        request.close_connection = True
+
+                    writer.write(request.take_response())
+                    await writer.drain()
+                finally:
+                    REQUESTS_IN_FLIGHT.dec()
+                    REQUEST_DURATION.observe(time.perf_counter() - start)
+                if request.close_connection:
+                    return
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, ssl.SSLError) as e:
+            # The client went away, was too slow or the TLS handshake failed
+            if isinstance(e, ssl.SSLError):
+                logger.debug("TLS error with %s: %s", client_address[0], e)
+        except asyncio.CancelledError:
+            # The server is shutting down. Before Python 3.12, asyncio logs an error for every connection handler that ends cancelled
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, ssl.SSLError):
+                # wait_closed raises the error that closed the connection again
+                pass
+
+    async def read_request(self, reader: asyncio.StreamReader, client_address: tuple[str, int]) -> Optional[AsyncRequest]:
+        """
+        Reads the request line and headers. Returns None if the request is malformed
+        """
+        try:
+            data = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idle_timeout)
+        except asyncio.LimitOverrunError:
+            logger.debug("Request headers from %s are too large", client_address[0])
+            return None
+
+        request_line, _, header_bytes = data.partition(b"\r\n")
+        words = request_line.decode("latin-1").split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            logger.debug("Malformed request line from %s", client_address[0])
+            return None
+        try:
+            headers = http.client.parse_headers(io.BytesIO(header_bytes))
+        except http.client.HTTPException:
+            logger.debug("Malformed request headers from %s", client_address[0])
+            return None
+        command, path, request_version = words
+        return AsyncRequest(client_address, command, path, request_version, headers)
+
+    async def check_authentication(self, request: AsyncRequest) -> bool:
+        """
+        Runs in a worker thread, since authenticators may compute slow password hashes (see HttpBasicCredentialFileAuthenticator)
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.check_authentication_blocking, request)
+
+    def check_authentication_blocking(self, request: AsyncRequest) -> bool:
+        with AUTH_DURATION.time():
+            authenticated = self.authenticator.check_authentication(request)
+        if authenticated:
+            return True
+        else:
+            # Log the failed authentication attempts
+            FAILED_AUTHENTICATIONS.inc()
+            self.ip_address_blocker.increase_failed_auth_count(request.client_ip)
+            return False
+
+    async def handle_request(self, request: AsyncRequest, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        loop = asyncio.get_running_loop()
+        if request.command == "GET":
+            if await self.check_authentication(request):
+                await loop.run_in_executor(None, self.upload_module_handler.handle_GET, request)
+        elif request.command == "HEAD":
+            if await self.check_authentication(request):
+                await loop.run_in_executor(None, self.upload_module_handler.handle_HEAD, request)
+        elif request.command == "DELETE":
+            if await self.check_authentication(request):
+                await loop.run_in_executor(None, self.upload_module_handler.handle_DELETE, request)
+        elif request.command in ["POST", "PUT", "PATCH"]:
+            if await self.check_authentication(request):
+                if is_raw_upload(request.command, request.headers):
+                    await self.handle_raw_upload(request, reader, writer)
+                else:
+                    await self.handle_POST(request, reader, writer)
+        else:
+            send_http_response(request, HTTPStatus.NOT_IMPLEMENTED)
+
+    def send_continue(self, request: AsyncRequest, writer: asyncio.StreamWriter) -> None:
+        """
+        See CustomRequestHandler.send_continue
+        """
+        if request.headers.get("Expect", "").lower() == "100-continue" and request.request_version >= "HTTP/1.1":
+            writer.write(f"{request.protocol_version} 100 Continue\r\n\r\n".encode("latin-1"))
+
+    def send_busy_response(self, request: AsyncRequest, e: SchedulerBusyError) -> None:
+        logger.info("Rejecting upload from %s, since all decryption workers are busy", request.client_ip)
+        send_http_response(request, HTTPStatus.SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(e.retry_after), "Connection": "close"},
+            content="The server is busy, please try again later")
+
+    async def handle_raw_upload(self, request: AsyncRequest, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        The asyncio version of CustomRequestHandler.handle_raw_upload
+        """
+        try:
+            decoder = create_body_decoder(request.headers, self.decoding_limits)
+            with self.reserve_storage(request) as reservation:
+                await self.receive_raw_upload(request, reader, writer, decoder, reservation)
+        except SchedulerBusyError as e:
+            self.send_busy_response(request, e)
+
+    async def receive_raw_upload(self, request: AsyncRequest, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, decoder: BodyDecoder,
+                    reservation: QuotaReservation) -> None:
+        upload = await self.upload_module_handler.open_raw_upload_async(request)
+        if upload is None:
+            # We did not read the body, so the connection can not be reused
+            send_http_response(request, HTTPStatus.NOT_FOUND, headers={"Connection": "close"}, content="Invalid request or the required module is not enabled")
+            return
+
+        module, sink = upload
+        try:
+            self.send_continue(request, writer)
+            with RECEIVE_DURATION.time():
+                async for chunk in self.read_request_body(request, reader):
+                    RECEIVED_BYTES.inc(len(chunk))
+                    for data in decoder.decode(chunk):
+                        reservation.add(len(data))
+                        await sink.write_async(data)
+                for data in decoder.finish():
+                    reservation.add(len(data))
+                    await sink.write_async(data)
+            await sink.finish_async()
+            await asyncio.get_running_loop().run_in_executor(None, self.upload_module_handler.handle_raw_upload, request, module, sink)
+        finally:
+            sink.close()
+
+    @contextlib.contextmanager
+    def reserve_storage(self, request: AsyncRequest) -> Iterator[QuotaReservation]:
+        """
+        See CustomRequestHandler.reserve_storage
+        """
+        if self.upload_module_handler.counts_towards_quota(request):
+            reservation = self.storage_quota.reserve(request.client_name, get_announced_length(request.headers))
+        else:
+            reservation = UncountedReservation(self.storage_quota, request.client_name or UNKNOWN_CLIENT)
+        try:
+            yield reservation
+        finally:
+            reservation.finish(request.status_code is not None and 200 <= request.status_code < 300)
+
+    async def receive(self, request: AsyncRequest, read: Callable[..., Awaitable[bytes]], *args) -> bytes:
+        """
+        Calls `read` (a read method of the StreamReader) with the timeout that the request's ReadDeadline allows
+        """
+        deadline = request.read_deadline
+        assert deadline is not None
+        timeout = deadline.remaining()
+        if timeout <= 0:
+            SLOW_CLIENTS.inc()
+            raise asyncio.TimeoutError()
+        start = time.monotonic()
+        try:
+            data = await asyncio.wait_for(read(*args), timeout)
+        except asyncio.TimeoutError:
+            if timeout < deadline.timeout:
+                SLOW_CLIENTS.inc()
+            raise
+        deadline.record(len(data), time.monotonic() - start)
+        return data
+
+    async def read_request_body(self, request: AsyncRequest, reader: asyncio.StreamReader) -> AsyncIterator[bytes]:
+        """
+        The asyncio version of http_response.read_request_body
+        """
+        if is_chunked(request.headers):
+            async for chunk in self.read_chunked_body(request, reader):
+                yield chunk
+            return
+        if request.headers.get("content-length") is None:
+            return
+
+        remaining = get_content_length(request.headers)
+        while remaining > 0:
+            chunk = await self.receive(request, reader.read, min(DEFAULT_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise RequestBodyError("Request body ended before the announced Content-Length")
+            remaining -= len(chunk)
+            yield chunk
+
+    async def read_chunked_body(self, request: AsyncRequest, reader: asyncio.StreamReader) -> AsyncIterator[bytes]:
+        while True:
+            size = parse_chunk_size(await self.read_line(request, reader))
+            if size == 0:
+                break
+            remaining = size
+            while remaining > 0:
+                chunk = await self.receive(request, reader.read, min(DEFAULT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise RequestBodyError("Request body ended in the middle of a chunk")
+                remaining -= len(chunk)
+                yield chunk
+            if (await self.read_line(request, reader)).strip(b"\r\n"):
+                raise RequestBodyError("Missing line break after chunk")
+
+        # Skip the trailer fields, which we do not use
+        for _ in range(MAX_TRAILER_LINES):
+            line = await self.read_line(request, reader)
+            if not line.endswith(b"\n"):
+                raise RequestBodyError("Trailer line is too long or incomplete")
+            if line in (b"\r\n", b"\n"):
+                return
+        raise RequestBodyError("Too many trailer lines")
+
+    async def read_line(self, request: AsyncRequest, reader: asyncio.StreamReader) -> bytes:
+        try:
+            line = await self.receive(request, reader.readuntil, b"\n")
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+        except asyncio.LimitOverrunError:
+            raise RequestBodyError("Line in chunked request body is too long")
+        if len(line) > MAX_CHUNK_LINE_SIZE:
+            raise RequestBodyError("Line in chunked request body is too long")
+        return line
+
+    async def handle_POST(self, request: AsyncRequest, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            with self.reserve_storage(request) as reservation:
+                self.send_continue(request, writer)
+                with RECEIVE_DURATION.time():
+                    post_data = await self.parse_request(request, reader, reservation)
+                # Forms always have a Content-Length
+                RECEIVED_BYTES.inc(get_content_length(request.headers))
+                try:
+                    logger.debug("POST data: %s", Capped(post_data))
+                    await asyncio.get_running_loop().run_in_executor(None, self.upload_module_handler.handle_POST, request, post_data)
+                finally:
+                    # Remove the temporary files of uploaded files
+                    close_request_data(post_data)
+        except SchedulerBusyError as e:
+            self.send_busy_response(request, e)
+
+    async def parse_request(self, request: AsyncRequest, reader: asyncio.StreamReader, reservation: QuotaReservation) -> dict[bytes, FieldValue]:
+        """
+        The asyncio version of http_response.parse_request
+        """
+        ctype = request.headers.get_content_type()
+        if ctype == "multipart/form-data":
+            length = get_content_length(request.headers)
+            decoder = create_body_decoder(request.headers, self.decoding_limits)
+            return await self.parse_multipart(request, reader, get_multipart_boundary(request.headers), length, decoder, reservation)
+        elif ctype == "application/x-www-form-urlencoded":
+            length = get_content_length(request.headers)
+            check_urlencoded_length(length)
+            decoder = create_body_decoder(request.headers, get_urlencoded_limits(self.decoding_limits))
+            request_body_bytes = b"".join([chunk async for chunk in self.read_content(request, reader, length, decoder)])
+            reservation.add(len(request_body_bytes))
+            return parse_urlencoded(request_body_bytes)
+        else:
+            raise_unknown_content_type(ctype)
+
+    async def parse_multipart(self, request: AsyncRequest, reader: asyncio.StreamReader, boundary: bytes, length: int,
+                    decoder: BodyDecoder, reservation: QuotaReservation) -> dict[bytes, FieldValue]:
+        """
+        The asyncio version of http_response.parse_multipart
+        """
+        parser = MultipartParser(boundary)
+        result: dict[bytes, FieldValue] = {}
+        current_part: Optional[MultipartPart] = None
+        sink: Optional[FieldSink] = None
+
+        try:
+            # The whole body is read, even the epilogue, so that the next request on this connection starts at the right place
+            async for chunk in self.read_content(request, reader, length, decoder):
+                reservation.add(len(chunk))
+                if parser.done:
+                    continue
+
+                for event in parser.feed(chunk):
+                    if isinstance(event, PartBegin):
+                        current_part = event.part
+                        sink = await self.upload_module_handler.open_field_async(request, current_part)
+                        if sink is None:
+                            sink = create_default_sink(current_part, DEFAULT_SPOOL_THRESHOLD, DEFAULT_MAX_FIELD_SIZE)
+                    elif isinstance(event, PartData):
+                        # The parser always begins a part before its data
+                        assert sink is not None
+                        await sink.write_async(event.data)
+                    elif isinstance(event, PartEnd):
+                        assert sink is not None and current_part is not None
+                        await sink.finish_async()
+                        store_field_value(result, current_part, sink.get_value())
+                        current_part, sink = None, None
+            parser.close()
+        except BaseException:
+            if sink is not None:
+                sink.close()
+            close_request_data(result)
+            raise
+        return result
+
+    async def read_content(self, request: AsyncRequest, reader: asyncio.StreamReader, length: int, decoder: BodyDecoder) -> AsyncIterator[bytes]:
+        """
+        The asyncio version of http_response.read_content, that also decodes the content
+        """
+        remaining = length
+        while remaining > 0:
+            chunk = await self.receive(request, reader.read, min(DEFAULT_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise MultipartError("Request body ended before the announced Content-Length")
+            remaining -= len(chunk)
+            for data in decoder.decode(chunk):
+                yield data
+        for data in decoder.finish():
+            yield data
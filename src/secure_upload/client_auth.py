@@ -1,25 +1,28 @@
 import base64
-from email import header
+from collections import Counter, OrderedDict
+import hashlib
 from hmac import compare_digest
+import hmac
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler
-import logging
+import os
+import threading
+import time
+from typing import NamedTuple, Optional
 # local
-from .http_response import send_http_response
+from .http_response import RequestHandler, send_http_response
+from .log import get_logger
 
-logger = logging.getLogger("ClientAuth")
-logger.setLevel(logging.DEBUG)
-c_handler = logging.StreamHandler()
-c_format = logging.Formatter('[%(levelname)s] %(name)s: %(message)s')
-c_handler.setFormatter(c_format)
-logger.addHandler(c_handler)
+logger = get_logger("ClientAuth")
 
 
 class BaseClientAuthenticator:
-    def is_authentication_valid(self, handler: BaseHTTPRequestHandler) -> bool:
+    def is_authentication_valid(self, handler: RequestHandler) -> bool:
+        """
+        Returns whether the request is allowed. If it is, the client's name (used for the storage quotas) is stored in `handler.client_name`
+        """
         raise Exception("This method needs to be overwritten by subclasses")
 
-    def check_authentication(self, handler: BaseHTTPRequestHandler) -> bool:
+    def check_authentication(self, handler: RequestHandler) -> bool:
         """
         Checks the authentication:
         - Valid: sends nothing, returns True
@@ -29,7 +32,9 @@ class BaseClientAuthenticator:
             return True
         else:
             send_http_response(handler, HTTPStatus.UNAUTHORIZED,
-                headers={"WWW-Authenticate": "Basic"},
+                # Clients need to open a new connection for their next attempt, which is checked against the IP blocks again.
+                # This also means that we do not need to read the request body
+                headers={"WWW-Authenticate": "Basic", "Connection": "close"},
                 content="Authentication required")
             return False
 
@@ -44,9 +49,9 @@ class MultiClientAuthenticator(BaseClientAuthenticator):
         super().__init__()
         self.authenticators = authenticators
         if not authenticators:
-            logger.warn("MultiClientAuthenticator has no authenticators and will thus reject all requests")
+            logger.warning("MultiClientAuthenticator has no authenticators and will thus reject all requests")
 
-    def is_authentication_valid(self, handler: BaseHTTPRequestHandler) -> bool:
+    def is_authentication_valid(self, handler: RequestHandler) -> bool:
         for auth in self.authenticators:
             if auth.is_authentication_valid(handler):
                 return True
@@ -61,6 +66,10 @@ class HttpBasicAuthClientAuthenticator(BaseClientAuthenticator):
         # The null byte should (normally) not be part of the password
         self.pad_char = b"\x00"
 
+        if ":" in username:
+            # The credentials are split at the first ':' (RFC 7617)
+            raise Exception("User names can not contain ':'")
+        self.username = username
         expected_credentials = f"{username}:{password}".encode("utf-8")
         # We pad the credentials beforehand, so that the time required for padding (which likely depends on the value's length) is not leaked
         self.expected_credentials_padded = expected_credentials.ljust(self.max_expected_secret_length, self.pad_char)
@@ -84,21 +93,236 @@ class HttpBasicAuthClientAuthenticator(BaseClientAuthenticator):
         return r
 
 
-    def is_authentication_valid(self, handler: BaseHTTPRequestHandler) -> bool:
-        try:
-            auth_header = handler.headers["Authorization"]
-            if not auth_header:
-                logger.debug("No Authorization header in request")
-                return False
-            parts = auth_header.split()
-            if len(parts) < 2 or parts[0].lower() != "basic":
-                # We only want properly formatted HTTP basic authentication
-                logger.debug("No valid Basic authentication header")
-                return False
-            credentials_encoded = parts[1]
-            credentials = base64.b64decode(credentials_encoded, validate=True)
-            return self.constant_time_compare(credentials)
-        except KeyError:
+    def is_authentication_valid(self, handler: RequestHandler) -> bool:
+        credentials = get_basic_credentials(handler)
+        if credentials is None:
+            return False
+        if not self.constant_time_compare(credentials):
+            return False
+        handler.client_name = self.username
+        return True
+
+
+def get_basic_credentials(handler: RequestHandler) -> Optional[bytes]:
+    """
+    Returns the decoded "username:password" of a HTTP Basic Authorization header or None if the request has none
+    """
+    try:
+        auth_header = handler.headers["Authorization"]
+        if not auth_header:
             logger.debug("No Authorization header in request")
-            # No auth header
+            return None
+        parts = auth_header.split()
+        if len(parts) < 2 or parts[0].lower() != "basic":
+            # We only want properly formatted HTTP basic authentication
+            logger.debug("No valid Basic authentication header")
+            return None
+        credentials_encoded = parts[1]
+        return base64.b64decode(credentials_encoded, validate=True)
+    except KeyError:
+        logger.debug("No Authorization header in request")
+        # No auth header
+        return None
+    except ValueError:
+        logger.debug("Authorization header is not valid base64")
+        return None
+
+
+class TlsClientCertificateAuthenticator(BaseClientAuthenticator):
+    """
+    Accepts clients that presented a certificate that was issued by one of the CAs passed to tls.create_tls_context.
+    If `allowed_names` is not empty, the certificate's common name also needs to be one of them
+    """
+
+    def __init__(self, allowed_names: list[str] = []) -> None:
+        super().__init__()
+        self.allowed_names = set(allowed_names)
+
+    def is_authentication_valid(self, handler: RequestHandler) -> bool:
+        # Only contains the certificate if it was verified against the CAs
+        certificate = handler.peer_certificate
+        if not certificate:
+            logger.debug("No valid TLS client certificate")
+            return False
+        common_names = [value for relative_distinguished_name in certificate.get("subject", ())
+            for key, value in relative_distinguished_name if key == "commonName"]
+        if self.allowed_names:
+            common_names = [name for name in common_names if name in self.allowed_names]
+            if not common_names:
+                logger.debug("TLS client certificate has a common name that is not allowed")
+                return False
+        # Prefixed, so that the name can not be confused with an HTTP Basic user
+        handler.client_name = f"CN={common_names[0]}" if common_names else "CN="
+        return True
+
+
+class PasswordHash(NamedTuple):
+    """
+    A salted password hash as stored in a credential file: 'scrypt$N$r$p$SALT$HASH' or 'pbkdf2-sha256$ITERATIONS$SALT$HASH'
+    (salt and hash are base64 encoded)
+    """
+    algorithm: str
+    parameters: tuple[int, ...]
+    salt: bytes
+    hash: bytes
+
+    @staticmethod
+    def parse(value: str) -> "PasswordHash":
+        fields = value.strip().split("$")
+        parameter_count = {"scrypt": 3, "pbkdf2-sha256": 1}.get(fields[0])
+        if parameter_count is None or len(fields) != parameter_count + 3:
+            raise Exception("Unknown password hash format, expected 'scrypt$N$r$p$SALT$HASH' or 'pbkdf2-sha256$ITERATIONS$SALT$HASH'")
+        parameters = tuple(int(field) for field in fields[1:-2])
+        return PasswordHash(fields[0], parameters, base64.b64decode(fields[-2]), base64.b64decode(fields[-1]))
+
+    @staticmethod
+    def create(password: bytes) -> "PasswordHash":
+        salt = os.urandom(16)
+        # About 16 MiB of memory and 50 ms of CPU time
+        parameters = (2**14, 8, 1)
+        n, r, p = parameters
+        return PasswordHash("scrypt", parameters, salt, hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256 * n * r))
+
+    def derive(self, password: bytes) -> bytes:
+        if self.algorithm == "scrypt":
+            n, r, p = self.parameters
+            return hashlib.scrypt(password, salt=self.salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=len(self.hash))
+        else:
+            iterations, = self.parameters
+            return hashlib.pbkdf2_hmac("sha256", password, self.salt, iterations, dklen=len(self.hash))
+
+    def verify(self, password: bytes) -> bool:
+        return compare_digest(self.derive(password), self.hash)
+
+    def __str__(self) -> str:
+        fields = [self.algorithm, *map(str, self.parameters), base64.b64encode(self.salt).decode(), base64.b64encode(self.hash).decode()]
+        return "$".join(fields)
+
+
+def create_dummy_hash(users: dict[bytes, PasswordHash]) -> PasswordHash:
+    """
+    Returns a hash for unknown users, that uses the same algorithm and parameters as (most of) the users' hashes.
+    So checking the password of an unknown user takes as long as checking the one of an existing user
+    """
+    if not users:
+        return PasswordHash.create(b"")
+    settings = Counter((password_hash.algorithm, password_hash.parameters, len(password_hash.salt), len(password_hash.hash))
+        for password_hash in users.values())
+    (algorithm, parameters, salt_length, hash_length), _ = settings.most_common(1)[0]
+    # It does not matter, that no password matches the random hash
+    return PasswordHash(algorithm, parameters, os.urandom(salt_length), os.urandom(hash_length))
+
+
+def load_credential_file(path: str) -> dict[bytes, PasswordHash]:
+    """
+    Reads a credential file with one 'USERNAME:PASSWORD_HASH' line per user (see PasswordHash). Empty lines and lines starting with '#' are ignored.
+    User names can not contain ':', since HTTP Basic credentials are split at the first one (RFC 7617)
+    """
+    users: dict[bytes, PasswordHash] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            # Split like the credentials of a request (see HttpBasicCredentialFileAuthenticator.is_authentication_valid)
+            username, separator, password_hash = line.partition(":")
+            if not separator or not username:
+                raise Exception(f"{path}:{line_number}: Expected 'USERNAME:PASSWORD_HASH'")
+            if ":" in password_hash:
+                raise Exception(f"{path}:{line_number}: User names can not contain ':'")
+            try:
+                users[username.encode("utf-8")] = PasswordHash.parse(password_hash)
+            except Exception as e:
+                raise Exception(f"{path}:{line_number}: {e}")
+    return users
+
+
+class HttpBasicCredentialFileAuthenticator(BaseClientAuthenticator):
+    """
+    HTTP Basic authentication for many users, whose salted password hashes are read from a credential file (see load_credential_file).
+    A request needs one dictionary lookup and one password hash computation.
+    Since the password hashes are slow on purpose, the recently verified credentials are cached,
+    so that clients that send many requests only pay for the first one.
+    The file is reloaded when it changes (checked at most every `reload_interval` seconds).
+    """
+
+    def __init__(self, path: str, cache_size: int = 1024, reload_interval: float = 1) -> None:
+        super().__init__()
+        self.path = path
+        self.cache_size = cache_size
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        # Cache keys are HMACs of the credentials, so that the cache does not contain the passwords in plain text
+        self.cache_key = os.urandom(32)
+        self.cache: OrderedDict[bytes, bytes] = OrderedDict()
+        self.file_state = self.get_file_state()
+        self.users = load_credential_file(path)
+        self.next_reload_check = time.monotonic() + reload_interval
+        # Used for unknown users, so that their requests take as long as the ones of existing users
+        self.dummy_hash = create_dummy_hash(self.users)
+        logger.info("Loaded %d user(s) from %s", len(self.users), path)
+
+    def get_file_state(self) -> Optional[tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def reload_if_changed(self) -> None:
+        now = time.monotonic()
+        if now < self.next_reload_check:
+            return
+        with self.lock:
+            if now < self.next_reload_check:
+                # Another thread just checked it
+                return
+            self.next_reload_check = now + self.reload_interval
+            file_state = self.get_file_state()
+            if file_state is None or file_state == self.file_state:
+                return
+            # Also set if the file is invalid, so that the error is only logged once per change
+            self.file_state = file_state
+            try:
+                users = load_credential_file(self.path)
+            except Exception as e:
+                # Keep the old users, the file may be written right now
+                logger.error("Failed to reload %s: %s", self.path, e)
+                return
+            self.users = users
+            self.dummy_hash = create_dummy_hash(users)
+            # Passwords may have been changed or users removed
+            self.cache.clear()
+        logger.info("Reloaded %d user(s) from %s", len(users), self.path)
+
+    def is_authentication_valid(self, handler: RequestHandler) -> bool:
+        self.reload_if_changed()
+        credentials = get_basic_credentials(handler)
+        if credentials is None:
             return False
+
+        cache_key = hmac.digest(self.cache_key, credentials, "sha256")
+        with self.lock:
+            username = self.cache.get(cache_key)
+            if username is not None:
+                self.cache.move_to_end(cache_key)
+                handler.client_name = username.decode("utf-8", errors="replace")
+                return True
+            users, dummy_hash = self.users, self.dummy_hash
+
+        username, _, password = credentials.partition(b":")
+        password_hash = users.get(username)
+        if password_hash is None:
+            dummy_hash.verify(password)
+            return False
+        if not password_hash.verify(password):
+            return False
+
+        with self.lock:
+            # Only cache the result if the file was not reloaded in the meantime
+            if users is self.users:
+                self.cache[cache_key] = username
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        handler.client_name = username.decode("utf-8", errors="replace")
+        return True
@@ -0,0 +1,12 @@
+from http import HTTPStatus
+
+
+class RequestBodyError(Exception):
+    """
+    Raised when the framing of a request body (Content-Length or Transfer-Encoding) is missing or malformed,
+    or when the body can not be decoded. `status` is the status code of the response
+    """
+
+    def __init__(self, message: str, status: HTTPStatus = HTTPStatus.BAD_REQUEST) -> None:
+        super().__init__(message)
+        self.status = status
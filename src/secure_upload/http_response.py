@@ -1,11 +1,52 @@
-import cgi
+import asyncio
+import email.message
+import io
+import tempfile
+import zlib
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler
-from typing import Union
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, NamedTuple, NoReturn, Optional, Protocol, Union, cast
 from urllib.parse import parse_qs
+# local
+from .errors import RequestBodyError
+from .multipart import MultipartError, MultipartParser, MultipartPart, PartBegin, PartData, PartEnd
 
+try:
+    # Optional dependency for 'Content-Encoding: zstd'
+    import zstandard
+except ImportError:
+    zstandard = None # type: ignore
 
-def send_http_response(handler: BaseHTTPRequestHandler,
+
+class RequestHandler(Protocol):
+    """
+    The parts of BaseHTTPRequestHandler's interface that the authenticators, upload modules and send_http_response use.
+    Provided by the threading engine's CustomRequestHandler and the asyncio engine's AsyncRequest
+    """
+    command: str
+    path: str
+    # Set by the authenticator that accepted the request
+    client_name: Optional[str]
+
+    @property
+    def client_address(self) -> Any: ...
+
+    @property
+    def headers(self) -> email.message.Message: ...
+
+    @property
+    def wfile(self) -> io.BufferedIOBase: ...
+
+    @property
+    def peer_certificate(self) -> Optional[dict]: ...
+
+    def send_response(self, code: int, message: Optional[str] = None) -> None: ...
+
+    def send_header(self, keyword: str, value: str) -> None: ...
+
+    def end_headers(self) -> None: ...
+
+
+def send_http_response(handler: RequestHandler,
                         status_code: HTTPStatus, # Response status code
                         headers: Union[dict[str,str],list[dict[str,str]]] = [], # Headers in the form of dictionaries. If a list is given the last dictionary has precedence in case of conflicts
                         content: Union[None,str,bytes] = None # The response's body
@@ -45,32 +86,570 @@ def send_http_response(handler: BaseHTTPRequestHandler,
     handler.send_response(status_code)
 
     for name, value in sorted(default_headers.items()):
-        handler.send_header(name, value)
+        handler.send_header(name, str(value))
     handler.end_headers()
 
-    handler.wfile.write(response_bytes)
+    # Responses to HEAD requests have the same headers as other responses, but no body
+    if handler.command != "HEAD":
+        handler.wfile.write(response_bytes)
+
+
+# Size of the blocks that the request body is read in
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# Uploaded files larger than this are moved from memory to a temporary file on disk
+DEFAULT_SPOOL_THRESHOLD = 1024 * 1024
+# Maximum size of multipart fields that are not files (and are thus kept in memory)
+DEFAULT_MAX_FIELD_SIZE = 64 * 1024
+# Maximum length of a chunk size line or trailer line of a chunked request body
+MAX_CHUNK_LINE_SIZE = 4 * 1024
+# Maximum number of trailer lines after the last chunk
+MAX_TRAILER_LINES = 100
+# The compression ratio of a compressed request body is only checked after this many bytes were decompressed
+RATIO_CHECK_THRESHOLD = 1024 * 1024
+# Larger zstd windows need too much memory per upload
+MAX_ZSTD_WINDOW_SIZE = 8 * 1024 * 1024
+# Requests that are sent slower than this many bytes per second (after the grace period in seconds) are aborted (see ReadDeadline)
+DEFAULT_MIN_TRANSFER_RATE = 1024
+DEFAULT_READ_GRACE_PERIOD = 30
+# Maximum size of urlencoded forms (before and after decompression), since they are kept in memory
+MAX_URLENCODED_SIZE = DEFAULT_SPOOL_THRESHOLD
+
+
+class ReadDeadline:
+    """
+    Drops clients that send their request too slowly (like slowloris), since they tie up a thread or connection slot.
+    The time spent waiting for the client's data may not exceed `grace_period` plus the time that the received bytes would take at `min_rate` bytes per second.
+    Time spent on processing the data (like waiting for a decryption worker) does not count. A single read still fails after `timeout` seconds
+    """
+
+    def __init__(self, min_rate: float, grace_period: float, timeout: float) -> None:
+        self.min_rate = min_rate
+        self.grace_period = grace_period
+        self.timeout = timeout
+        self.received = 0
+        self.waited = 0.0
+
+    def remaining(self) -> float:
+        """
+        Returns how long (in seconds) the next read may wait for data. Zero or less means that the client is too slow
+        """
+        if not self.min_rate:
+            return self.timeout
+        return min(self.timeout, self.grace_period + self.received / self.min_rate - self.waited)
+
+    def record(self, size: int, waited: float) -> None:
+        """
+        Called after each read with the number of received bytes and the time spent waiting for them
+        """
+        self.received += size
+        self.waited += waited
+
+
+class DecodingLimits(NamedTuple):
+    """
+    Protects against decompression bombs in request bodies that are sent with Content-Encoding
+    """
+    # Maximum size of a decompressed request body
+    max_size: int = 16 * 1024 * 1024 * 1024
+    # Maximum ratio of decompressed to compressed size. Text and logs usually compress less than 20:1
+    max_ratio: float = 200
+
+
+class BodyDecoder:
+    """
+    Decodes a request body according to its Content-Encoding while it is being received. This base class is used for unencoded bodies
+    """
+
+    def __init__(self, limits: DecodingLimits = DecodingLimits()) -> None:
+        self.limits = limits
+        self.input_size = 0
+        self.output_size = 0
+
+    def decode(self, data: bytes) -> list[bytes]:
+        """
+        Returns the decoded data (in pieces of at most DEFAULT_CHUNK_SIZE bytes for compressed bodies)
+        """
+        return [data]
+
+    def finish(self) -> list[bytes]:
+        """
+        Called after the end of the body. Returns the rest of the decoded data and raises an error if the body was incomplete
+        """
+        return []
+
+    def decode_all(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        for chunk in chunks:
+            yield from self.decode(chunk)
+        yield from self.finish()
+
+    def check_limits(self, output_size: int) -> None:
+        """
+        Called by subclasses for every piece of output, before the next piece is decompressed
+        """
+        self.output_size += output_size
+        if self.output_size > self.limits.max_size:
+            raise RequestBodyError(f"The decompressed request body is larger than {self.limits.max_size} bytes", HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        if self.output_size > RATIO_CHECK_THRESHOLD and self.output_size > self.input_size * self.limits.max_ratio:
+            raise RequestBodyError(f"The request body is compressed more than {self.limits.max_ratio:g}:1, which is not allowed",
+                HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+
+class ZlibBodyDecoder(BodyDecoder):
+    """
+    Decodes gzip (which may consist of multiple members) and deflate bodies
+    """
+
+    def __init__(self, limits: DecodingLimits, wbits: int, multiple_members: bool) -> None:
+        super().__init__(limits)
+        self.wbits = wbits
+        self.multiple_members = multiple_members
+        self.decompressor = zlib.decompressobj(wbits)
+
+    def decode(self, data: bytes) -> list[bytes]:
+        self.input_size += len(data)
+        output = []
+        while True:
+            try:
+                # Limiting the output size keeps a decompression bomb from using a lot of memory before we can check it
+                piece = self.decompressor.decompress(data, DEFAULT_CHUNK_SIZE)
+            except zlib.error as e:
+                raise RequestBodyError(f"Invalid compressed request body: {e}")
+            if piece:
+                self.check_limits(len(piece))
+                output.append(piece)
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                if not data:
+                    return output
+                if not self.multiple_members:
+                    raise RequestBodyError("Unexpected data after the end of the compressed request body")
+                self.decompressor = zlib.decompressobj(self.wbits)
+            else:
+                data = self.decompressor.unconsumed_tail
+                if not data and len(piece) < DEFAULT_CHUNK_SIZE:
+                    return output
+
+    def finish(self) -> list[bytes]:
+        if not self.decompressor.eof:
+            raise RequestBodyError("The compressed request body is incomplete")
+        return []
+
+
+class ZstdBodyDecoder(BodyDecoder):
+    """
+    Decodes zstd bodies (which may consist of multiple frames). Unlike ZlibBodyDecoder it can not detect a truncated last frame,
+    which only happens if the client sent a broken body (the HTTP framing ensures that the whole body was received)
+    """
+
+    def __init__(self, limits: DecodingLimits) -> None:
+        super().__init__(limits)
+        self.output: list[bytes] = []
+        # The writer passes each piece of output to our `write` method, so that we can check the limits while it is decompressing
+        # It only needs our `write` method, not a complete file object
+        self.writer = zstandard.ZstdDecompressor(max_window_size=MAX_ZSTD_WINDOW_SIZE).stream_writer(cast(BinaryIO, self), write_size=DEFAULT_CHUNK_SIZE,
+            closefd=False)
+
+    def write(self, data: bytes) -> int:
+        self.check_limits(len(data))
+        self.output.append(bytes(data))
+        return len(data)
+
+    def decode(self, data: bytes) -> list[bytes]:
+        self.input_size += len(data)
+        try:
+            self.writer.write(data)
+        except zstandard.ZstdError as e:
+            raise RequestBodyError(f"Invalid compressed request body: {e}")
+        output, self.output = self.output, []
+        return output
+
+
+def get_supported_encodings() -> list[str]:
+    encodings = ["gzip", "deflate"]
+    if zstandard is not None:
+        encodings.append("zstd")
+    return encodings
+
+
+def create_body_decoder(headers, limits: DecodingLimits = DecodingLimits()) -> BodyDecoder:
+    """
+    Returns the decoder for the request's Content-Encoding. Fails with '415 Unsupported Media Type' for unknown encodings
+    """
+    encoding = headers.get("content-encoding", "").strip().lower()
+    if encoding in ["", "identity"]:
+        return BodyDecoder(limits)
+    if encoding in ["gzip", "x-gzip"]:
+        return ZlibBodyDecoder(limits, 16 + zlib.MAX_WBITS, multiple_members=True)
+    if encoding == "deflate":
+        return ZlibBodyDecoder(limits, zlib.MAX_WBITS, multiple_members=False)
+    if encoding == "zstd" and zstandard is not None:
+        return ZstdBodyDecoder(limits)
+    raise RequestBodyError(f"Unsupported Content-Encoding: '{encoding}'. Supported are: {', '.join(get_supported_encodings())}",
+        HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
+
+
+class FieldSink:
+    """
+    Receives the contents of a multipart field while the request body is still being read.
+    Upload modules can return a sink for a field, if they want to process it in a streaming fashion.
+    """
+
+    def write(self, data: bytes) -> None:
+        raise Exception("This method needs to be overwritten by subclasses")
+
+    def finish(self) -> None:
+        """
+        Called after the last chunk of the field has been written
+        """
+
+    def close(self) -> None:
+        """
+        Releases all resources. Called after the request was handled or when an error occurred while reading the request
+        """
+
+    def get_value(self) -> "FieldValue":
+        """
+        Returns the value that is passed to the upload modules (after `finish` was called)
+        """
+        return self
+
+    # Used by the asyncio engine. By default the (potentially blocking) methods above are run in a worker thread
+    async def write_async(self, data: bytes) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.write, data)
+
+    async def finish_async(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.finish)
+
+
+class MemoryFieldSink(FieldSink):
+    """
+    Keeps a (small) field in memory. Used for fields that are not files
+    """
+
+    def __init__(self, part: MultipartPart, max_size: int) -> None:
+        super().__init__()
+        self.part = part
+        self.max_size = max_size
+        self.data = bytearray()
+
+    def write(self, data: bytes) -> None:
+        if len(self.data) + len(data) > self.max_size:
+            raise MultipartError(f"Field '{self.part.name.decode(errors='replace')}' is larger than {self.max_size} bytes. Upload it as a file instead")
+        self.data += data
+
+    def get_value(self) -> "FieldValue":
+        return bytes(self.data)
+
+    async def write_async(self, data: bytes) -> None:
+        self.write(data)
+
+    async def finish_async(self) -> None:
+        pass
+
+
+class SpooledFileSink(FieldSink):
+    """
+    Writes an uploaded file to a temporary file, that only stays in memory while it is smaller than `spool_threshold`
+    """
 
+    def __init__(self, spool_threshold: int) -> None:
+        super().__init__()
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
 
-def parse_request(headers, body_file_pointer) -> dict[bytes, bytes]:
-    ctype, pdict = cgi.parse_header(headers['content-type'])
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+
+    def finish(self) -> None:
+        self.file.seek(0)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def get_value(self) -> "FieldValue":
+        return cast(BinaryIO, self.file)
+
+    async def write_async(self, data: bytes) -> None:
+        # Writing to the page cache is fast enough to not need a thread
+        self.write(data)
+
+    async def finish_async(self) -> None:
+        self.finish()
+
+
+# Files are returned as (seekable) file objects, fields handled by a sink as the sink and all other fields as bytes
+FieldValue = Union[bytes, BinaryIO, FieldSink]
+# Called for each multipart part. Can return a sink that should receive the part's contents instead of the default handling
+OpenFieldCallback = Callable[[MultipartPart], Optional[FieldSink]]
+# Called with the size of each piece of the (decoded) request body. Can raise an exception to abort the request
+DataCallback = Callable[[int], None]
+
+
+def parse_request(headers, body_file_pointer,
+                    chunk_size: int = DEFAULT_CHUNK_SIZE,
+                    spool_threshold: int = DEFAULT_SPOOL_THRESHOLD,
+                    max_field_size: int = DEFAULT_MAX_FIELD_SIZE,
+                    open_field: Optional[OpenFieldCallback] = None,
+                    decoding_limits: DecodingLimits = DecodingLimits(),
+                    on_data: Optional[DataCallback] = None,
+                ) -> dict[bytes, FieldValue]:
+    ctype = headers.get_content_type()
     if ctype == 'multipart/form-data':
-        ### Fix the following error:
-        #   [...]
-        #   File "/Library/Frameworks/Python.framework/Versions/3.10/lib/python3.10/cgi.py", line 206, in parse_multipart
-        #     boundary = pdict['boundary'].decode('ascii')
-        # AttributeError: 'str' object has no attribute 'decode'
-
-        fixed_pdict = {key: value.encode("ascii") for key, value in pdict.items()}
-        data = cgi.parse_multipart(body_file_pointer, fixed_pdict)
-        return ensure_byte_dict(data)
+        length = get_content_length(headers)
+        decoder = create_body_decoder(headers, decoding_limits)
+        return parse_multipart(body_file_pointer, get_multipart_boundary(headers), length, chunk_size, spool_threshold, max_field_size, open_field,
+            decoder, on_data)
     elif ctype == 'application/x-www-form-urlencoded':
-        length = int(headers['content-length'])
+        length = get_content_length(headers)
+        check_urlencoded_length(length)
+        decoder = create_body_decoder(headers, get_urlencoded_limits(decoding_limits))
         request_body_bytes = body_file_pointer.read(length)
-        # Parse query string
-        data = parse_qs(request_body_bytes, keep_blank_values=1)
-        return ensure_byte_dict(data)
+        if type(decoder) is not BodyDecoder:
+            request_body_bytes = b"".join(decoder.decode_all([request_body_bytes]))
+        if on_data:
+            on_data(len(request_body_bytes))
+        return parse_urlencoded(request_body_bytes)
+    else:
+        raise_unknown_content_type(ctype)
+
+
+def is_raw_upload(command: str, headers) -> bool:
+    """
+    Raw uploads send the file as the request body instead of wrapping it in a form (like `curl -T FILE`).
+    POST requests without a Content-Type header are treated as raw uploads too, since they do not contain a form
+    """
+    if command in ["PUT", "PATCH"]:
+        return True
+    return command == "POST" and (headers.get("content-type") is None or headers.get_content_type() == "application/octet-stream")
+
+
+def raise_unknown_content_type(ctype: str) -> NoReturn:
+    raise RequestBodyError(f"Unknown content type: '{ctype}'. Supported are: multipart/form-data, application/x-www-form-urlencoded",
+        HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
+
+
+def get_content_length(headers) -> int:
+    """
+    Fails with '411 Length Required' if the Content-Length header is missing or invalid
+    """
+    try:
+        length = int(headers["content-length"])
+    except (TypeError, ValueError):
+        raise RequestBodyError("Missing or invalid Content-Length header", HTTPStatus.LENGTH_REQUIRED)
+    if length < 0:
+        raise RequestBodyError("Missing or invalid Content-Length header", HTTPStatus.LENGTH_REQUIRED)
+    return length
+
+
+def get_announced_length(headers) -> int:
+    """
+    Returns the Content-Length of a request, or 0 if it is chunked or has no valid Content-Length (which is reported when the body is read)
+    """
+    if headers.get("content-length") is None or headers.get("transfer-encoding") is not None:
+        return 0
+    try:
+        return get_content_length(headers)
+    except RequestBodyError:
+        return 0
+
+
+def is_chunked(headers) -> bool:
+    """
+    Returns whether the request body uses chunked transfer encoding, which takes precedence over Content-Length
+    """
+    transfer_encoding = headers.get("transfer-encoding")
+    if transfer_encoding is None:
+        return False
+    if transfer_encoding.strip().lower() != "chunked":
+        raise RequestBodyError(f"Unsupported Transfer-Encoding: '{transfer_encoding}'")
+    return True
+
+
+def parse_chunk_size(line: bytes) -> int:
+    """
+    Parses the size line of a chunk ("1a2b" with optional chunk extensions after a ';')
+    """
+    if not line.endswith(b"\n"):
+        raise RequestBodyError("Chunk size line is too long or incomplete")
+    size = line.split(b";", 1)[0].strip()
+    try:
+        if not size or size.startswith((b"+", b"-", b"0x", b"0X")):
+            raise ValueError()
+        return int(size, 16)
+    except ValueError:
+        raise RequestBodyError(f"Invalid chunk size: {size[:32]!r}")
+
+
+def read_request_body(headers, body_file_pointer, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Yields the request body in chunks of at most `chunk_size` bytes. Supports Content-Length and chunked transfer encoding
+    """
+    if is_chunked(headers):
+        yield from read_chunked_body(body_file_pointer, chunk_size)
+        return
+    if headers.get("content-length") is None:
+        # Requests without Content-Length and Transfer-Encoding have no body
+        return
+
+    remaining = get_content_length(headers)
+    while remaining > 0:
+        chunk = body_file_pointer.read(min(chunk_size, remaining))
+        if not chunk:
+            raise RequestBodyError("Request body ended before the announced Content-Length")
+        remaining -= len(chunk)
+        yield chunk
+
+
+def read_chunked_body(body_file_pointer, chunk_size: int) -> Iterator[bytes]:
+    while True:
+        size = parse_chunk_size(body_file_pointer.readline(MAX_CHUNK_LINE_SIZE + 1))
+        if size == 0:
+            break
+        remaining = size
+        while remaining > 0:
+            chunk = body_file_pointer.read(min(chunk_size, remaining))
+            if not chunk:
+                raise RequestBodyError("Request body ended in the middle of a chunk")
+            remaining -= len(chunk)
+            yield chunk
+        if body_file_pointer.readline(MAX_CHUNK_LINE_SIZE + 1).strip(b"\r\n"):
+            raise RequestBodyError("Missing line break after chunk")
+
+    # Skip the trailer fields, which we do not use
+    for _ in range(MAX_TRAILER_LINES):
+        line = body_file_pointer.readline(MAX_CHUNK_LINE_SIZE + 1)
+        if not line.endswith(b"\n"):
+            raise RequestBodyError("Trailer line is too long or incomplete")
+        if line in (b"\r\n", b"\n"):
+            return
+    raise RequestBodyError("Too many trailer lines")
+
+
+def get_multipart_boundary(headers) -> bytes:
+    boundary = headers.get_param("boundary")
+    if not boundary:
+        raise MultipartError("Content-Type header is missing the boundary parameter")
+    return ensure_bytes(boundary)
+
+
+def check_urlencoded_length(length: int) -> None:
+    if length > MAX_URLENCODED_SIZE:
+        raise RequestBodyError(f"Urlencoded forms may not be larger than {MAX_URLENCODED_SIZE} bytes. Upload files as multipart/form-data instead",
+            HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+
+def get_urlencoded_limits(limits: DecodingLimits) -> DecodingLimits:
+    """
+    Urlencoded forms are decoded in memory, so they are limited to a smaller size
+    """
+    return limits._replace(max_size=min(limits.max_size, MAX_URLENCODED_SIZE))
+
+
+def parse_urlencoded(request_body_bytes: bytes) -> dict[bytes, FieldValue]:
+    # Parse query string
+    data = parse_qs(request_body_bytes, keep_blank_values=True)
+    result: dict[bytes, FieldValue] = dict(ensure_byte_dict(data))
+    return result
+
+
+def parse_multipart(body_file_pointer, boundary: bytes, length: int, chunk_size: int, spool_threshold: int, max_field_size: int,
+                    open_field: Optional[OpenFieldCallback] = None, decoder: Optional[BodyDecoder] = None,
+                    on_data: Optional[DataCallback] = None) -> dict[bytes, FieldValue]:
+    """
+    Reads the multipart body in chunks of `chunk_size` bytes and decodes it with `decoder` (if its Content-Encoding is not identity).
+    `on_data` is called with the size of every decoded chunk.
+    Parts for which `open_field` returns a sink are passed to the sink chunk by chunk.
+    Other file parts are written to temporary files, that only stay in memory while they are smaller than `spool_threshold`.
+    """
+    parser = MultipartParser(boundary)
+    result: dict[bytes, FieldValue] = {}
+    # The part that is currently being received
+    current_part: Optional[MultipartPart] = None
+    sink: Optional[FieldSink] = None
+
+    if decoder is None:
+        decoder = BodyDecoder()
+
+    try:
+        # The whole body is read (and decoded), even the epilogue, so that the next request on this connection starts at the right place
+        for chunk in decoder.decode_all(read_content(body_file_pointer, length, chunk_size)):
+            if on_data:
+                on_data(len(chunk))
+            if parser.done:
+                continue
+
+            for event in parser.feed(chunk):
+                if isinstance(event, PartBegin):
+                    current_part = event.part
+                    sink = open_field(current_part) if open_field else None
+                    if sink is None:
+                        sink = create_default_sink(current_part, spool_threshold, max_field_size)
+                elif isinstance(event, PartData):
+                    # The parser always begins a part before its data
+                    assert sink is not None
+                    sink.write(event.data)
+                elif isinstance(event, PartEnd):
+                    assert sink is not None and current_part is not None
+                    sink.finish()
+                    store_field_value(result, current_part, sink.get_value())
+                    current_part, sink = None, None
+        parser.close()
+    except BaseException:
+        # Do not leak temporary files
+        if sink is not None:
+            sink.close()
+        close_request_data(result)
+        raise
+    return result
+
+
+def read_content(body_file_pointer, length: int, chunk_size: int) -> Iterator[bytes]:
+    """
+    Yields the `length` bytes of a multipart body in chunks of at most `chunk_size` bytes
+    """
+    remaining = length
+    while remaining > 0:
+        chunk = body_file_pointer.read(min(chunk_size, remaining))
+        if not chunk:
+            raise MultipartError("Request body ended before the announced Content-Length")
+        remaining -= len(chunk)
+        yield chunk
+
+
+def create_default_sink(part: MultipartPart, spool_threshold: int, max_field_size: int) -> FieldSink:
+    if part.filename is not None:
+        return SpooledFileSink(spool_threshold)
+    else:
+        return MemoryFieldSink(part, max_field_size)
+
+
+def store_field_value(result: dict[bytes, FieldValue], part: MultipartPart, value: FieldValue) -> None:
+    # Like before, only the first value is kept if a field name is used multiple times
+    if part.name in result:
+        close_field_value(value)
     else:
-        raise Exception(f"Unknown content type: '{ctype}'")   
+        result[part.name] = value
+
+
+def close_field_value(value) -> None:
+    if hasattr(value, "close"):
+        value.close()
+
+
+def close_request_data(data: dict[bytes, FieldValue]) -> None:
+    """
+    Closes (and thus deletes) all temporary files and sinks that were created by parse_request
+    """
+    for value in data.values():
+        close_field_value(value)
+
+
+def field_as_file(value: Union[bytes, BinaryIO]) -> BinaryIO:
+    """
+    Allows upload modules to handle files uploaded as normal form fields and as file fields the same way
+    """
+    if isinstance(value, bytes):
+        return io.BytesIO(value)
+    return value
 
 
 def ensure_byte_dict(byte_or_strings_in_dict: dict) -> dict[bytes, bytes]:
@@ -1,79 +1,305 @@
-import logging
+from bisect import bisect_right
+import hashlib
+import mmap
+import multiprocessing
+import os
+import socket
+import struct
 import time
-from typing import Optional
+from typing import Iterable, Optional
+# local
+from .log import get_logger
+from .metrics import IP_BLOCKS
 
-logger = logging.getLogger("IP blocks")
-logger.setLevel(logging.DEBUG)
-c_handler = logging.StreamHandler()
-c_format = logging.Formatter('[%(levelname)s] %(name)s: %(message)s')
-c_handler.setFormatter(c_format)
-logger.addHandler(c_handler)
+logger = get_logger("IP blocks")
+
+
+# IPv4 addresses are stored as IPv4-mapped IPv6 addresses (::ffff:a.b.c.d)
+IPV4_MAPPED_PREFIX = b"\x00" * 10 + b"\xff\xff"
+
+
+def pack_ip_address(ip_address: str) -> Optional[bytes]:
+    """
+    Converts an IP address to a fixed size (16 byte) big endian key or returns None if it is not a valid address.
+    IPv4 addresses are mapped to IPv6 (::ffff:a.b.c.d), so that IPv4 clients of a dual stack socket are treated the same as clients of an IPv4 socket
+    """
+    # Remove the scope of link-local IPv6 addresses (fe80::1%eth0)
+    ip_address = ip_address.split("%", 1)[0]
+    # socket.inet_pton is a lot faster than the ipaddress module, which matters when loading large rule lists
+    try:
+        return IPV4_MAPPED_PREFIX + socket.inet_pton(socket.AF_INET, ip_address)
+    except OSError:
+        pass
+    try:
+        return socket.inet_pton(socket.AF_INET6, ip_address)
+    except OSError:
+        return None
+
+
+def ip_address_key(ip_address: str) -> bytes:
+    """
+    Like pack_ip_address, but also returns a stable key for invalid addresses (which should not happen for TCP connections)
+    """
+    key = pack_ip_address(ip_address)
+    if key is None:
+        return hashlib.sha256(ip_address.encode("utf-8")).digest()[:16]
+    return key
+
+
+def ip_network_range(network: str) -> tuple[int, int]:
+    """
+    Parses an address ("10.1.2.3") or a CIDR range ("10.0.0.0/8", "2001:db8::/32") and returns the first and last address
+    as integers in the key space of pack_ip_address
+    """
+    address, has_prefix, prefix_length = network.strip().partition("/")
+    key = pack_ip_address(address)
+    if key is None:
+        raise Exception(f"Invalid IP address or network: '{network}'")
+    # IPv4 prefix lengths are relative to the last 32 bits of the mapped address
+    max_prefix_length = 32 if key.startswith(IPV4_MAPPED_PREFIX) and ":" not in address else 128
+    if has_prefix:
+        if not prefix_length.isdigit() or int(prefix_length) > max_prefix_length:
+            raise Exception(f"Invalid IP address or network: '{network}'")
+        host_bits = max_prefix_length - int(prefix_length)
+    else:
+        host_bits = 0
+    host_mask = (1 << host_bits) - 1
+    first = int.from_bytes(key, "big") & ~host_mask
+    return first, first | host_mask
+
+
+def load_ip_rules(path: str) -> list[str]:
+    """
+    Reads addresses and CIDR ranges from a file: one per line, everything after a '#' is ignored
+    """
+    rules = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                rules.append(line)
+    return rules
+
+
+class _PackedKeys:
+    """
+    A read-only sequence view of 16 byte keys stored back to back, so that they can be searched with bisect
+    """
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.data) // 16
+
+    def __getitem__(self, index: int) -> bytes:
+        return self.data[index * 16:index * 16 + 16]
+
+
+class IpRangeSet:
+    """
+    A set of IP addresses and CIDR ranges (IPv4 and IPv6).
+    Overlapping and adjacent ranges are merged and the remaining ranges are stored as two sorted arrays of 16 byte big endian
+    keys (32 bytes per range). Since big endian keys compare like the numbers they encode, a lookup is a binary search (bisect).
+    """
+
+    def __init__(self, networks: Iterable[str] = ()) -> None:
+        ranges = sorted(ip_network_range(network) for network in networks)
+        merged: list[list[int]] = []
+        for first, last in ranges:
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        self.starts = _PackedKeys(b"".join(first.to_bytes(16, "big") for first, _ in merged))
+        self.ends = _PackedKeys(b"".join(last.to_bytes(16, "big") for _, last in merged))
+
+    def __len__(self) -> int:
+        """
+        Returns the number of (merged) ranges
+        """
+        return len(self.starts)
+
+    def __contains__(self, ip_address: str) -> bool:
+        if not len(self.starts):
+            return False
+        key = pack_ip_address(ip_address)
+        if key is None:
+            return False
+        # Find the last range that starts at or before the address
+        index = bisect_right(self.starts, key) - 1
+        return index >= 0 and key <= self.ends[index]
+
+
+class SharedBlockTable:
+    """
+    Stores the per address failed authentication counters and blocks in a fixed size, set associative hash table:
+    each address hashes to one bucket of `WAYS` entries and can only be stored in that bucket.
+    When a bucket is full, an entry is evicted with the CLOCK algorithm (an approximation of LRU), so every operation
+    only looks at a few entries and the memory usage does not grow no matter how many addresses are seen.
+    The table lives in an anonymous shared memory mapping, so it is shared with all worker processes that are forked after it was created.
+    This way the failed attempts against all workers count towards the same limit.
+    All accesses need to hold `lock`, which works across threads and processes.
+    """
+    WAYS = 8
+    # Dropped connections, evicted entries
+    HEADER = struct.Struct("<QQ")
+    # IP address key, flags, failed attempts in the previous and current window, current window start, blocked until (monotonic time)
+    ENTRY = struct.Struct("<16sB3xIIdd")
+    FLAG_USED = 1
+    # Set when the entry is used and cleared by the CLOCK hand. Entries without it are evicted first
+    FLAG_REFERENCED = 2
+
+    def __init__(self, capacity: int) -> None:
+        self.bucket_count = max(1, -(-capacity // self.WAYS))
+        self.capacity = self.bucket_count * self.WAYS
+        # The header is followed by one CLOCK hand (one byte) per bucket and then the entries
+        self.entries_offset = self.HEADER.size + self.bucket_count
+        # Anonymous mappings are shared with child processes
+        self.memory = mmap.mmap(-1, self.entries_offset + self.capacity * self.ENTRY.size)
+        self.lock = multiprocessing.Lock()
+        # A secret hash key prevents attackers from choosing addresses that all end up in the same bucket
+        self.hash_key = os.urandom(16)
+
+    def get_counters(self) -> tuple[int, int]:
+        """
+        Returns the number of dropped connections and evicted entries
+        """
+        return self.HEADER.unpack_from(self.memory, 0)
+
+    def increase_dropped_connections(self) -> int:
+        dropped, evicted = self.HEADER.unpack_from(self.memory, 0)
+        self.HEADER.pack_into(self.memory, 0, dropped + 1, evicted)
+        return dropped + 1
+
+    def lookup(self, key: bytes) -> Optional[tuple[int, int, float, float]]:
+        """
+        Returns the previous window's count, the current window's count, the current window start and the block end of the key
+        or None if it is not tracked
+        """
+        index = self._find(key, self._bucket(key))
+        if index is None:
+            return None
+        _, flags, previous_count, count, window_start, blocked_until = self.ENTRY.unpack_from(self.memory, self._offset(index))
+        return previous_count, count, window_start, blocked_until
+
+    def store(self, key: bytes, previous_count: int, count: int, window_start: float, blocked_until: float, is_stale) -> None:
+        """
+        Stores the entry for the key. If the key is not yet tracked and its bucket is full, an entry is evicted.
+        `is_stale(previous_count, count, window_start, blocked_until)` tells whether an entry has expired and can be replaced without counting as an eviction
+        """
+        bucket = self._bucket(key)
+        index = self._find(key, bucket)
+        if index is None:
+            index = self._evict(bucket, is_stale)
+        flags = self.FLAG_USED | self.FLAG_REFERENCED
+        self.ENTRY.pack_into(self.memory, self._offset(index), key, flags, previous_count, count, window_start, blocked_until)
+
+    def _bucket(self, key: bytes) -> int:
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8, key=self.hash_key).digest(), "little") % self.bucket_count
+
+    def _find(self, key: bytes, bucket: int) -> Optional[int]:
+        for index in range(bucket * self.WAYS, (bucket + 1) * self.WAYS):
+            entry_key, flags = self.ENTRY.unpack_from(self.memory, self._offset(index))[:2]
+            if flags & self.FLAG_USED and entry_key == key:
+                if not flags & self.FLAG_REFERENCED:
+                    self.memory[self._offset(index) + 16] = flags | self.FLAG_REFERENCED
+                return index
+        return None
+
+    def _evict(self, bucket: int, is_stale) -> int:
+        """
+        Returns the index of an entry in the bucket that can be overwritten
+        """
+        first = bucket * self.WAYS
+        # Prefer free and expired entries
+        for index in range(first, first + self.WAYS):
+            _, flags, *state = self.ENTRY.unpack_from(self.memory, self._offset(index))
+            if not flags & self.FLAG_USED or is_stale(*state):
+                return index
+
+        # CLOCK: advance the hand and clear the referenced flags, until an entry that was not used since the last round is found
+        hand_offset = self.HEADER.size + bucket
+        hand = self.memory[hand_offset]
+        for _ in range(2 * self.WAYS):
+            index = first + hand
+            hand = (hand + 1) % self.WAYS
+            flags_offset = self._offset(index) + 16
+            if self.memory[flags_offset] & self.FLAG_REFERENCED:
+                self.memory[flags_offset] &= ~self.FLAG_REFERENCED
+            else:
+                break
+        self.memory[hand_offset] = hand
+
+        dropped, evicted = self.HEADER.unpack_from(self.memory, 0)
+        self.HEADER.pack_into(self.memory, 0, dropped, evicted + 1)
+        return index
+
+    def _offset(self, index: int) -> int:
+        return self.entries_offset + index * self.ENTRY.size
 
 
 class IpAddressBlocker:
-    def __init__(self, allowed_ips: list[str], denied_ips: list[str], block_threshold: int, block_duration: int) -> None:
+    def __init__(self, allowed_ips: list[str], denied_ips: list[str], block_threshold: int, block_duration: int, max_tracked_ips: int = 65536) -> None:
         """
         Creates an IP address blocker.
+        allowed_ips and denied_ips can contain single addresses and CIDR ranges (like 10.0.0.0/8 or 2001:db8::/32).
         If an IP address is both in allowed_ips and denied_ips, the entry in denied_ips will take precedence.
         If an IP is in neither, failed authentication attempts will be tracked.
-        After `block_threshold` fails are recorded, the address will be blocked.
-        `block_duration` seconds after the first block, all temporary blocks will be reset.
+        After `block_threshold` fails are recorded within a sliding window of `block_duration` seconds, the address will be blocked for `block_duration` seconds.
+        At most `max_tracked_ips` addresses are tracked, when there are more the least recently used ones are forgotten.
+        The temporary blocks are shared with processes forked after the blocker was created.
         """
-        self.allowed_ips = set(allowed_ips)
-        self.denied_ips = set(denied_ips)
+        self.allowed_ips = IpRangeSet(allowed_ips)
+        self.denied_ips = IpRangeSet(denied_ips)
         # Start: Variables for temporary blocks
-        # Set of IP addresses that have exceeded the threshold
-        self.block_ip_set = set()
-        # Counts of failed attempts for addressed below the threshld
-        self.block_counts_map: dict[str, int] = {}
-        # None means no blocks are currently active
-        # As soon as a block is made, the time is stored. This prevents some blocks from expiring prematurely
-        self.block_period_start: Optional[float] = None
+        self.table = SharedBlockTable(max_tracked_ips)
         self.block_threshold = block_threshold
         self.block_duration = block_duration
         # End: Variables for temporary blocks
 
-    def update_blocks(self) -> None:
+    def is_stale(self, previous_count: int, count: int, window_start: float, blocked_until: float) -> bool:
         """
-        We could store each failed attempt with a timestamp and track it accurately,
-        but it would be way easier to implement (and thus less error prone) to just reset all blocks periodically
+        An entry is stale once it is no longer blocked and its failed attempts are no longer part of the sliding window
         """
         now = time.monotonic()
-        if self.block_period_start and now > self.block_period_start + self.block_duration:
-            # Block period expired, reset all blocks
-            self.block_ip_set = set()
-            self.block_counts_map = {}
-            self.block_period_start = None
-            logger.info("Reset temporary blocks")
+        return blocked_until <= now and now >= window_start + 2 * self.block_duration
 
     def increase_failed_auth_count(self, ip_address: str) -> None:
-        if ip_address in self.block_ip_set:
-            # already blocked
-            return
-        elif ip_address in self.allowed_ips or ip_address in self.denied_ips:
+        if ip_address in self.allowed_ips or ip_address in self.denied_ips:
             # already have an existing rule for this ip
             return
-        else:
-            # Start the timer if this is the first block
-            if not self.block_period_start:
-                now = time.monotonic()
-                self.block_period_start = now
-                logger.debug("Blocking period timer started")
-
-            try:
-                # Increase existing fail count by one
-                self.block_counts_map[ip_address] += 1
-            except KeyError:
-                # No entry for ip address, so we start a new count for it
-                self.block_counts_map[ip_address] = 1
-            
-            logger.debug(f"{ip_address} has {self.block_counts_map[ip_address]} failed authentication attempt(s)")
-            # This needs to be here in case block_threshold is set to one
-            if self.block_counts_map[ip_address] >= self.block_threshold:
-                # Threshold exceeded -> put on block list, remove counter
-                self.block_ip_set.add(ip_address)
-                del self.block_counts_map[ip_address]
-                logger.info(f"Temporarily blocked {ip_address}")
+
+        key = ip_address_key(ip_address)
+        now = time.monotonic()
+        with self.table.lock:
+            previous_count, count, window_start, blocked_until = self.table.lookup(key) or (0, 0, now, 0.0)
+            if blocked_until > now:
+                # already blocked
+                return
+
+            # The sliding window is approximated with two fixed windows: the attempts of the previous window are weighted
+            # by how much of it still overlaps with the sliding window
+            if now >= window_start + 2 * self.block_duration:
+                previous_count, count, window_start = 0, 0, now
+            elif now >= window_start + self.block_duration:
+                previous_count, count, window_start = count, 0, window_start + self.block_duration
+            count += 1
+            overlap = 1 - (now - window_start) / self.block_duration
+            failed_attempts = previous_count * overlap + count
+
+            # This needs to be compared here in case block_threshold is set to one
+            blocked = failed_attempts >= self.block_threshold
+            if blocked:
+                # Start over once the block expires
+                previous_count, count, window_start, blocked_until = 0, 0, now, now + self.block_duration
+            self.table.store(key, previous_count, count, window_start, blocked_until, self.is_stale)
+
+        logger.debug("%s has %.1f failed authentication attempt(s) in the last %d seconds", ip_address, failed_attempts, self.block_duration)
+        if blocked:
+            # Threshold exceeded -> block it
+            IP_BLOCKS.inc()
+            logger.info("Temporarily blocked %s for %d seconds", ip_address, self.block_duration)
 
     def is_blocked(self, ip_address: str) -> bool:
         if ip_address in self.denied_ips:
@@ -83,5 +309,36 @@ class IpAddressBlocker:
             # Permanently allowed
             return False
         else:
-            # No static rule, so we check the temporary block list
-            return ip_address in self.block_ip_set
+            # No static rule, so we check the temporary blocks. Expired blocks are ignored and later replaced
+            key = ip_address_key(ip_address)
+            with self.table.lock:
+                entry = self.table.lookup(key)
+            return entry is not None and entry[3] > time.monotonic()
+
+    def should_drop_connection(self, ip_address: str) -> bool:
+        """
+        Checks a new connection before anything else is done with it.
+        Returns True (and counts the connection as dropped) if the connection should be closed right away
+        """
+        if not self.is_blocked(ip_address):
+            return False
+        with self.table.lock:
+            dropped = self.table.increase_dropped_connections()
+        logger.debug("Dropping connection from blocked IP address %s (%d dropped connections in total)", ip_address, dropped)
+        return True
+
+    @property
+    def dropped_connections(self) -> int:
+        """
+        The number of connections from blocked addresses that were dropped (by all worker processes)
+        """
+        with self.table.lock:
+            return self.table.get_counters()[0]
+
+    @property
+    def evicted_entries(self) -> int:
+        """
+        The number of tracked addresses that were forgotten to make room for other ones (by all worker processes)
+        """
+        with self.table.lock:
+            return self.table.get_counters()[1]
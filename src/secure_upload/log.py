@@ -0,0 +1,172 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+from typing import Optional
+
+DEFAULT_FORMAT = '[%(levelname)s] %(name)s: %(message)s'
+# Records that do not fit into the queue are dropped instead of blocking the thread that logs them
+MAX_QUEUED_RECORDS = 10000
+# Maximum length of a value logged with Capped
+MAX_VALUE_LENGTH = 200
+# Maximum number of items of a dict or list logged with Capped
+MAX_ITEMS = 20
+# Messages with only these argument types are formatted by the background thread. Others are formatted right away, since they could change in the meantime
+IMMUTABLE_ARGUMENT_TYPES = (str, bytes, int, float, bool, type(None))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Writes each record as a JSON object on its own line
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class BackgroundLogHandler(logging.handlers.QueueHandler):
+    """
+    Hands the records to a background thread, that formats and writes them, so that slow log I/O never blocks a request.
+    Until the background thread is started (see configure_logging), records are written directly.
+    """
+
+    def __init__(self, target: logging.Handler) -> None:
+        super().__init__(queue.Queue(MAX_QUEUED_RECORDS))
+        self.target = target
+        self.listener: Optional[logging.handlers.QueueListener] = None
+        # Number of records that were dropped, because the queue was full
+        self.dropped_records = 0
+        # Only used to format exceptions, while their traceback is still available
+        self.exception_formatter = logging.Formatter()
+
+    def start(self) -> None:
+        if self.listener is None:
+            self.listener = logging.handlers.QueueListener(self.queue, self.target)
+            self.listener.start()
+
+    def stop(self) -> None:
+        """
+        Writes the queued records and stops the background thread
+        """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def restart_after_fork(self) -> None:
+        # Threads do not survive fork, so the child needs its own background thread (and queue, since its lock may have been held by another thread)
+        if self.listener is not None:
+            self.queue = queue.Queue(MAX_QUEUED_RECORDS)
+            self.listener = None
+            self.start()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.listener is None:
+            self.target.handle(record)
+        else:
+            super().emit(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Unlike QueueHandler.prepare, we leave the formatting to the background thread where possible
+        if record.args and not (isinstance(record.args, tuple) and all(isinstance(arg, IMMUTABLE_ARGUMENT_TYPES) for arg in record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # The traceback refers to frames that will be gone once the background thread formats the record
+            record.exc_text = self.exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_records += 1
+
+
+class Capped:
+    """
+    Logs a (potentially huge) value like a request's form data with a limited size.
+    Use it as argument: logger.debug("POST data: %s", Capped(post_data)). It is only converted to a string if the message is logged
+    """
+
+    def __init__(self, value, max_length: int = MAX_VALUE_LENGTH) -> None:
+        self.value = value
+        self.max_length = max_length
+
+    def __str__(self) -> str:
+        return capped_repr(self.value, self.max_length)
+
+
+def capped_repr(value, max_length: int = MAX_VALUE_LENGTH) -> str:
+    """
+    Like repr, but strings, bytes and the values in dicts and lists are shortened to `max_length` characters
+    """
+    if isinstance(value, (bytes, bytearray, str)):
+        if len(value) > max_length:
+            unit = "characters" if isinstance(value, str) else "bytes"
+            return f"{value[:max_length]!r}... ({len(value)} {unit})"
+        return repr(value)
+    if isinstance(value, dict):
+        items = [f"{capped_repr(key, max_length)}: {capped_repr(item, max_length)}" for key, item in list(value.items())[:MAX_ITEMS]]
+        if len(value) > MAX_ITEMS:
+            items.append(f"... ({len(value)} items)")
+        return "{" + ", ".join(items) + "}"
+    if isinstance(value, (list, tuple)):
+        items = [capped_repr(item, max_length) for item in value[:MAX_ITEMS]]
+        if len(value) > MAX_ITEMS:
+            items.append(f"... ({len(value)} items)")
+        return "[" + ", ".join(items) + "]"
+    text = repr(value)
+    return text if len(text) <= max_length else text[:max_length] + "..."
+
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(logging.Formatter(DEFAULT_FORMAT))
+HANDLER = BackgroundLogHandler(stream_handler)
+# The loggers created by get_logger
+loggers: list[logging.Logger] = []
+log_level = logging.INFO
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=HANDLER.restart_after_fork)
+atexit.register(HANDLER.stop)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Returns a logger that writes to stderr through the background thread and uses the configured level
+    """
+    logger = logging.getLogger(name)
+    if HANDLER not in logger.handlers:
+        logger.addHandler(HANDLER)
+        logger.setLevel(log_level)
+        loggers.append(logger)
+    return logger
+
+
+def configure_logging(level: str = "INFO", format: str = "text") -> None:
+    """
+    Sets the level of all our loggers, the output format ('text' or 'json') and starts the background thread
+    """
+    global log_level
+    log_level = logging.getLevelName(level.upper())
+    if not isinstance(log_level, int):
+        raise Exception(f"Unknown log level: '{level}'")
+    for logger in loggers:
+        logger.setLevel(log_level)
+    stream_handler.setFormatter(JsonFormatter() if format == "json" else logging.Formatter(DEFAULT_FORMAT))
+    HANDLER.start()
@@ -1,15 +1,30 @@
 #!/usr/bin/env python3
 import argparse
-import functools
-from http.server import ThreadingHTTPServer, test
-from typing import Any
+import asyncio
+import getpass
+import os
+import signal
+from typing import Any, Optional
 
+from secure_upload.upload import openpgp
 from secure_upload.upload.gpg import GpgUploadHandler
 from secure_upload.upload.handler import ModuleHandler
+from secure_upload.upload.resumable import ResumableUploadModule
+from secure_upload.upload.scheduler import DecryptionScheduler
+from secure_upload.upload.dedup import DedupIndex
+from secure_upload.upload.store import DURABILITY_POLICIES, OutputStore
 # local files
-from .server import CustomRequestHandler
-from .client_auth import HttpBasicAuthClientAuthenticator, MultiClientAuthenticator
-from .ip_blocking import IpAddressBlocker
+from .async_server import AsyncUploadServer
+from .prefork import exit_on_sigterm, run_workers
+from .server import CustomRequestHandler, serve_threading
+from .http_response import DEFAULT_MIN_TRANSFER_RATE, DEFAULT_READ_GRACE_PERIOD, DecodingLimits
+from .client_auth import (HttpBasicAuthClientAuthenticator, HttpBasicCredentialFileAuthenticator, MultiClientAuthenticator, PasswordHash,
+    TlsClientCertificateAuthenticator)
+from .ip_blocking import IpAddressBlocker, load_ip_rules
+from .log import HANDLER, configure_logging
+from .metrics import REGISTRY, start_metrics_server
+from .quota import StorageQuota
+from .tls import create_tls_context
 
 def parse_args() -> Any:
     default_block_threshold = 2
@@ -21,30 +36,109 @@ def parse_args() -> Any:
     ap.add_argument("-p", "--http-port", nargs="?", type=int, default=8000, help="the port to bind the HTTP server to. Defaults to 8000")
     ap.add_argument("-b", "--bind", default=None, metavar="ADDRESS",
         help="Specify alternate bind address. Defaults to all interfaces (and both IPv4 and IPv6, which may render IP address based blocking nearly useless)")
+    ap.add_argument("-w", "--workers", type=int, default=1, metavar="N",
+        help="number of server processes. With more than one, all of them listen on the same port (SO_REUSEPORT) and share the IP address blocks. Defaults to 1")
+    ap.add_argument("--idle-timeout", type=float, default=15, metavar="SECONDS",
+        help="connections are kept open for more requests, until the client did not send a new request for this many seconds. Defaults to 15")
+    ap.add_argument("--engine", choices=["threading", "asyncio"], default="threading",
+        help="'threading' uses one thread per connection. 'asyncio' handles all connections in a single event loop, which scales better to many concurrent (or slow) clients. Defaults to 'threading'")
+
+    ap.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO", type=str.upper,
+        help="only log messages with at least this level. DEBUG logs details about every request (like failed authentication attempts). Defaults to INFO")
+    ap.add_argument("--log-format", choices=["text", "json"], default="text", help="'json' writes each log message as a JSON object on its own line. Defaults to 'text'")
+    ap.add_argument("--metrics-port", type=int, default=None, metavar="PORT",
+        help="serve Prometheus metrics on 'http://127.0.0.1:PORT/metrics'. With multiple --workers, worker N uses PORT + N")
 
     auth_group = ap.add_argument_group("Authentication", "Authentication is used to prevent random people from interacting with the web server. You will need to enable at least one of the following options. Since authentication credentials may be passed on plain text or weakly hashed form, DO NOT REUSE THESE CREDENTIALS FOR ANYTHING ELSE (especially not as encryption password)!")
     auth_group.add_argument("--http-basic", metavar=("USERNAME", "PASSWORD"), nargs=2, required=False, help="HTTP Basic authentication. Widely supported, but transmits credentials in plain text")
+    auth_group.add_argument("--http-basic-file", metavar="FILE", help="HTTP Basic authentication for multiple users, whose credentials are read from FILE. Each line contains 'USERNAME:PASSWORD_HASH', use --hash-password to create them. The file is reloaded when it changes")
+    auth_group.add_argument("--tls-client-ca", metavar="FILE", help="TLS client certificate authentication: accept clients with a certificate issued by one of the CAs in FILE (PEM). Requires --tls-cert")
+    auth_group.add_argument("--tls-client-names", nargs="*", default=[], metavar="NAME", help="only accept client certificates with one of these common names")
+    auth_group.add_argument("--hash-password", metavar="USERNAME", help="asks for a password, prints a line for --http-basic-file and exits")
+
+    tls_group = ap.add_argument_group("TLS", "Serve HTTPS instead of HTTP. Returning clients resume their TLS session, which makes repeated connections much cheaper")
+    tls_group.add_argument("--tls-cert", metavar="FILE", help="the server's certificate chain (PEM). May also contain the private key")
+    tls_group.add_argument("--tls-key", metavar="FILE", help="the server's private key (PEM), if it is not in --tls-cert")
 
     ip_group = ap.add_argument_group("IP based access control", "IP based access control aims to prevent unauthorized access and limit brute force attacks against the authentication.")
-    ip_group.add_argument("--allow-ips", nargs="*", default=[], help="always allow access from these IP addresses (even when they repeatedly fail authentication)")
-    ip_group.add_argument("--deny-ips", nargs="*", default=[], help="never allow connections from these IP addresses. If both --allow-ips and --deny-ips contain the same address, --deny-ips will take priority")
+    ip_group.add_argument("--allow-ips", nargs="*", default=[], help="always allow access from these IP addresses or CIDR ranges like 10.0.0.0/8 (even when they repeatedly fail authentication)")
+    ip_group.add_argument("--deny-ips", nargs="*", default=[], help="never allow connections from these IP addresses or CIDR ranges. If both --allow-ips and --deny-ips contain the same address, --deny-ips will take priority")
+    ip_group.add_argument("--allow-ips-file", nargs="*", default=[], metavar="FILE", help="like --allow-ips, but reads the addresses and ranges from files (one per line, '#' starts a comment)")
+    ip_group.add_argument("--deny-ips-file", nargs="*", default=[], metavar="FILE", help="like --deny-ips, but reads the addresses and ranges from files (one per line, '#' starts a comment)")
     ip_group.add_argument("--block-threshold", nargs="?", type=int, default=default_block_threshold, help=f"after how many failed authentication attempts an IP address is temporarily blocked. Defaults to {default_block_threshold}")
-    ip_group.add_argument("--block-duration", nargs="?", type=int, default=default_block_duration, help=f"BLOCK_DURATION seconds after the first failed login, all blocks and failed login counters will be reset. So consider this the maximum block duration. Defaults to {default_block_duration} (seconds)")
+    ip_group.add_argument("--block-duration", nargs="?", type=int, default=default_block_duration, help=f"failed authentication attempts are counted over a sliding window of BLOCK_DURATION seconds and blocked addresses stay blocked for BLOCK_DURATION seconds. Defaults to {default_block_duration} (seconds)")
+    ip_group.add_argument("--max-tracked-ips", type=int, default=65536, metavar="N", help="maximum number of IP addresses whose failed authentication attempts are tracked. When more addresses fail to authenticate, the least recently seen ones are forgotten. Defaults to 65536")
 
     module_group = ap.add_argument_group("Upload modules", "Upload modules define how you can upload data (and how it is encrypted). You will need to enable at least one of the following options:")
     module_group.add_argument("--gpg-symmetric", metavar="PASSWORD", help="the client needs to encrypt the file using GPG with the given password and then upload it to 'http://HOST:PORT/gpg'. See README for more details")
+    module_group.add_argument("--resumable-uploads", metavar="DIRECTORY", help="allow uploads to be split into multiple requests and resumed after an interruption (see README). Incomplete uploads are stored in DIRECTORY")
+    module_group.add_argument("--gpg-in-process", action="store_true", help="decrypt --gpg-symmetric uploads in the server process instead of starting gpg for each upload. Requires the 'cryptography' package. Messages that use unsupported features are still passed to gpg")
+
+    output_group = ap.add_argument_group("Output", "Where the decrypted files are stored. Files are written under a temporary name and only get their final name once they are complete")
+    output_group.add_argument("--output-dir", default="/tmp", metavar="DIRECTORY", help="the directory for the decrypted files. Defaults to /tmp")
+    output_group.add_argument("--output-name", default="TODO_change_me_{name}", metavar="FORMAT",
+        help="the file names. FORMAT can contain {name} (the uploaded file's name), {stem}, {extension}, {date}, {time} and {random}. "
+        "Existing files are never overwritten, a number is appended to the name instead. Defaults to 'TODO_change_me_{name}'")
+    output_group.add_argument("--fsync", choices=DURABILITY_POLICIES, default="none",
+        help="'file' flushes each file to disk before the upload is reported as successful, so that it survives a crash or power loss. "
+        "'group' does the same, but flushes concurrent uploads together, which is much cheaper under load. Defaults to 'none'")
+    output_group.add_argument("--dedup-index", metavar="FILE",
+        help="store files that were uploaded before as hard links to the existing copy. FILE is an SQLite database with the SHA-256 digests of the stored files")
+
+    limits_group = ap.add_argument_group("Request limits", "Request bodies may be compressed with 'Content-Encoding: gzip', 'deflate' or 'zstd' (needs the 'zstandard' package). They are decompressed while they are received. Bodies that exceed these limits are rejected with '413 Content Too Large', which protects against decompression bombs. With --gpg-in-process, the same limits apply to compressed data inside of the encrypted messages")
+    limits_group.add_argument("--max-decoded-size", type=int, default=16 * 1024, metavar="MIB", help="maximum decompressed size of a request body in MiB. Defaults to 16384 (16 GiB)")
+    limits_group.add_argument("--max-compression-ratio", type=float, default=200, metavar="RATIO", help="maximum ratio of decompressed to compressed size of a request body. Defaults to 200")
+    limits_group.add_argument("--min-transfer-rate", type=float, default=DEFAULT_MIN_TRANSFER_RATE, metavar="BYTES_PER_SECOND", help=f"requests that are sent slower than this are aborted, so that slow clients can not tie up the server. 0 disables the check. Defaults to {DEFAULT_MIN_TRANSFER_RATE}")
+    limits_group.add_argument("--read-grace-period", type=float, default=DEFAULT_READ_GRACE_PERIOD, metavar="SECONDS", help=f"how long the server waits for a request's data in addition to what --min-transfer-rate allows. Defaults to {DEFAULT_READ_GRACE_PERIOD}")
+
+    quota_group = ap.add_argument_group("Storage quotas", "Limits how much data clients can upload. Uploads are checked against their Content-Length before the body is read (and chunked uploads while they are received). Uploads that are too large are rejected with '413 Content Too Large', uploads that exceed a quota with '507 Insufficient Storage'")
+    quota_group.add_argument("--max-upload-size", type=int, metavar="MIB", help="maximum size of a single upload in MiB")
+    quota_group.add_argument("--client-quota", type=int, metavar="MIB", help="how many MiB each client (HTTP Basic user or TLS client certificate) may upload in total")
+    quota_group.add_argument("--total-quota", type=int, metavar="MIB", help="how many MiB all clients together may upload")
+    quota_group.add_argument("--quota-file", metavar="FILE", help="keep track of the uploaded bytes in FILE (JSON), so that the quotas also apply after a restart. Delete it to reset the usage")
+
+    scheduler_group = ap.add_argument_group("Decryption scheduling", "Limits how many uploads are decrypted at the same time. Each gpg process uses a worker until it exited. With --gpg-in-process a worker is only used while an upload's data is decrypted, not while it is received, so slow clients do not keep workers busy. When all workers are busy and the queue is full, new uploads are rejected with '503 Service Unavailable'")
+    scheduler_group.add_argument("--decryption-workers", type=int, default=None, metavar="N", help="maximum number of concurrent decryptions per server process. Defaults to the number of CPUs divided by the number of --workers")
+    scheduler_group.add_argument("--decryption-queue", type=int, default=16, metavar="N", help="maximum number of uploads waiting for a free decryption worker. Defaults to 16")
+    scheduler_group.add_argument("--retry-after", type=int, default=5, metavar="SECONDS", help="value of the Retry-After header sent when the queue is full. Defaults to 5")
 
     return ap.parse_args()
 
+def mib_to_bytes(value: Optional[int]) -> Optional[int]:
+    return value * 1024 * 1024 if value is not None else None
+
 def main():
     args = parse_args()
 
+    if args.hash_password:
+        if ":" in args.hash_password:
+            raise Exception("User names can not contain ':'")
+        password = getpass.getpass(f"Password for {args.hash_password}: ")
+        print(f"{args.hash_password}:{PasswordHash.create(password.encode('utf-8'))}")
+        return
+
+    # Log messages are written by a background thread from now on
+    configure_logging(args.log_level, args.log_format)
+    REGISTRY.add_callback("secure_upload_dropped_log_records_total", "Number of log messages that were dropped, because the log queue was full",
+        "counter", lambda: HANDLER.dropped_records)
+
+    tls_context = None
+    if args.tls_cert:
+        # Created before the workers are started, so that they share the session ticket keys
+        tls_context = create_tls_context(args.tls_cert, args.tls_key, args.tls_client_ca)
+    elif args.tls_key or args.tls_client_ca:
+        raise Exception("--tls-key and --tls-client-ca require --tls-cert")
+
     auth_modules = []
     if args.http_basic:
         username, password = args.http_basic
         # @TODO: check length to prevent really weak posswords like "1" or ""
         # @TODO: check password aginst common weak passwords (like "password", "12345678", "admin", "root", "etc")
         auth_modules.append(HttpBasicAuthClientAuthenticator(username, password))
+    if args.http_basic_file:
+        auth_modules.append(HttpBasicCredentialFileAuthenticator(args.http_basic_file))
+    if args.tls_client_ca:
+        auth_modules.append(TlsClientCertificateAuthenticator(args.tls_client_names))
     
     if not auth_modules:
         raise Exception("No authentication module was specified")
@@ -55,28 +149,83 @@ def main():
         # Create an authenticator handler that will accept requests if at least one authenticator allowed them
         authenticator = MultiClientAuthenticator(auth_modules)
 
-    ip_address_blocker = IpAddressBlocker(args.allow_ips, args.deny_ips, args.block_threshold, args.block_duration)
+    allowed_ips = args.allow_ips + [rule for path in args.allow_ips_file for rule in load_ip_rules(path)]
+    denied_ips = args.deny_ips + [rule for path in args.deny_ips_file for rule in load_ip_rules(path)]
+    ip_address_blocker = IpAddressBlocker(allowed_ips, denied_ips, args.block_threshold, args.block_duration, args.max_tracked_ips)
+    # These are counted in shared memory, so every worker reports the total of all workers
+    REGISTRY.add_callback("secure_upload_dropped_connections_total", "Number of connections from blocked IP addresses that were dropped (by all workers)",
+        "counter", lambda: ip_address_blocker.dropped_connections)
+    REGISTRY.add_callback("secure_upload_evicted_ip_entries_total", "Number of tracked IP addresses that were forgotten to make room for others (by all workers)",
+        "counter", lambda: ip_address_blocker.evicted_entries)
 
+    # Also used for the compressed data inside of messages that are decrypted in-process
+    decoding_limits = DecodingLimits(args.max_decoded_size * 1024 * 1024, args.max_compression_ratio)
 
     modules = []
     if args.gpg_symmetric:
-        modules.append(GpgUploadHandler(args.gpg_symmetric))
+        if args.gpg_in_process and not openpgp.is_available():
+            raise Exception("--gpg-in-process requires the 'cryptography' package")
+        decryption_workers = args.decryption_workers
+        if decryption_workers is None:
+            # Split the CPUs between the server processes
+            decryption_workers = max(1, (os.cpu_count() or 1) // max(1, args.workers))
+        scheduler = DecryptionScheduler(decryption_workers, args.decryption_queue, retry_after=args.retry_after)
+        REGISTRY.add_callback("secure_upload_decryptions_running", "Number of decryptions that are currently running", "gauge", lambda: scheduler.running)
+        REGISTRY.add_callback("secure_upload_decryptions_waiting", "Number of uploads waiting for a free decryption worker", "gauge", lambda: scheduler.waiting)
+        dedup_index = DedupIndex(args.dedup_index) if args.dedup_index else None
+        store = OutputStore(args.output_dir, args.output_name, args.fsync, dedup_index)
+        modules.append(GpgUploadHandler(args.gpg_symmetric, in_process=args.gpg_in_process, scheduler=scheduler, store=store, decoding_limits=decoding_limits))
     if not modules:
         raise Exception("No upload module was specified")
+    storage_quota = StorageQuota(args.quota_file, mib_to_bytes(args.max_upload_size), mib_to_bytes(args.client_quota), mib_to_bytes(args.total_quota))
+    if args.resumable_uploads:
+        # Finished uploads are passed on to the other modules
+        modules.append(ResumableUploadModule(args.resumable_uploads, list(modules), storage_quota=storage_quota))
     module_handler = ModuleHandler(modules)
 
-    def handler_class(*args, **kwargs):
-        return CustomRequestHandler(*args, authenticator, ip_address_blocker, module_handler, **kwargs)
-    # handler_class = functools.partial(CustomRequestHandler, authenticators=[HttpBasicAuthClientAuthenticator("test", "123")])
-
-    test(
-        HandlerClass=handler_class,
-        ServerClass=ThreadingHTTPServer,
-        port=args.http_port,
-        bind=args.bind,
-
-    )
-
+    def start_metrics(worker_index: int) -> None:
+        if args.metrics_port is not None:
+            # Each worker has its own metrics
+            start_metrics_server(args.metrics_port + worker_index)
+
+
+    reuse_port = args.workers > 1
+    if args.engine == "asyncio":
+        server = AsyncUploadServer(authenticator, ip_address_blocker, module_handler, idle_timeout=args.idle_timeout, tls_context=tls_context,
+            decoding_limits=decoding_limits, storage_quota=storage_quota, min_transfer_rate=args.min_transfer_rate,
+            read_grace_period=args.read_grace_period)
+
+        def serve(worker_index: int = 0) -> None:
+            start_metrics(worker_index)
+            try:
+                asyncio.run(server.serve_forever(args.bind, args.http_port, reuse_port))
+            except KeyboardInterrupt:
+                print("\nKeyboard interrupt received, exiting.")
+            finally:
+                storage_quota.persist()
+    else:
+        idle_timeout = args.idle_timeout
+        min_transfer_rate = args.min_transfer_rate
+        read_grace_period = args.read_grace_period
+
+        def handler_class(*args, **kwargs):
+            return CustomRequestHandler(*args, authenticator, ip_address_blocker, module_handler, idle_timeout=idle_timeout,
+                decoding_limits=decoding_limits, storage_quota=storage_quota, min_transfer_rate=min_transfer_rate,
+                read_grace_period=read_grace_period, **kwargs)
+        # handler_class = functools.partial(CustomRequestHandler, authenticators=[HttpBasicAuthClientAuthenticator("test", "123")])
+
+        def serve(worker_index: int = 0) -> None:
+            start_metrics(worker_index)
+            try:
+                serve_threading(handler_class, ip_address_blocker, args.bind, args.http_port, reuse_port, tls_context)
+            finally:
+                storage_quota.persist()
+
+    if args.workers > 1:
+        run_workers(args.workers, serve)
+    else:
+        signal.signal(signal.SIGTERM, exit_on_sigterm)
+        serve()
 
 if __name__ == "__main__":
     main()
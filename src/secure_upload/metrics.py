@@ -0,0 +1,325 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+from typing import Callable, Iterator, Optional
+# local
+from .log import get_logger
+
+logger = get_logger("Metrics")
+
+# Upper bounds (in seconds) of the histogram buckets. Uploads can take anything from milliseconds to minutes
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+# When this many threads have registered values, the values of the threads that exited are merged (see MetricsRegistry.get_thread_values)
+MAX_THREADS_BEFORE_MERGE = 256
+
+
+class MetricsRegistry:
+    """
+    Holds all metrics and renders them in the Prometheus text format.
+    Each thread updates its own copy of the values, so recording a value never waits for a lock (or for another thread).
+    The copies are only added up when the metrics are collected, which is why gauges only support inc and dec.
+    Since the values are read while other threads update them, a single collection may be off by the updates that happen during it.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: list["Metric"] = []
+        # Metrics whose value is computed when they are collected: (name, help, type, callback)
+        self.callbacks: list[tuple[str, str, str, Callable[[], float]]] = []
+        self.local = threading.local()
+        # Protects the following fields. It is only used once per thread and when collecting the metrics
+        self.lock = threading.Lock()
+        self.thread_values: list[tuple[threading.Thread, dict]] = []
+        # The values of threads that have exited
+        self.merged_values: dict = {}
+
+    def counter(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> "Counter":
+        return self.add(Counter(self, name, help, label_names))
+
+    def gauge(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> "Gauge":
+        return self.add(Gauge(self, name, help, label_names))
+
+    def histogram(self, name: str, help: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> "Histogram":
+        return self.add(Histogram(self, name, help, label_names, buckets))
+
+    def add(self, metric):
+        with self.lock:
+            if any(existing.name == metric.name for existing in self.metrics):
+                raise Exception(f"Metric '{metric.name}' is already registered")
+            self.metrics.append(metric)
+        return metric
+
+    def add_callback(self, name: str, help: str, metric_type: str, callback: Callable[[], float]) -> None:
+        """
+        Adds a metric (of type 'counter' or 'gauge') whose value is returned by `callback` when the metrics are collected.
+        Use it for values that are already counted elsewhere, like the IpAddressBlocker's counters in shared memory
+        """
+        with self.lock:
+            self.callbacks = [entry for entry in self.callbacks if entry[0] != name] + [(name, help, metric_type, callback)]
+
+    def get_thread_values(self) -> dict:
+        """
+        Returns the current thread's values. Only the current thread may modify them
+        """
+        try:
+            return self.local.values
+        except AttributeError:
+            pass
+        values: dict = {}
+        with self.lock:
+            if len(self.thread_values) >= MAX_THREADS_BEFORE_MERGE:
+                # The threading engine starts a thread for each connection, so do not keep all of their values around
+                self.merge_exited_threads()
+            self.thread_values.append((threading.current_thread(), values))
+        self.local.values = values
+        return values
+
+    def merge_exited_threads(self) -> None:
+        """
+        Needs to be called with the lock held
+        """
+        remaining = []
+        for thread, values in self.thread_values:
+            if thread.is_alive():
+                remaining.append((thread, values))
+            else:
+                # The thread can not change its values anymore
+                add_values(self.merged_values, values)
+        self.thread_values = remaining
+
+    def collect(self) -> dict:
+        """
+        Returns the sum of all threads' values
+        """
+        with self.lock:
+            self.merge_exited_threads()
+            total = dict(self.merged_values)
+            # The merged values must not be changed by add_values
+            for key, value in total.items():
+                if isinstance(value, list):
+                    total[key] = list(value)
+            for _, values in self.thread_values:
+                # Copying the dict is atomic, while iterating over it could fail if the thread adds a value at the same time
+                add_values(total, values.copy())
+        return total
+
+    def render(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format
+        """
+        values = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for child in metric.get_children():
+                child.render(values.get(child), lines)
+        for name, help, metric_type, callback in self.callbacks:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{name} {format_value(callback())}")
+        return "\n".join(lines) + "\n"
+
+
+def add_values(total: dict, values: dict) -> None:
+    for key, value in values.items():
+        if isinstance(value, list):
+            # Histogram: bucket counts and sum
+            existing = total.get(key)
+            if existing is None:
+                total[key] = list(value)
+            else:
+                for i, item in enumerate(value):
+                    existing[i] += item
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Metric:
+    """
+    A metric without labels records its values itself. A metric with labels records them in its children (see `labels`)
+    """
+    type = ""
+
+    def __init__(self, registry: MetricsRegistry, name: str, help: str, label_names: tuple[str, ...], parent: Optional["Metric"] = None,
+                    labels: Optional[dict[str, str]] = None) -> None:
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.parent = parent
+        self.label_values = labels or {}
+        self.children: dict[tuple[str, ...], Metric] = {}
+
+    def labels(self, **labels: object):
+        """
+        Returns the child for the given label values. Look it up once and keep it, if it is used on a hot path
+        """
+        if set(labels) != set(self.label_names):
+            raise Exception(f"Metric '{self.name}' needs the labels {self.label_names}")
+        key = tuple(str(labels[name]) for name in self.label_names)
+        child = self.children.get(key)
+        if child is None:
+            with self.registry.lock:
+                child = self.children.get(key)
+                if child is None:
+                    child = self.create_child(dict(zip(self.label_names, key)))
+                    # Replace the dict instead of modifying it, so that get_children can iterate over it without the lock
+                    self.children = {**self.children, key: child}
+        return child
+
+    def create_child(self, labels: dict[str, str]) -> "Metric":
+        return type(self)(self.registry, self.name, self.help, (), self, labels)
+
+    def get_children(self) -> list["Metric"]:
+        if self.label_names:
+            return list(self.children.values())
+        return [self]
+
+    def render(self, value, lines: list[str]) -> None:
+        lines.append(f"{self.name}{format_labels(self.label_values)} {format_value(value or 0)}")
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1) -> None:
+        values = self.registry.get_thread_values()
+        values[self] = values.get(self, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1) -> None:
+        values = self.registry.get_thread_values()
+        values[self] = values.get(self, 0) + amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, registry: MetricsRegistry, name: str, help: str, label_names: tuple[str, ...], buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+                    parent: Optional[Metric] = None, labels: Optional[dict[str, str]] = None) -> None:
+        super().__init__(registry, name, help, label_names, parent, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def create_child(self, labels: dict[str, str]) -> Metric:
+        return Histogram(self.registry, self.name, self.help, (), self.buckets, self, labels)
+
+    def observe(self, value: float) -> None:
+        values = self.registry.get_thread_values()
+        counts = values.get(self)
+        if counts is None:
+            # One count per bucket, one for values above the last bucket and the sum of all values
+            counts = values[self] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """
+        Observes how long the with block took
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self, value, lines: list[str]) -> None:
+        counts = value or [0] * (len(self.buckets) + 2)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{format_labels({**self.label_values, 'le': format_value(bound)})} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(self.label_values)} {format_value(counts[-1])}")
+        lines.append(f"{self.name}_count{format_labels(self.label_values)} {cumulative}")
+
+
+# The metrics of this process. Each worker process (see --workers) has its own
+REGISTRY = MetricsRegistry()
+
+REQUESTS_IN_FLIGHT = REGISTRY.gauge("secure_upload_requests_in_flight", "Number of requests that are currently being handled")
+REQUEST_DURATION = REGISTRY.histogram("secure_upload_request_duration_seconds", "Time from receiving the request headers until the response was sent")
+RESPONSES = REGISTRY.counter("secure_upload_responses_total", "Number of responses by status code", ("code",))
+STAGE_DURATION = REGISTRY.histogram("secure_upload_stage_duration_seconds",
+    "Time spent in each stage of a request: auth (checking the credentials), receive (reading the body and passing it to the decryption), "
+    "queue (waiting for a decryption worker), decrypt (from starting the decryption until the plaintext is complete), "
+    "store (moving the plaintext to its final location) and module (the upload module's handling after the body was received)", ("stage",))
+AUTH_DURATION = STAGE_DURATION.labels(stage="auth")
+RECEIVE_DURATION = STAGE_DURATION.labels(stage="receive")
+QUEUE_DURATION = STAGE_DURATION.labels(stage="queue")
+DECRYPT_DURATION = STAGE_DURATION.labels(stage="decrypt")
+STORE_DURATION = STAGE_DURATION.labels(stage="store")
+MODULE_DURATION = STAGE_DURATION.labels(stage="module")
+RECEIVED_BYTES = REGISTRY.counter("secure_upload_received_bytes_total", "Request body bytes received")
+STORED_BYTES = REGISTRY.counter("secure_upload_stored_bytes_total", "Plaintext bytes of successfully decrypted uploads")
+DEDUPLICATED_BYTES = REGISTRY.counter("secure_upload_deduplicated_bytes_total", "Plaintext bytes of uploads that were stored as a link to an identical file")
+DECRYPTIONS = REGISTRY.counter("secure_upload_decryptions_total", "Number of completed decryptions by result", ("result",))
+DECRYPTION_SUCCESSES = DECRYPTIONS.labels(result="success")
+DECRYPTION_FAILURES = DECRYPTIONS.labels(result="failure")
+FAILED_AUTHENTICATIONS = REGISTRY.counter("secure_upload_failed_authentications_total", "Number of requests that failed authentication")
+REJECTED_UPLOADS = REGISTRY.counter("secure_upload_rejected_uploads_total", "Number of uploads that were rejected because they were too large or exceeded a storage quota",
+    ("reason",))
+SLOW_CLIENTS = REGISTRY.counter("secure_upload_slow_clients_total", "Number of requests that were aborted because the client sent them too slowly")
+IP_BLOCKS = REGISTRY.counter("secure_upload_ip_blocks_total", "Number of times an IP address was temporarily blocked by this process")
+
+
+class MetricsHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], registry: MetricsRegistry) -> None:
+        super().__init__(address, MetricsRequestHandler)
+        self.registry = registry
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    server: MetricsHTTPServer
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # Scrapes happen every few seconds, so they should not clutter the log
+        pass
+
+
+def start_metrics_server(port: int, registry: MetricsRegistry = REGISTRY, bind: str = "127.0.0.1") -> MetricsHTTPServer:
+    """
+    Serves the metrics on 'http://BIND:PORT/metrics' in a background thread.
+    It is only reachable locally by default, since it is neither authenticated nor protected by the IP blocking
+    """
+    server = MetricsHTTPServer((bind, port), registry)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info("Serving metrics on http://%s:%d/metrics", bind, port)
+    return server
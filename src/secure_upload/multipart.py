@@ -0,0 +1,184 @@
+from email.message import Message
+from email.parser import BytesHeaderParser
+from email.utils import collapse_rfc2231_value
+from enum import Enum, auto
+from typing import NamedTuple, Optional, Union
+# local
+from .errors import RequestBodyError
+
+
+class MultipartError(RequestBodyError):
+    """
+    Raised when a multipart/form-data body is malformed or exceeds one of the parser's limits ('400 Bad Request')
+    """
+
+
+class MultipartPart(NamedTuple):
+    # The value of the 'name' parameter of the part's Content-Disposition header
+    name: bytes
+    # The value of the 'filename' parameter, if the part is a file upload
+    filename: Optional[str]
+    headers: Message
+
+
+class PartBegin(NamedTuple):
+    part: MultipartPart
+
+
+class PartData(NamedTuple):
+    data: bytes
+
+
+class PartEnd(NamedTuple):
+    pass
+
+
+MultipartEvent = Union[PartBegin, PartData, PartEnd]
+
+
+class _State(Enum):
+    PREAMBLE = auto()
+    AFTER_BOUNDARY = auto()
+    HEADERS = auto()
+    BODY = auto()
+    DONE = auto()
+
+
+class MultipartParser:
+    """
+    An incremental multipart/form-data parser.
+    It does no I/O by itself: the caller feeds it chunks of the request body (of any size) and gets back a list of events.
+    Only a small tail (shorter than the boundary) is buffered between calls, so the memory usage does not depend on the size of the parts.
+    """
+
+    def __init__(self, boundary: bytes, max_header_size: int = 16 * 1024) -> None:
+        if not boundary:
+            raise MultipartError("Missing multipart boundary")
+        # Every boundary (except for the first one) is preceded by a line break
+        self.delimiter = b"\r\n--" + boundary
+        self.max_header_size = max_header_size
+        # We prepend a line break, so that the first boundary can be handled just like the other ones
+        self.buffer = bytearray(b"\r\n")
+        self.state = _State.PREAMBLE
+
+    @property
+    def done(self) -> bool:
+        return self.state == _State.DONE
+
+    def feed(self, data: bytes) -> list[MultipartEvent]:
+        if self.state == _State.DONE:
+            # Ignore the epilogue
+            return []
+
+        self.buffer += data
+        events: list[MultipartEvent] = []
+        while self._process_buffer(events):
+            pass
+        return events
+
+    def close(self) -> None:
+        """
+        Needs to be called after the whole body was fed to the parser. Raises an exception if the body was incomplete
+        """
+        if self.state != _State.DONE:
+            raise MultipartError("Multipart body ended before the closing boundary")
+
+    def _process_buffer(self, events: list[MultipartEvent]) -> bool:
+        """
+        Tries to advance the parser's state. Returns True if progress was made and it should be called again
+        """
+        if self.state == _State.PREAMBLE:
+            index = self.buffer.find(self.delimiter)
+            if index == -1:
+                # Discard the preamble, but keep enough bytes to detect a boundary that is split across chunks
+                keep = len(self.delimiter) - 1
+                if len(self.buffer) > keep:
+                    del self.buffer[:-keep]
+                return False
+            del self.buffer[:index + len(self.delimiter)]
+            self.state = _State.AFTER_BOUNDARY
+            return True
+
+        elif self.state == _State.AFTER_BOUNDARY:
+            if len(self.buffer) < 2:
+                return False
+            if self.buffer.startswith(b"--"):
+                # This was the closing boundary
+                self.buffer.clear()
+                self.state = _State.DONE
+                return False
+            index = self.buffer.find(b"\r\n")
+            if index == -1:
+                if len(self.buffer) > self.max_header_size:
+                    raise MultipartError("Boundary line is too long")
+                return False
+            # Ignore any transport padding (whitespace) after the boundary
+            if self.buffer[:index].strip(b" \t"):
+                raise MultipartError("Unexpected data after the boundary")
+            del self.buffer[:index + 2]
+            self.state = _State.HEADERS
+            return True
+
+        elif self.state == _State.HEADERS:
+            if self.buffer.startswith(b"\r\n"):
+                # The part has no headers at all
+                header_end = 0
+            else:
+                header_end = self.buffer.find(b"\r\n\r\n")
+                if header_end == -1:
+                    if len(self.buffer) > self.max_header_size:
+                        raise MultipartError("Part headers are too large")
+                    return False
+                # Keep the line break of the last header line
+                header_end += 2
+            if header_end > self.max_header_size:
+                raise MultipartError("Part headers are too large")
+
+            part = parse_part_headers(bytes(self.buffer[:header_end]))
+            del self.buffer[:header_end + 2]
+            events.append(PartBegin(part))
+            self.state = _State.BODY
+            return True
+
+        elif self.state == _State.BODY:
+            index = self.buffer.find(self.delimiter)
+            if index == -1:
+                # Everything except a possible partial delimiter at the end can be passed on
+                safe_length = len(self.buffer) - (len(self.delimiter) - 1)
+                if safe_length > 0:
+                    events.append(PartData(bytes(self.buffer[:safe_length])))
+                    del self.buffer[:safe_length]
+                return False
+            if index > 0:
+                events.append(PartData(bytes(self.buffer[:index])))
+            events.append(PartEnd())
+            del self.buffer[:index + len(self.delimiter)]
+            self.state = _State.AFTER_BOUNDARY
+            return True
+
+        else:
+            return False
+
+
+def parse_part_headers(raw_headers: bytes) -> MultipartPart:
+    headers = BytesHeaderParser().parsebytes(raw_headers)
+    if headers.defects:
+        raise MultipartError(f"Malformed part headers: {headers.defects}")
+
+    name = headers.get_param("name", header="content-disposition")
+    if name is None:
+        raise MultipartError("Part is missing the 'name' parameter in its Content-Disposition header")
+    filename = headers.get_filename()
+    if filename is not None:
+        filename = _restore_bytes(filename).decode("utf-8", errors="replace")
+    return MultipartPart(_restore_bytes(name), filename, headers)
+
+
+def _restore_bytes(value: Union[str, tuple]) -> bytes:
+    """
+    The email module decodes non-ASCII header bytes as surrogates, this function restores the original bytes
+    """
+    if isinstance(value, tuple):
+        # RFC 2231 encoded parameter: (charset, language, value)
+        return collapse_rfc2231_value(value).encode("utf-8")
+    return value.encode("utf-8", errors="surrogateescape")
@@ -0,0 +1,63 @@
+import os
+import signal
+from typing import Callable
+# local
+from .log import HANDLER, get_logger
+
+logger = get_logger("Prefork")
+
+
+def exit_on_sigterm(signum, frame) -> None:
+    """
+    Signal handler that unwinds the stack, so that the server can clean up (like writing the quota file)
+    """
+    raise SystemExit(0)
+
+
+def run_workers(worker_count: int, serve: Callable[[int], None]) -> None:
+    """
+    Forks `worker_count` processes that each call `serve` with their index (0 to worker_count - 1). It should bind its own socket with SO_REUSEPORT.
+    Everything created before calling this (like the IpAddressBlocker's shared memory) is shared with the workers.
+    The parent process only supervises the workers: if one of them dies or the parent is interrupted, all workers are stopped.
+    """
+    workers = []
+    for index in range(worker_count):
+        pid = os.fork()
+        if pid == 0:
+            # Worker process
+            signal.signal(signal.SIGTERM, exit_on_sigterm)
+            exit_code = 1
+            try:
+                serve(index)
+                exit_code = 0
+            except KeyboardInterrupt:
+                exit_code = 0
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 0
+            except BaseException:
+                logger.exception("Worker %d failed", index)
+            finally:
+                # os._exit skips the atexit handlers, so the queued log records need to be written now
+                HANDLER.stop()
+                os._exit(exit_code)
+        workers.append(pid)
+    logger.info("Started %d worker processes: %s", worker_count, workers)
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+
+    try:
+        pid, status = os.wait()
+        workers.remove(pid)
+        logger.error("Worker %d exited with status %d, stopping the other workers", pid, os.waitstatus_to_exitcode(status))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
@@ -0,0 +1,343 @@
+import fcntl
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import time
+from http import HTTPStatus
+from typing import Optional
+# local
+from .http_response import RequestBodyError
+from .log import get_logger
+from .metrics import REJECTED_UPLOADS
+
+logger = get_logger("Quota")
+
+# How often (in seconds) the usage is written to the quota file
+DEFAULT_PERSIST_INTERVAL = 10
+# Used for requests whose authenticator does not name the client
+UNKNOWN_CLIENT = "(unknown)"
+# How many clients the shared usage table can hold (see SharedUsageTable)
+DEFAULT_MAX_CLIENTS = 65536
+
+
+class QuotaExceededError(RequestBodyError):
+    """
+    Raised when a request is larger than allowed ('413 Content Too Large') or would exceed a storage quota ('507 Insufficient Storage')
+    """
+
+
+class SharedUsageTable:
+    """
+    The usage that is not in the quota file yet (the reservations of running uploads and finished uploads that were not written yet) of all processes.
+    Like SharedBlockTable it lives in an anonymous shared memory mapping, so all worker processes forked after it was created count against the same values.
+    Clients are stored by a keyed hash of their name in a set associative table of `WAYS` entries per bucket, and entries whose value drops to 0 are free.
+    If a client's bucket is full, its usage is added to an overflow counter instead, which counts towards every client:
+    this way a quota can be reached early, but never exceeded. The counter does not know whose usage it holds,
+    so callers keep track of their share of it and pass that to `add` when they take the usage away again.
+    All accesses need to hold `lock`, which works across threads and processes.
+    """
+    WAYS = 8
+    # Sum of all values (including the overflow counter), overflow counter, number of times that the quota file was written
+    HEADER = struct.Struct("<qqQ")
+    # Client key, value
+    ENTRY = struct.Struct("<16sq")
+
+    def __init__(self, capacity: int) -> None:
+        self.bucket_count = max(1, -(-capacity // self.WAYS))
+        self.capacity = self.bucket_count * self.WAYS
+        # Anonymous mappings are shared with child processes
+        self.memory = mmap.mmap(-1, self.HEADER.size + self.capacity * self.ENTRY.size)
+        self.lock = multiprocessing.Lock()
+        self.hash_key = os.urandom(16)
+
+    @property
+    def total(self) -> int:
+        return self.HEADER.unpack_from(self.memory, 0)[0]
+
+    @property
+    def generation(self) -> int:
+        return self.HEADER.unpack_from(self.memory, 0)[2]
+
+    def increase_generation(self) -> None:
+        total, overflow, generation = self.HEADER.unpack_from(self.memory, 0)
+        self.HEADER.pack_into(self.memory, 0, total, overflow, generation + 1)
+
+    def get(self, client: str) -> int:
+        key = self._key(client)
+        index = self._find(key, allocate=False)
+        value = self.ENTRY.unpack_from(self.memory, self._offset(index))[1] if index is not None else 0
+        return value + self.HEADER.unpack_from(self.memory, 0)[1]
+
+    def add(self, client: str, size: int, overflowed: int = 0) -> int:
+        """
+        Adds `size` (which may be negative) to the client's value and returns the part of it that was added to the overflow counter.
+        `overflowed` is the caller's share of the overflow counter for this client (the sum of what `add` returned before):
+        changes that cancel it out are applied to the overflow counter first, so that usage is taken away from where it was added
+        """
+        key = self._key(client)
+        total, overflow, generation = self.HEADER.unpack_from(self.memory, 0)
+        moved = 0
+        if overflowed * size < 0:
+            moved = max(size, -overflowed) if size < 0 else min(size, -overflowed)
+        if size != moved:
+            index = self._find(key, allocate=True)
+            if index is None:
+                moved = size
+            else:
+                value = self.ENTRY.unpack_from(self.memory, self._offset(index))[1]
+                self.ENTRY.pack_into(self.memory, self._offset(index), key, value + size - moved)
+        self.HEADER.pack_into(self.memory, 0, total + size, overflow + moved, generation)
+        return moved
+
+    def _key(self, client: str) -> bytes:
+        return hashlib.blake2b(client.encode("utf-8", errors="replace"), digest_size=16, key=self.hash_key).digest()
+
+    def _find(self, key: bytes, allocate: bool) -> Optional[int]:
+        """
+        Returns the index of the client's entry. If it has none and `allocate` is set, a free entry of its bucket is returned (if there is one)
+        """
+        first = int.from_bytes(key[:8], "little") % self.bucket_count * self.WAYS
+        free = None
+        for index in range(first, first + self.WAYS):
+            entry_key, value = self.ENTRY.unpack_from(self.memory, self._offset(index))
+            if entry_key == key:
+                return index
+            if value == 0 and free is None:
+                free = index
+        return free if allocate else None
+
+    def _offset(self, index: int) -> int:
+        return self.HEADER.size + index * self.ENTRY.size
+
+
+class StorageQuota:
+    """
+    Limits the size of each upload and how many bytes each client (identified by the credentials it authenticated with) and all clients together may upload.
+    Uploads count with the size of their (decoded) request body, which is close to the size of the stored file.
+    Requests reserve their Content-Length before the body is read, so that concurrent uploads can not exceed a quota together,
+    and chunked bodies are checked while they are received.
+
+    The usage is kept in memory and written to `path` (if given) every `persist_interval` seconds.
+    Worker processes that are forked after the quota was created count against the same values: the reservations and the usage that was not written yet
+    are kept in shared memory (see SharedUsageTable). Each process writes the usage of its own finished uploads by adding it to the file's values,
+    after which all processes reload the file. Delete the file (or edit the values) to reset the usage
+    """
+
+    def __init__(self, path: Optional[str] = None, max_upload_size: Optional[int] = None, client_quota: Optional[int] = None,
+                    total_quota: Optional[int] = None, persist_interval: float = DEFAULT_PERSIST_INTERVAL, max_clients: int = DEFAULT_MAX_CLIENTS) -> None:
+        self.path = path
+        self.max_upload_size = max_upload_size
+        self.client_quota = client_quota
+        self.total_quota = total_quota
+        self.persist_interval = persist_interval
+        # The reservations of running uploads and the usage of finished uploads that was not written to the file yet, of all processes
+        self.table = SharedUsageTable(max_clients)
+        self.lock = self.table.lock
+        # The usage that was read from the file (at the table's `generation`) and the usage of this process's finished uploads since then
+        self.persisted: dict[str, int] = {}
+        self.persisted_total = 0
+        self.generation = 0
+        self.unpersisted: dict[str, int] = {}
+        # This process's share of the table's overflow counter, by client (see SharedUsageTable.add)
+        self.overflowed: dict[str, int] = {}
+        # Every process writes its own usage (see `persist`), with a thread that is started on first use
+        self.persist_thread_pid: Optional[int] = None
+        if path:
+            self.persisted = self.load(path)
+            self.persisted_total = sum(self.persisted.values())
+            logger.info("Loaded the usage of %d client(s) from %s", len(self.persisted), path)
+
+    def reserve(self, client: Optional[str], size: int) -> "QuotaReservation":
+        """
+        Reserves `size` bytes (the announced size of the request body) for an upload by `client`.
+        Raises a QuotaExceededError if that is not possible
+        """
+        self.start_persist_thread()
+        reservation = QuotaReservation(self, client or UNKNOWN_CLIENT)
+        if size:
+            self.extend(reservation, size)
+        return reservation
+
+    def extend(self, reservation: "QuotaReservation", size: int) -> None:
+        """
+        Adds `size` bytes to the reservation or raises a QuotaExceededError
+        """
+        client = reservation.client
+        if self.max_upload_size is not None and reservation.reserved + size > self.max_upload_size:
+            REJECTED_UPLOADS.labels(reason="too_large").inc()
+            raise QuotaExceededError(f"Uploads may not be larger than {self.max_upload_size} bytes", HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        with self.lock:
+            self.reload_if_changed()
+            if self.client_quota is not None and self.get_usage(client) + size > self.client_quota:
+                REJECTED_UPLOADS.labels(reason="client_quota").inc()
+                raise QuotaExceededError(f"This upload would exceed your storage quota of {self.client_quota} bytes", HTTPStatus.INSUFFICIENT_STORAGE)
+            if self.total_quota is not None and self.get_total() + size > self.total_quota:
+                REJECTED_UPLOADS.labels(reason="total_quota").inc()
+                raise QuotaExceededError("The server does not have enough storage left for this upload", HTTPStatus.INSUFFICIENT_STORAGE)
+            reservation.overflowed += self.table.add(client, size)
+        reservation.reserved += size
+
+    def finish(self, reservation: "QuotaReservation", successful: bool) -> None:
+        """
+        Frees the reservation. If the upload was successful, its size is added to the client's usage
+        """
+        with self.lock:
+            self.table.add(reservation.client, -reservation.reserved, reservation.overflowed)
+            if successful and reservation.received:
+                self.add_unpersisted(reservation.client, reservation.received)
+        reservation.reserved = 0
+        reservation.overflowed = 0
+
+    def release(self, client: str, size: int) -> None:
+        """
+        Removes `size` bytes from the usage of `client`, for uploads that were counted in advance but not stored after all
+        """
+        with self.lock:
+            self.add_unpersisted(client, -size)
+
+    def add_unpersisted(self, client: str, size: int) -> None:
+        """
+        Changes the usage of `client` that this process did not write to the quota file yet. Must be called with the lock held
+        """
+        add_usage(self.overflowed, client, self.table.add(client, size, self.overflowed.get(client, 0)))
+        add_usage(self.unpersisted, client, size)
+
+    def get_usage(self, client: str) -> int:
+        """
+        Returns the bytes used and reserved by `client` in all processes. Must be called with the lock held
+        """
+        return self.persisted.get(client, 0) + self.table.get(client)
+
+    def get_total(self) -> int:
+        """
+        Returns the bytes used and reserved by all clients. Must be called with the lock held
+        """
+        return self.persisted_total + self.table.total
+
+    def reload_if_changed(self) -> None:
+        """
+        Reloads the quota file if another process wrote to it since it was read. Must be called with the lock held
+        """
+        if not self.path or self.generation == self.table.generation:
+            return
+        try:
+            self.persisted = self.load(self.path)
+        except Exception as e:
+            logger.error("Could not read the quota file %s: %s", self.path, e)
+            return
+        self.persisted_total = sum(self.persisted.values())
+        self.generation = self.table.generation
+
+    def start_persist_thread(self) -> None:
+        if not self.path or self.persist_thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.persist_thread_pid == os.getpid():
+                return
+            # Threads do not survive a fork, so each worker process starts its own
+            self.persist_thread_pid = os.getpid()
+        threading.Thread(target=self.persist_periodically, name="quota-persist", daemon=True).start()
+
+    def persist_periodically(self) -> None:
+        while True:
+            time.sleep(self.persist_interval)
+            try:
+                self.persist()
+            except Exception as e:
+                logger.error("Could not write the quota file %s: %s", self.path, e)
+
+    def persist(self) -> None:
+        """
+        Adds the usage since the last call to the quota file and reloads the usage of all clients from it
+        """
+        if not self.path:
+            return
+        with self.lock:
+            unpersisted = dict(self.unpersisted)
+        # The lock file serializes the processes, since the quota file itself is replaced on every write
+        with open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            usage = self.load(self.path)
+            for client, size in unpersisted.items():
+                # Released usage can not make a value negative, for example if the file was reset in the meantime
+                add_usage(usage, client, max(size, -usage.get(client, 0)))
+            if unpersisted:
+                self.write(self.path, usage)
+            with self.lock:
+                # The written usage moves from the shared table to the file. Uploads that finished in the meantime stay unpersisted
+                for client, size in unpersisted.items():
+                    self.add_unpersisted(client, -size)
+                if unpersisted:
+                    # Makes the other processes reload the file
+                    self.table.increase_generation()
+                self.generation = self.table.generation
+                self.persisted = usage
+                self.persisted_total = sum(usage.values())
+
+    def load(self, path: str) -> dict[str, int]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                usage = json.load(f)
+        except FileNotFoundError:
+            return {}
+        if not isinstance(usage, dict) or not all(isinstance(size, int) for size in usage.values()):
+            raise Exception(f"Invalid quota file {path}: expected an object that maps the clients to the number of bytes they uploaded")
+        return usage
+
+    def write(self, path: str, usage: dict[str, int]) -> None:
+        # Replace the file atomically, so that a crash can not leave a partially written file behind
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".quota-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(usage, f, indent=1, sort_keys=True)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+class QuotaReservation:
+    """
+    The storage reserved for a single upload. Call `add` for every received piece of the body and `finish` once the request was handled
+    """
+
+    def __init__(self, quota: StorageQuota, client: str) -> None:
+        self.quota = quota
+        self.client = client
+        self.reserved = 0
+        self.received = 0
+        # The part of `reserved` that was added to the overflow counter of the quota's table
+        self.overflowed = 0
+
+    def add(self, size: int) -> None:
+        self.received += size
+        if self.received > self.reserved:
+            self.quota.extend(self, self.received - self.reserved)
+
+    def finish(self, successful: bool) -> None:
+        self.quota.finish(self, successful)
+
+
+class UncountedReservation(QuotaReservation):
+    """
+    Used for request bodies that are neither limited nor counted, since a module accounts for them (see UploadModule.counts_towards_quota)
+    """
+
+    def add(self, size: int) -> None:
+        self.received += size
+
+    def finish(self, successful: bool) -> None:
+        pass
+
+
+def add_usage(usage: dict[str, int], client: str, size: int) -> None:
+    value = usage.get(client, 0) + size
+    if value:
+        usage[client] = value
+    else:
+        usage.pop(client, None)
@@ -1,25 +1,192 @@
-from asyncio.log import logger
+import contextlib
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler
-import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import socket
+import ssl
+import sys
+import time
+from typing import Callable, Iterator, Optional, cast
 
 # local
 from secure_upload.upload.handler import ModuleHandler
+from secure_upload.upload.scheduler import SchedulerBusyError
 from .client_auth import BaseClientAuthenticator, MultiClientAuthenticator
 from .ip_blocking import IpAddressBlocker
-from .http_response import parse_request
+from .http_response import (DEFAULT_CHUNK_SIZE, DEFAULT_MIN_TRANSFER_RATE, DEFAULT_READ_GRACE_PERIOD, BodyDecoder, DecodingLimits, ReadDeadline,
+    RequestBodyError, close_request_data, create_body_decoder, get_announced_length, get_content_length, is_raw_upload, parse_request,
+    read_request_body, send_http_response)
+from .log import Capped, get_logger
+from .metrics import (AUTH_DURATION, FAILED_AUTHENTICATIONS, RECEIVE_DURATION, RECEIVED_BYTES, REQUEST_DURATION, REQUESTS_IN_FLIGHT, RESPONSES,
+    SLOW_CLIENTS)
+from .quota import UNKNOWN_CLIENT, QuotaReservation, StorageQuota, UncountedReservation
 
-logger = logging.getLogger("Server")
-logger.setLevel(logging.DEBUG)
-c_handler = logging.StreamHandler()
-c_format = logging.Formatter('[%(levelname)s] %(name)s: %(message)s')
-c_handler.setFormatter(c_format)
-logger.addHandler(c_handler)
+logger = get_logger("Server")
+
+
+class UploadHTTPServer(ThreadingHTTPServer):
+    """
+    A ThreadingHTTPServer that can share its port with the other worker processes (see --workers)
+    and that drops connections from blocked IP addresses as soon as they are accepted
+    """
+
+    def __init__(self, server_address: tuple[str, int], handler_class, ip_address_blocker: IpAddressBlocker, reuse_port: bool = False,
+                    tls_context: Optional[ssl.SSLContext] = None) -> None:
+        self.ip_address_blocker = ip_address_blocker
+        self.reuse_port = reuse_port
+        super().__init__(server_address, handler_class)
+        if tls_context:
+            # The handshake is done by the connection's thread when it first reads from the socket.
+            # So it neither blocks the accept loop nor is it done for blocked IP addresses
+            self.socket = tls_context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+
+    def handle_error(self, request, client_address: tuple[str, int]) -> None:
+        error = sys.exc_info()[1]
+        # Before Python 3.10, socket.timeout is not a subclass of TimeoutError
+        if isinstance(error, (ssl.SSLError, ConnectionError, TimeoutError, socket.timeout)):
+            # Failed handshakes and clients that go away are common, so we do not need a stack trace
+            logger.debug("Connection with %s failed: %s", client_address[0], error)
+        else:
+            super().handle_error(request, client_address)
+
+    def verify_request(self, request, client_address: tuple[str, int]) -> bool:
+        """
+        Called in the accept loop, before a thread and a request handler are created for the connection.
+        If this returns False, the socket is closed right away, which resets the connection:
+        $ curl 'http://localhost:8000/' -u "test:12"
+        curl: (56) Recv failure: Connection reset by peer
+        """
+        # @TODO: Should I try to add load-balancer support? Then I would need to parse the X-Forwarded-For header (in do_*)
+        #        And also make sure, that clients can not spoof the header (by checking that the request came from the LB's IP address)
+        return not self.ip_address_blocker.should_drop_connection(client_address[0])
+
+    def server_bind(self) -> None:
+        if self.reuse_port:
+            # Let the kernel distribute the connections between all processes that listen on this port
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def serve_threading(handler_class, ip_address_blocker: IpAddressBlocker, bind: Optional[str], port: int, reuse_port: bool = False,
+                    tls_context: Optional[ssl.SSLContext] = None) -> None:
+    """
+    Runs the threading engine until it is interrupted. Does the same as http.server.test, but supports SO_REUSEPORT
+    """
+    # Use the address family of the bind address (IPv6 dual stack if possible when binding to all interfaces)
+    address_info = socket.getaddrinfo(bind, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
+    family, _, _, _, sockaddr = address_info[0]
+
+    class ServerClass(UploadHTTPServer):
+        address_family = family
+
+    with ServerClass(cast(tuple[str, int], sockaddr[:2]), handler_class, ip_address_blocker, reuse_port, tls_context) as httpd:
+        host, port = httpd.socket.getsockname()[:2]
+        url_host = f"[{host}]" if ":" in host else host
+        scheme = "https" if tls_context else "http"
+        print(f"Serving {scheme.upper()} on {host} port {port} ({scheme}://{url_host}:{port}/) ...")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("\nKeyboard interrupt received, exiting.")
+
+
+class DeadlineReader:
+    """
+    Wraps a connection's rfile, so that the reads of a request only wait as long as its ReadDeadline allows.
+    The socket timeout alone does not help against slow clients, since BufferedReader.read and readline receive until they have enough data:
+    a client that sends a byte every few seconds would never trigger it
+    """
+
+    def __init__(self, file, connection: socket.socket) -> None:
+        self.file = file
+        self.connection = connection
+        self.deadline: Optional[ReadDeadline] = None
+
+    def start(self, deadline: ReadDeadline) -> None:
+        """
+        Called at the start of every request
+        """
+        self.deadline = deadline
+
+    def receive(self, deadline: ReadDeadline, read: Callable[[int], bytes], size: int, consumes: bool = True) -> bytes:
+        """
+        Calls `read`, which may receive from the socket at most once
+        """
+        timeout = deadline.remaining()
+        if timeout <= 0:
+            SLOW_CLIENTS.inc()
+            raise socket.timeout("The client sent the request too slowly")
+        self.connection.settimeout(timeout)
+        start = time.monotonic()
+        try:
+            data = read(size)
+        except socket.timeout:
+            if timeout < deadline.timeout:
+                SLOW_CLIENTS.inc()
+            raise
+        finally:
+            # Sending the response uses the normal timeout
+            self.connection.settimeout(deadline.timeout)
+        deadline.record(len(data) if consumes else 0, time.monotonic() - start)
+        return data
+
+    def read1(self, size: int = -1) -> bytes:
+        if self.deadline is None:
+            return self.file.read1(size)
+        return self.receive(self.deadline, self.file.read1, size)
+
+    def read(self, size: int = -1) -> bytes:
+        if self.deadline is None:
+            return self.file.read(size)
+        chunks = []
+        remaining = size
+        while remaining != 0:
+            chunk = self.read1(DEFAULT_CHUNK_SIZE if remaining < 0 else remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b"".join(chunks)
+
+    def readline(self, size: int = -1) -> bytes:
+        deadline = self.deadline
+        if deadline is None:
+            return self.file.readline(size)
+        line = bytearray()
+        while size < 0 or len(line) < size:
+            # Returns the buffered data, which is only received if the buffer is empty
+            available = self.receive(deadline, self.file.peek, 1, consumes=False)
+            if not available:
+                break
+            limit = len(available) if size < 0 else min(len(available), size - len(line))
+            end = available.find(b"\n", 0, limit)
+            count = end + 1 if end >= 0 else limit
+            line += self.file.read(count)
+            deadline.record(count, 0)
+            if end >= 0:
+                break
+        return bytes(line)
+
+    def peek(self, size: int = 0) -> bytes:
+        # Only used while waiting for the next request, which is limited by the idle timeout
+        return self.file.peek(size)
+
+    def close(self) -> None:
+        self.file.close()
 
 
 class CustomRequestHandler(BaseHTTPRequestHandler):
     # Try to make fingerprinting a bit harder by not using the default Python error message
     error_message_format = ""
+    # Keep connections open for multiple requests. send_http_response always sends a Content-Length header
+    protocol_version = "HTTP/1.1"
+    # Responses are written with multiple writes (headers and body), which Nagle's algorithm would delay on a reused connection
+    disable_nagle_algorithm = True
+    # Maximum time (in seconds) that reading from the client may block, once a request has started
+    timeout = 60
+    # Set by setup
+    rfile: "DeadlineReader" # type: ignore
+    # Set by send_response for each request
+    status_code: Optional[int]
 
     ###### Start: Remove the value from the Server HTTP header
     # Remove the BaseHTTP/0.6 part
@@ -35,40 +202,89 @@ class CustomRequestHandler(BaseHTTPRequestHandler):
             return super().send_header(keyword, value)
     ###### End: Remove the value from the Server HTTP header
 
-    def __init__(self, request: bytes, client_address: tuple[str, int], server,
-        authenticator: BaseClientAuthenticator, ip_address_blocker: IpAddressBlocker, upload_module_handler: ModuleHandler) -> None:
+    def log_message(self, format: str, *args) -> None:
+        # BaseHTTPRequestHandler would write to stderr directly (in the request's thread)
+        logger.info("%s " + format, self.client_ip, *args)
+
+    def send_response(self, code: int, message: Optional[str] = None) -> None:
+        self.status_code = code
+        RESPONSES.labels(code=int(code)).inc()
+        super().send_response(code, message)
+
+    def __init__(self, request: socket.socket, client_address: tuple[str, int], server,
+        authenticator: BaseClientAuthenticator, ip_address_blocker: IpAddressBlocker, upload_module_handler: ModuleHandler, idle_timeout: float = 15,
+        decoding_limits: DecodingLimits = DecodingLimits(), storage_quota: Optional[StorageQuota] = None,
+        min_transfer_rate: float = DEFAULT_MIN_TRANSFER_RATE, read_grace_period: float = DEFAULT_READ_GRACE_PERIOD) -> None:
         # For some reason it needs to be called before the superclass constructor.
         # I think the constructor calls the do_GET (and similar methods), which then access the not yet defined fields
         self.authenticator = authenticator
         self.ip_address_blocker = ip_address_blocker
         self.upload_module_handler = upload_module_handler
-
-        # Check the client IP address.
-        # @TODO: Should I try to add load-balancer support? Then I would need to parse the X-Forwarded-For header (in do_*)
-        #        And also make sure, that clients can not spoof the header (by checking that the request came from the LB's IP address)
+        # Idle connections are closed after this many seconds without a new request
+        self.idle_timeout = idle_timeout
+        # Limits for request bodies with Content-Encoding
+        self.decoding_limits = decoding_limits
+        self.storage_quota = storage_quota or StorageQuota()
+        # Requests are aborted, if the client sends them slower than this (see ReadDeadline)
+        self.min_transfer_rate = min_transfer_rate
+        self.read_grace_period = read_grace_period
+        # Set by the authenticator and by send_response for each request
+        self.client_name: Optional[str] = None
+        self.status_code = None
+        # Connections from blocked IP addresses are already dropped by UploadHTTPServer.verify_request
         self.client_ip = client_address[0]
 
-        # Update blocks (which may drop temporary blocks), before cheking if the address is blocked
-        ip_address_blocker.update_blocks()
-        if ip_address_blocker.is_blocked(self.client_ip):
-            # @TODO: What should I do? skip calling the supercalss constructor to prevent processing the request?
-            # Or do i need to close the connection / send a response?
+        super().__init__(request, client_address, server)
 
-            # This seems to just reset the connection:
-            # $ curl 'http://localhost:8000/' -u "test:12"
-            # curl: (56) Recv failure: Connection reset by peer
-            logger.debug(f"Dropping request from blocked IP address {self.client_ip}")
+    def setup(self) -> None:
+        super().setup()
+        self.rfile = DeadlineReader(self.rfile, self.connection)
+
+    def handle_one_request(self) -> None:
+        # Wait for the next request with the idle timeout and then read it with the normal timeout
+        self.connection.settimeout(self.idle_timeout)
+        try:
+            if not self.rfile.peek(1):
+                # The client closed the connection
+                self.close_connection = True
+                return
+        except (TimeoutError, socket.timeout, ConnectionError):
+            self.close_connection = True
             return
+        self.connection.settimeout(self.timeout)
+        # The request line and headers count towards the deadline as well
+        self.rfile.start(ReadDeadline(self.min_transfer_rate, self.read_grace_period, self.timeout))
+        self.client_name = None
+        self.status_code = None
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            super().handle_one_request()
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            REQUEST_DURATION.observe(time.perf_counter() - start)
 
-        super().__init__(request, client_address, server)
+    @property
+    def peer_certificate(self) -> Optional[dict]:
+        """
+        The client's TLS certificate, if it sent one that could be verified
+        """
+        if isinstance(self.connection, ssl.SSLSocket):
+            return self.connection.getpeercert()
+        return None
 
-    def check_authentication(self) -> bool:
-        self.ip_address_blocker.update_blocks()
+    def handle_expect_100(self) -> bool:
+        # '100 Continue' is only sent once the client was authenticated (see send_continue)
+        return True
 
-        if self.authenticator.check_authentication(self):
+    def check_authentication(self) -> bool:
+        with AUTH_DURATION.time():
+            authenticated = self.authenticator.check_authentication(self)
+        if authenticated:
             return True
         else:
             # Log the failed authentication attempts
+            FAILED_AUTHENTICATIONS.inc()
             self.ip_address_blocker.increase_failed_auth_count(self.client_ip)
             return False
 
@@ -76,8 +292,118 @@ class CustomRequestHandler(BaseHTTPRequestHandler):
         if self.check_authentication():
             self.upload_module_handler.handle_GET(self)
 
+    def do_HEAD(self) -> None:
+        if self.check_authentication():
+            self.upload_module_handler.handle_HEAD(self)
+
+    def do_DELETE(self) -> None:
+        if self.check_authentication():
+            self.upload_module_handler.handle_DELETE(self)
+
     def do_POST(self) -> None:
         if self.check_authentication():
-            post_data = parse_request(self.headers, self.rfile)
-            logger.debug(f"POST data: {post_data}")
-            self.upload_module_handler.handle_POST(self, post_data)
+            if is_raw_upload(self.command, self.headers):
+                self.handle_raw_upload()
+                return
+            try:
+                with self.reserve_storage() as reservation:
+                    self.send_continue()
+                    with RECEIVE_DURATION.time():
+                        post_data = parse_request(self.headers, self.rfile,
+                            open_field=lambda part: self.upload_module_handler.open_field(self, part), decoding_limits=self.decoding_limits,
+                            on_data=reservation.add)
+                    # Forms always have a Content-Length
+                    RECEIVED_BYTES.inc(get_content_length(self.headers))
+                    try:
+                        logger.debug("POST data: %s", Capped(post_data))
+                        self.upload_module_handler.handle_POST(self, post_data)
+                    finally:
+                        # Remove the temporary files of uploaded files
+                        close_request_data(post_data)
+            except SchedulerBusyError as e:
+                # Reject the request without reading the rest of the body
+                self.send_busy_response(e)
+            except RequestBodyError as e:
+                self.send_bad_request(e)
+
+    def do_PUT(self) -> None:
+        if self.check_authentication():
+            self.handle_raw_upload()
+
+    def do_PATCH(self) -> None:
+        if self.check_authentication():
+            self.handle_raw_upload()
+
+    def handle_raw_upload(self) -> None:
+        """
+        Streams the request body directly into the sink of the module that accepts the upload
+        """
+        try:
+            # Fail before the module does any work, if the Content-Encoding is not supported or the upload is too large
+            decoder = create_body_decoder(self.headers, self.decoding_limits)
+            with self.reserve_storage() as reservation:
+                self.receive_raw_upload(decoder, reservation)
+        except SchedulerBusyError as e:
+            self.send_busy_response(e)
+        except RequestBodyError as e:
+            self.send_bad_request(e)
+
+    def receive_raw_upload(self, decoder: BodyDecoder, reservation: QuotaReservation) -> None:
+        upload = self.upload_module_handler.open_raw_upload(self)
+        if upload is None:
+            # We did not read the body, so the connection can not be reused
+            send_http_response(self, HTTPStatus.NOT_FOUND, headers={"Connection": "close"}, content="Invalid request or the required module is not enabled")
+            return
+
+        module, sink = upload
+        try:
+            self.send_continue()
+            with RECEIVE_DURATION.time():
+                for chunk in read_request_body(self.headers, self.rfile):
+                    RECEIVED_BYTES.inc(len(chunk))
+                    for data in decoder.decode(chunk):
+                        reservation.add(len(data))
+                        sink.write(data)
+                for data in decoder.finish():
+                    reservation.add(len(data))
+                    sink.write(data)
+            sink.finish()
+            self.upload_module_handler.handle_raw_upload(self, module, sink)
+        finally:
+            sink.close()
+
+    @contextlib.contextmanager
+    def reserve_storage(self) -> Iterator[QuotaReservation]:
+        """
+        Fails with '413 Content Too Large' or '507 Insufficient Storage' before the body is read, if the announced size exceeds a limit.
+        Only successful uploads count towards the client's quota. Bodies that a module accounts for itself are not checked (see UploadModule.counts_towards_quota)
+        """
+        if self.upload_module_handler.counts_towards_quota(self):
+            reservation = self.storage_quota.reserve(self.client_name, get_announced_length(self.headers))
+        else:
+            reservation = UncountedReservation(self.storage_quota, self.client_name or UNKNOWN_CLIENT)
+        try:
+            yield reservation
+        finally:
+            reservation.finish(self.status_code is not None and 200 <= self.status_code < 300)
+
+    def send_bad_request(self, e: RequestBodyError) -> None:
+        logger.info("Invalid request from %s: %s", self.client_ip, e)
+        # We do not know where the next request would start
+        send_http_response(self, e.status, headers={"Connection": "close"}, content=str(e))
+
+    def send_continue(self) -> None:
+        """
+        Clients like curl wait (up to a second) for a '100 Continue' response before sending large bodies.
+        We only send it once the client was authenticated (BaseHTTPRequestHandler would send it for every HTTP/1.1 request)
+        """
+        if self.headers.get("Expect", "").lower() == "100-continue" and self.request_version >= "HTTP/1.1":
+            self.send_response_only(HTTPStatus.CONTINUE)
+            self.end_headers()
+
+    def send_busy_response(self, e: SchedulerBusyError) -> None:
+        logger.info("Rejecting upload from %s, since all decryption workers are busy", self.client_ip)
+        # The rest of the request body was not read, so the connection can not be reused
+        send_http_response(self, HTTPStatus.SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(e.retry_after), "Connection": "close"},
+            content="The server is busy, please try again later")
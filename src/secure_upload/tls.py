@@ -0,0 +1,35 @@
+import ssl
+from typing import Optional
+
+# TLS 1.2 cipher suites: only forward secret AEAD ciphers. AES-GCM comes first, since it is hardware accelerated on most servers
+# and thus the fastest for large uploads. ChaCha20 is faster for clients without AES instructions.
+# (TLS 1.3 only has AEAD cipher suites, OpenSSL's defaults are fine for it)
+TLS12_CIPHERS = "ECDHE+AESGCM:ECDHE+CHACHA20"
+# Number of session tickets that are sent to TLS 1.3 clients after the handshake. Each one can be used to resume one connection
+SESSION_TICKETS = 2
+
+
+def create_tls_context(cert_file: str, key_file: Optional[str] = None, client_ca_file: Optional[str] = None) -> ssl.SSLContext:
+    """
+    Creates the server's TLS context.
+    Returning clients can resume their session (with a session ticket or from the server's session cache), which skips the expensive part of the handshake.
+    Create the context before starting the worker processes, so that all of them share the session ticket keys.
+    If `client_ca_file` is given, clients can authenticate with a certificate issued by one of its CAs (see TlsClientCertificateAuthenticator)
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.set_ciphers(TLS12_CIPHERS)
+    # Use our preference (fast ciphers) instead of the client's
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    # Compression would allow attacks like CRIME (it is disabled by default, but let's make sure)
+    context.options |= ssl.OP_NO_COMPRESSION
+    # Session tickets are enabled by default, so we only need to make sure nobody disabled them
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = SESSION_TICKETS
+    context.load_cert_chain(cert_file, key_file)
+
+    if client_ca_file:
+        # Clients without a certificate can still use other authentication methods
+        context.verify_mode = ssl.CERT_OPTIONAL
+        context.load_verify_locations(cafile=client_ca_file)
+    return context
@@ -1,26 +1,98 @@
 # The different upload modules will be housed here
+import asyncio
 from enum import Enum, auto
-from http.server import BaseHTTPRequestHandler
 from typing import NamedTuple, Optional
+from urllib.parse import urlsplit
+# local
+from ..http_response import FieldSink, FieldValue, RequestHandler
+from ..multipart import MultipartPart
 
 
 class ModuleStatus(Enum):
     SUCCESS = auto()
     ERROR = auto()
     WRONG_MODULE = auto()
+    # The request was invalid, for example because a header was missing
+    CLIENT_ERROR = auto()
 
 
 class ModuleResult(NamedTuple):
     status: ModuleStatus
     message: Optional[str]
+    # Additional response headers for this request
+    headers: Optional[dict[str,str]] = None
+
+
+class Route(NamedTuple):
+    # The HTTP method. POST routes receive both forms (handle_POST) and raw uploads (open_raw_upload)
+    method: str
+    # A normalized path (see normalize_path) like '/gpg' or a prefix like '/gpg/*', which matches all paths below the first path segment
+    path: str
+
+
+def normalize_path(path: str) -> str:
+    """
+    Removes the query string and trailing slashes and converts the path to lower case. The root path is normalized to ''
+    """
+    return urlsplit(path).path.lower().rstrip("/")
 
 
 class UploadModule:
     def __init__(self, additional_headers: dict[str,str] = {}) -> None:
         self.additional_headers = additional_headers
 
-    def handle_GET(self, handler: BaseHTTPRequestHandler) -> ModuleResult:
+    def get_routes(self) -> list[Route]:
+        """
+        Returns the methods and paths that this module handles. Requests are only passed to the module that registered the route
+        """
         raise Exception("This method needs to be overwritten by the subclass")
 
-    def handle_POST(self, handler: BaseHTTPRequestHandler, post_data: dict[bytes,bytes]) -> ModuleResult:
+    def handle_GET(self, handler: RequestHandler) -> ModuleResult:
+        raise Exception("This method needs to be overwritten by the subclass")
+
+    def open_field(self, handler: RequestHandler, part: MultipartPart) -> Optional[FieldSink]:
+        """
+        Called while the request body is being read, once for each multipart field.
+        Modules can return a sink to process the field's contents while they are received, instead of after the whole request was read.
+        The sink will be passed to handle_POST as the field's value.
+        """
+        return None
+
+    async def open_field_async(self, handler: RequestHandler, part: MultipartPart) -> Optional[FieldSink]:
+        """
+        Used instead of open_field by the asyncio engine. By default open_field is run in a worker thread, since it may block
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.open_field, handler, part)
+
+    def handle_POST(self, handler: RequestHandler, post_data: dict[bytes,FieldValue]) -> ModuleResult:
         raise Exception("This method needs to be overwritten by the subclass")
+
+    def handle_HEAD(self, handler: RequestHandler) -> ModuleResult:
+        return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+
+    def handle_DELETE(self, handler: RequestHandler) -> ModuleResult:
+        return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+
+    def open_raw_upload(self, handler: RequestHandler) -> Optional[FieldSink]:
+        """
+        Called for uploads that send the file as the request body (PUT, PATCH, or POST that is not a form).
+        If the module handles the request, it returns a sink that receives the body while it is being read.
+        Then handle_raw_upload is called with the sink
+        """
+        return None
+
+    async def open_raw_upload_async(self, handler: RequestHandler) -> Optional[FieldSink]:
+        """
+        Used instead of open_raw_upload by the asyncio engine
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.open_raw_upload, handler)
+
+    def handle_raw_upload(self, handler: RequestHandler, upload: FieldSink) -> ModuleResult:
+        return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+
+    def counts_towards_quota(self, handler: RequestHandler) -> bool:
+        """
+        Whether the request body is checked against the storage limits and counted in the client's usage (see StorageQuota).
+        Modules that account for the stored data themselves return False
+        """
+        return True
@@ -0,0 +1,77 @@
+import os
+import sqlite3
+import threading
+from typing import Optional
+# local
+from ..log import get_logger
+
+logger = get_logger("Dedup")
+
+
+class DedupIndex:
+    """
+    Remembers the SHA-256 digest of every stored file in an SQLite database, so that a file that was uploaded before
+    can be stored as a hard link to the existing copy instead of a second copy.
+    The database can be shared by multiple processes. Entries whose file was deleted or changed since are ignored and removed
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        # Every process opens its own connection, since connections can not be used across fork
+        self.connection: Optional[sqlite3.Connection] = None
+        self.connection_pid: Optional[int] = None
+        with self.lock:
+            connection = self.connect()
+            connection.execute("CREATE TABLE IF NOT EXISTS files (digest TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, "
+                "inode INTEGER NOT NULL, mtime_ns INTEGER NOT NULL)")
+            # Do not pass the connection on to forked workers
+            connection.close()
+            self.connection = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None or self.connection_pid != os.getpid():
+            # Autocommit mode, since every statement is a transaction on its own
+            self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            # Readers do not block the writer (and the other way around)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    def lookup(self, digest: str) -> Optional[str]:
+        """
+        Returns the path of a stored file with this digest or None
+        """
+        try:
+            with self.lock:
+                row = self.connect().execute("SELECT path, size, inode, mtime_ns FROM files WHERE digest = ?", (digest,)).fetchone()
+        except sqlite3.Error as e:
+            # The upload is stored as a separate copy
+            logger.warning("Could not read the dedup index: %s", e)
+            return None
+        if row is None:
+            return None
+        path, size, inode, mtime_ns = row
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or (stat.st_size, stat.st_ino, stat.st_mtime_ns) != (size, inode, mtime_ns):
+            logger.debug("Removing outdated entry for %s", path)
+            try:
+                with self.lock:
+                    self.connect().execute("DELETE FROM files WHERE digest = ? AND path = ?", (digest, path))
+            except sqlite3.Error as e:
+                logger.warning("Could not update the dedup index: %s", e)
+            return None
+        return path
+
+    def add(self, digest: str, path: str) -> None:
+        stat = os.stat(path)
+        try:
+            with self.lock:
+                self.connect().execute("INSERT OR REPLACE INTO files (digest, path, size, inode, mtime_ns) VALUES (?, ?, ?, ?, ?)",
+                    (digest, path, stat.st_size, stat.st_ino, stat.st_mtime_ns))
+        except sqlite3.Error as e:
+            # The file is stored anyway, it just can not be deduplicated later
+            logger.warning("Could not update the dedup index: %s", e)
@@ -1,44 +1,494 @@
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import shutil
 import subprocess
-from http.server import BaseHTTPRequestHandler
 import os
-import traceback
+import threading
+import time
+from typing import IO, BinaryIO, Callable, Iterator, Optional, Union, cast
+from urllib.parse import unquote, urlsplit
 # local
-from . import UploadModule, ModuleResult, ModuleStatus
-from ..http_response import parse_request
+from . import ModuleResult, ModuleStatus, Route, UploadModule, normalize_path
+from .openpgp import DecryptionError, DerivedKeyCache, SymmetricMessageDecryptor, UnsupportedMessageError
+from .scheduler import DecryptionScheduler, SchedulerBusyError, SchedulerSlot
+from .store import OutputStore
+from ..http_response import DEFAULT_CHUNK_SIZE, DecodingLimits, FieldSink, FieldValue, RequestBodyError, RequestHandler, field_as_file, get_content_length
+from ..log import get_logger
+from ..metrics import DECRYPT_DURATION, DECRYPTION_FAILURES, DECRYPTION_SUCCESSES, QUEUE_DURATION, STORE_DURATION, STORED_BYTES
+from ..multipart import MultipartPart
 
 FIELD_NAME = b"gpg"
 FILE_NAME = b"filename"
+logger = get_logger("GPG")
+
+# How much ciphertext the in-process decryption keeps to be able to hand the upload over to gpg
+MAX_REPLAY_SIZE = 1024 * 1024
+# Fits into a pipe's buffer on every POSIX system (PIPE_BUF)
+MAX_PASSPHRASE_SIZE = 512
+# Size of the pipe for gpg's output (if the OS allows it) and of the reads from it
+OUTPUT_PIPE_SIZE = 1024 * 1024
+
+
+def get_success_message(digest: str) -> str:
+    # Lets the client verify that the server got the right file
+    return f"File uploaded and decrypted. SHA-256: {digest}"
+
+
+class Decryption(FieldSink):
+    """
+    Base class for sinks that decrypt an upload into a temporary file of the output store.
+    The SHA-256 digest of the plaintext is computed while it is written.
+    Call `save_as` after the upload is complete to give the plaintext its final name.
+    `expected_size` is used to preallocate the temporary file (see OutputStore.create_temp_file)
+    """
+
+    def __init__(self, store: OutputStore, expected_size: Optional[int] = None) -> None:
+        super().__init__()
+        self.store = store
+        temp_fd, temp_path = store.create_temp_file(expected_size)
+        # Both are set to None once they were closed or handed over
+        self.temp_fd: Optional[int] = temp_fd
+        self.temp_path: Optional[str] = temp_path
+        self.succeeded = False
+        self.start_time = time.perf_counter()
+        # Limits how many in-process decryptions process data at the same time (see using_worker)
+        self.scheduler: Optional[DecryptionScheduler] = None
+        # The worker a gpg process holds from its start until it exited (see release_worker)
+        self.slot: Optional[SchedulerSlot] = None
+        self.hash = hashlib.sha256()
+        self.plaintext_buffer = bytearray()
+        # Copies gpg's output to the temporary file (see start_output_thread)
+        self.output_thread: Optional[threading.Thread] = None
+        self.output_error: Optional[OSError] = None
+
+    @property
+    def digest(self) -> str:
+        """
+        The SHA-256 digest of the plaintext (as hex string)
+        """
+        return self.hash.hexdigest()
+
+    @contextlib.contextmanager
+    def using_worker(self) -> Iterator[None]:
+        """
+        Holds a worker of the scheduler while the decryption processes a piece of the upload.
+        Between the pieces (while the next one is received from the client) the worker can decrypt other uploads.
+        Only used by in-process decryptions: a gpg process runs until it exited, so it holds a worker the whole time
+        """
+        slot = self.scheduler.acquire(admitted=True) if self.scheduler else None
+        try:
+            yield
+        finally:
+            if slot:
+                slot.release()
+
+    def release_worker(self) -> None:
+        """
+        Releases the worker held for the whole decryption, if any
+        """
+        if self.slot:
+            self.slot.release()
+            self.slot = None
+
+    def write_plaintext(self, data: bytes) -> None:
+        """
+        Buffers small pieces of plaintext, so that they are hashed and written in larger chunks. Call `flush_plaintext` at the end
+        """
+        self.plaintext_buffer += data
+        if len(self.plaintext_buffer) >= DEFAULT_CHUNK_SIZE:
+            self.flush_plaintext()
+
+    def flush_plaintext(self) -> None:
+        if self.plaintext_buffer:
+            self.write_output(self.plaintext_buffer)
+            self.plaintext_buffer = bytearray()
+
+    def write_output(self, data: Union[bytes, bytearray]) -> None:
+        self.hash.update(data)
+        assert self.temp_fd is not None
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.temp_fd, view):]
+
+    def start_output_thread(self) -> int:
+        """
+        Returns the write end of a pipe for gpg's output, which needs to be closed once gpg was started.
+        A thread reads the plaintext from the pipe, hashes it and writes it to the temporary file, so that it does not need to be read again
+        """
+        read_fd, write_fd = os.pipe()
+        if hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                # Fewer context switches between gpg and the thread
+                fcntl.fcntl(read_fd, fcntl.F_SETPIPE_SZ, OUTPUT_PIPE_SIZE)
+            except OSError:
+                # Larger than /proc/sys/fs/pipe-max-size
+                pass
+        self.output_thread = threading.Thread(target=self.copy_output, args=(read_fd,), name="gpg-output", daemon=True)
+        self.output_thread.start()
+        return write_fd
+
+    def copy_output(self, read_fd: int) -> None:
+        try:
+            while True:
+                data = os.read(read_fd, OUTPUT_PIPE_SIZE)
+                if not data:
+                    return
+                self.write_output(data)
+        except OSError as e:
+            # For example, because the disk is full. Closing the pipe stops gpg
+            self.output_error = e
+        finally:
+            os.close(read_fd)
+
+    def wait_for_output(self) -> bool:
+        """
+        Waits until the output thread has written everything (gpg needs to have exited) and returns whether that succeeded
+        """
+        if self.output_thread:
+            self.output_thread.join()
+            self.output_thread = None
+        if self.output_error:
+            logger.warning("Could not write the plaintext: %s", self.output_error)
+            return False
+        return True
+
+    def save_as(self, name: str) -> str:
+        """
+        Stores the plaintext under the given name and returns its path, which may differ from the name (see OutputStore.commit)
+        """
+        if not self.succeeded:
+            raise DecryptionError("Decryption failed")
+        assert self.temp_path is not None
+        path = self.store.commit(self.temp_path, name, self.digest)
+        self.temp_path = None
+        return path
+
+    def close_output(self) -> None:
+        """
+        Closes our file descriptor of the temporary file
+        """
+        if self.temp_fd is not None:
+            os.close(self.temp_fd)
+            self.temp_fd = None
+
+    def close(self) -> None:
+        self.release_worker()
+        if self.output_thread:
+            # The thread must not write to the file descriptor after it was closed
+            self.output_thread.join()
+            self.output_thread = None
+        self.close_output()
+        if self.temp_path:
+            # Do not keep incomplete or unauthenticated plaintext around
+            self.store.discard(self.temp_path)
+            self.temp_path = None
+
+
+class GpgDecryption(Decryption):
+    """
+    Decrypts an upload with gpg while it is being received.
+    The ciphertext is piped into gpg chunk by chunk and gpg's output is written to the temporary file by the output thread.
+    """
+
+    def __init__(self, command: list[str], store: OutputStore, expected_size: Optional[int] = None, pass_fds: tuple[int, ...] = ()) -> None:
+        super().__init__(store, expected_size)
+        output_fd = self.start_output_thread()
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output_fd, pass_fds=pass_fds)
+        except BaseException:
+            os.close(output_fd)
+            self.close()
+            raise
+        # gpg has its own copy. The output thread stops once gpg exited
+        os.close(output_fd)
+        # Always set, because stdin is a pipe
+        self.stdin = cast(IO[bytes], self.process.stdin)
+        self.return_code: Optional[int] = None
+        # Set when gpg closed its input, for example because the password was wrong
+        self.gpg_exited_early = False
+
+    def write(self, data: bytes) -> None:
+        if self.gpg_exited_early:
+            # We still need to consume the rest of the request, but there is no point in passing it on
+            return
+        try:
+            # Writing blocks while gpg is still busy with the previous data
+            self.stdin.write(data)
+        except BrokenPipeError:
+            self.gpg_exited_early = True
+
+    def finish(self) -> None:
+        try:
+            self.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.return_code = self.process.wait()
+        self.release_worker()
+        output_written = self.wait_for_output()
+        self.succeeded = output_written and self.return_code == 0
+        if self.succeeded:
+            assert self.temp_fd is not None
+            self.store.trim(self.temp_fd)
+        self.close_output()
+
+    def close(self) -> None:
+        if hasattr(self, "process"):
+            if self.process.poll() is None:
+                # The upload was aborted before it was complete
+                self.process.kill()
+                self.process.wait()
+            try:
+                self.stdin.close()
+            except BrokenPipeError:
+                pass
+        super().close()
+
+
+class AsyncGpgDecryption(Decryption):
+    """
+    The asyncio engine's version of GpgDecryption, that uses asyncio's subprocess API.
+    Use `start` to create an instance.
+    """
+
+    def __init__(self, store: OutputStore, expected_size: Optional[int] = None) -> None:
+        super().__init__(store, expected_size)
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.return_code: Optional[int] = None
+        self.gpg_exited_early = False
+
+    @classmethod
+    async def start(cls, command: list[str], store: OutputStore, expected_size: Optional[int] = None,
+            pass_fds: tuple[int, ...] = ()) -> "AsyncGpgDecryption":
+        decryption = cls(store, expected_size)
+        output_fd = decryption.start_output_thread()
+        try:
+            decryption.process = await asyncio.create_subprocess_exec(*command, stdin=subprocess.PIPE, stdout=output_fd, pass_fds=pass_fds)
+        except BaseException:
+            os.close(output_fd)
+            decryption.close()
+            raise
+        os.close(output_fd)
+        return decryption
+
+    def write(self, data: bytes) -> None:
+        raise Exception("AsyncGpgDecryption can only be used by the asyncio engine")
+
+    async def write_async(self, data: bytes) -> None:
+        if self.gpg_exited_early:
+            return
+        assert self.process and self.process.stdin
+        try:
+            self.process.stdin.write(data)
+            # Wait until gpg has processed enough of the data
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            self.gpg_exited_early = True
+
+    async def finish_async(self) -> None:
+        assert self.process and self.process.stdin
+        self.process.stdin.close()
+        try:
+            await self.process.stdin.wait_closed()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.return_code = await self.process.wait()
+        self.release_worker()
+        output_written = await asyncio.get_running_loop().run_in_executor(None, self.wait_for_output)
+        self.succeeded = output_written and self.return_code == 0
+        if self.succeeded:
+            assert self.temp_fd is not None
+            self.store.trim(self.temp_fd)
+        self.close_output()
+
+    def close(self) -> None:
+        if self.process and self.process.returncode is None:
+            # The upload was aborted before it was complete. The event loop will collect the exit status
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+        super().close()
+
+
+class InProcessDecryption(Decryption):
+    """
+    Decrypts an upload with the built-in OpenPGP implementation while it is being received.
+    If the message uses features that are not supported, the upload is handed over to gpg.
+    """
+
+    def __init__(self, passphrase: bytes, store: OutputStore, expected_size: Optional[int], key_cache: DerivedKeyCache,
+            start_fallback: Callable[[], GpgDecryption], limits: DecodingLimits = DecodingLimits()) -> None:
+        super().__init__(store, expected_size)
+        self.decryptor = SymmetricMessageDecryptor(passphrase, self.write_plaintext, key_cache, limits)
+        self.start_fallback = start_fallback
+        self.fallback: Optional[GpgDecryption] = None
+        # The ciphertext received so far. It is replayed to gpg if we need to fall back to it.
+        # Unsupported features are detected before any plaintext is written, so it is only kept until then
+        self.replay_buffer: Optional[bytearray] = bytearray()
+        self.failed = False
+
+    def write(self, data: bytes) -> None:
+        if self.fallback:
+            self.fallback.write(data)
+            return
+        if self.failed:
+            return
+
+        if self.replay_buffer is not None:
+            self.replay_buffer += data
+        try:
+            with self.using_worker():
+                self.decryptor.feed(data)
+        except UnsupportedMessageError as e:
+            self.switch_to_fallback(e)
+        except DecryptionError as e:
+            logger.info("In-process decryption failed: %s", e)
+            self.failed = True
+
+        if self.replay_buffer is not None and (self.decryptor.output_started or len(self.replay_buffer) > MAX_REPLAY_SIZE):
+            self.replay_buffer = None
+
+    def switch_to_fallback(self, reason: UnsupportedMessageError) -> None:
+        if self.replay_buffer is None:
+            logger.info("In-process decryption failed and gpg can not be used as fallback anymore: %s", reason)
+            self.failed = True
+            return
+
+        logger.info("Falling back to gpg: %s", reason)
+        self.fallback = self.start_fallback()
+        self.fallback.write(bytes(self.replay_buffer))
+        self.replay_buffer = None
+        # The temporary file of the fallback will be used instead
+        self.close_output()
+        if self.temp_path:
+            self.store.discard(self.temp_path)
+            self.temp_path = None
+
+    def finish(self) -> None:
+        if not self.fallback and not self.failed:
+            try:
+                with self.using_worker():
+                    self.decryptor.close()
+                self.flush_plaintext()
+                assert self.temp_fd is not None
+                self.store.trim(self.temp_fd)
+                self.close_output()
+                self.succeeded = True
+            except UnsupportedMessageError as e:
+                self.switch_to_fallback(e)
+            except DecryptionError as e:
+                logger.info("In-process decryption failed: %s", e)
+                self.failed = True
+
+        if self.fallback:
+            self.fallback.finish()
+            self.succeeded = self.fallback.succeeded
+
+    @property
+    def digest(self) -> str:
+        if self.fallback:
+            return self.fallback.digest
+        return super().digest
+
+    def save_as(self, name: str) -> str:
+        if self.fallback:
+            return self.fallback.save_as(name)
+        return super().save_as(name)
+
+    def close(self) -> None:
+        if self.fallback:
+            self.fallback.close()
+        super().close()
+
 
 class GpgUploadHandler(UploadModule):
-    def __init__(self, symmetric_key: str) -> None:
+    def __init__(self, symmetric_key: str, in_process: bool = False, scheduler: Optional[DecryptionScheduler] = None, store: Optional[OutputStore] = None,
+            decoding_limits: DecodingLimits = DecodingLimits()) -> None:
         super().__init__()
         self.gpg_executeable = "gpg"
+        if "\n" in symmetric_key or len(symmetric_key.encode("utf-8")) > MAX_PASSPHRASE_SIZE:
+            # gpg reads the passphrase up to the first line break (see open_passphrase_pipe)
+            raise Exception(f"The GPG passphrase can not contain line breaks or be longer than {MAX_PASSPHRASE_SIZE} bytes")
         self.symmetric_key = symmetric_key
+        # Use the built-in OpenPGP implementation instead of starting a gpg process for each upload
+        self.in_process = in_process
+        self.key_cache = DerivedKeyCache()
+        # Limits the compressed data inside of messages that are decrypted in-process
+        self.decoding_limits = decoding_limits
+        # Limits the number of concurrent decryptions. If it is None, every upload is decrypted immediately
+        self.scheduler = scheduler
+        # Where the decrypted files are stored
+        self.store = store or OutputStore("/tmp", "TODO_change_me_{name}")
 
-    def handle_GET(self, handler: BaseHTTPRequestHandler) -> ModuleResult:
+    def get_routes(self) -> list[Route]:
+        return [
+            # Forms
+            Route("POST", ""),
+            Route("POST", "/gpg"),
+            # Raw uploads to '/gpg/FILENAME' (the form route '/gpg' accepts raw uploads too)
+            Route("POST", "/gpg/*"),
+            Route("PUT", "/gpg"),
+            Route("PUT", "/gpg/*"),
+        ]
+
+    def handle_GET(self, handler: RequestHandler) -> ModuleResult:
         return ModuleResult(ModuleStatus.WRONG_MODULE, None)
 
-    def handle_POST(self, handler: BaseHTTPRequestHandler, post_data: dict[bytes,bytes]) -> ModuleResult:
-        # Normalize path
-        path = handler.path.lower()
-        while path.endswith("/"):
-            path = path[:-1]
+    def should_stream_field(self, handler: RequestHandler, part: MultipartPart) -> bool:
+        return part.name == FIELD_NAME
+
+    def open_field(self, handler: RequestHandler, part: MultipartPart) -> Optional[FieldSink]:
+        if self.should_stream_field(handler, part):
+            # Start decrypting while the file is still being uploaded. The form is a bit larger than the file, which is fine for preallocation
+            return self.start_decryption(self.get_expected_size(handler))
+        return None
+
+    async def open_field_async(self, handler: RequestHandler, part: MultipartPart) -> Optional[FieldSink]:
+        if self.should_stream_field(handler, part):
+            return await self.start_decryption_async(self.get_expected_size(handler))
+        return None
+
+    def handle_POST(self, handler: RequestHandler, post_data: dict[bytes,FieldValue]) -> ModuleResult:
+        path = normalize_path(handler.path)
 
         if path in ["", "/gpg"]:
             try:
                 if FIELD_NAME in post_data:
-                    file_name = post_data.get(FILE_NAME, "unnamed")
+                    file_name_value = post_data.get(FILE_NAME, b"unnamed")
+                    if isinstance(file_name_value, bytes):
+                        file_name = file_name_value.decode("utf-8", errors="replace")
+                    else:
+                        file_name = "unnamed"
                     # Prevent path traversal attacks
-                    file_name =  os.path.basename(file_name)
+                    file_name = os.path.basename(file_name) or "unnamed"
 
                     try:
-                        self.handle_file(file_name, post_data[FIELD_NAME])
-                        return ModuleResult(ModuleStatus.SUCCESS, "File uploaded and decrypted")
+                        upload = post_data[FIELD_NAME]
+                        if isinstance(upload, Decryption):
+                            # The file was already decrypted while it was uploaded
+                            digest = self.finish_decryption(file_name, upload)
+                        elif isinstance(upload, FieldSink):
+                            raise Exception(f"Field was consumed by another module: {upload}")
+                        else:
+                            digest = self.handle_file(file_name, field_as_file(upload))
+                        return ModuleResult(ModuleStatus.SUCCESS, get_success_message(digest))
+                    except SchedulerBusyError:
+                        # Handled by the server
+                        raise
+                    except DecryptionError as e:
+                        # Usually the client used the wrong password, which does not need a stack trace
+                        logger.info("Could not decrypt '%s' from %s: %s", file_name, handler.client_address[0], e)
+                        return ModuleResult(ModuleStatus.ERROR, f"Failed to decrypt file with GPG. Did you use the right password for the symmetric encryption?")
                     except Exception:
+                        logger.exception("Failed to decrypt '%s' from %s", file_name, handler.client_address[0])
                         return ModuleResult(ModuleStatus.ERROR, f"Failed to decrypt file with GPG. Did you use the right password for the symmetric encryption?")
 
+            except SchedulerBusyError:
+                raise
             except Exception:
-                traceback.print_exc()
+                logger.exception("Failed to handle the form from %s", handler.client_address[0])
 
             if path == "":
                 return ModuleResult(ModuleStatus.WRONG_MODULE, None)
@@ -47,7 +497,168 @@ class GpgUploadHandler(UploadModule):
         else:
             return ModuleResult(ModuleStatus.WRONG_MODULE, None)
 
-    def handle_file(self, file_name: str, contents: bytes) -> None:
-        command = [self.gpg_executeable, "-d", "--pinentry-mode", "loopback", "--passphrase", self.symmetric_key, "-o", f"/tmp/TODO_change_me_{file_name}"]
-        print("Running command:", command)
-        subprocess.run(command, input=contents, check=True)
+    def get_raw_upload_file_name(self, handler: RequestHandler) -> Optional[str]:
+        """
+        Raw uploads are sent to '/gpg/FILENAME' (or just '/gpg'). Returns the file name or None if the path does not belong to this module
+        """
+        path = urlsplit(handler.path).path
+        prefix, _, file_name = path.lstrip("/").partition("/")
+        if prefix.lower() != "gpg":
+            return None
+        # Prevent path traversal attacks
+        return os.path.basename(unquote(file_name, errors="replace")) or "unnamed"
+
+    def should_accept_raw_upload(self, handler: RequestHandler) -> bool:
+        # A raw POST to the root path is not for us
+        return self.get_raw_upload_file_name(handler) is not None
+
+    def open_raw_upload(self, handler: RequestHandler) -> Optional[FieldSink]:
+        if not self.should_accept_raw_upload(handler):
+            return None
+        return self.start_decryption(self.get_expected_size(handler))
+
+    async def open_raw_upload_async(self, handler: RequestHandler) -> Optional[FieldSink]:
+        if not self.should_accept_raw_upload(handler):
+            return None
+        return await self.start_decryption_async(self.get_expected_size(handler))
+
+    def handle_raw_upload(self, handler: RequestHandler, upload: FieldSink) -> ModuleResult:
+        # Only called for sinks from open_raw_upload, which checked the path
+        file_name = self.get_raw_upload_file_name(handler) or "unnamed"
+        try:
+            if not isinstance(upload, Decryption):
+                raise Exception(f"Upload was not opened by this module: {upload}")
+            digest = self.finish_decryption(file_name, upload)
+            return ModuleResult(ModuleStatus.SUCCESS, get_success_message(digest))
+        except DecryptionError as e:
+            # Usually the client used the wrong password, which does not need a stack trace
+            logger.info("Could not decrypt '%s' from %s: %s", file_name, handler.client_address[0], e)
+            return ModuleResult(ModuleStatus.ERROR, f"Failed to decrypt file with GPG. Did you use the right password for the symmetric encryption?")
+        except Exception:
+            logger.exception("Failed to decrypt '%s' from %s", file_name, handler.client_address[0])
+            return ModuleResult(ModuleStatus.ERROR, f"Failed to decrypt file with GPG. Did you use the right password for the symmetric encryption?")
+
+    @staticmethod
+    def get_expected_size(handler: RequestHandler) -> Optional[int]:
+        """
+        Returns the request's Content-Length, which is close to the size of the plaintext, or None for chunked and compressed requests
+        """
+        if "transfer-encoding" in handler.headers or "content-encoding" in handler.headers:
+            return None
+        try:
+            return get_content_length(handler.headers)
+        except RequestBodyError:
+            return None
+
+    def start_decryption(self, expected_size: Optional[int] = None) -> Decryption:
+        """
+        Waits for a free worker (if a scheduler is used) and starts a new decryption.
+        This is where uploads are rejected, if the server is overloaded.
+        A gpg process keeps the worker until it exited, an in-process decryption only uses a worker while it processes data
+        """
+        with QUEUE_DURATION.time():
+            slot = self.scheduler.acquire() if self.scheduler else None
+        try:
+            if self.in_process:
+                decryption: Decryption = self.start_in_process_decryption(expected_size)
+                decryption.scheduler = self.scheduler
+            else:
+                decryption = self.start_gpg_decryption(expected_size)
+                decryption.slot, slot = slot, None
+        finally:
+            if slot:
+                slot.release()
+        return decryption
+
+    async def start_decryption_async(self, expected_size: Optional[int] = None) -> Decryption:
+        """
+        Like start_decryption, but without blocking the event loop
+        """
+        with QUEUE_DURATION.time():
+            slot = await self.scheduler.acquire_async() if self.scheduler else None
+        try:
+            if self.in_process:
+                # Its blocking methods are run in worker threads
+                decryption: Decryption = self.start_in_process_decryption(expected_size)
+                decryption.scheduler = self.scheduler
+            else:
+                passphrase_fd = self.open_passphrase_pipe()
+                try:
+                    decryption = await AsyncGpgDecryption.start(self.get_gpg_command(passphrase_fd), self.store, expected_size, (passphrase_fd,))
+                finally:
+                    os.close(passphrase_fd)
+                decryption.slot, slot = slot, None
+        finally:
+            if slot:
+                slot.release()
+        return decryption
+
+    def start_in_process_decryption(self, expected_size: Optional[int] = None) -> InProcessDecryption:
+        return InProcessDecryption(self.symmetric_key.encode("utf-8"), self.store, expected_size, self.key_cache,
+            lambda: self.start_fallback_decryption(expected_size), self.decoding_limits)
+
+    def open_passphrase_pipe(self) -> int:
+        """
+        Returns the read end of a pipe that contains the passphrase, which gpg reads with --passphrase-fd.
+        Unlike a command line argument, it is not visible to other users (for example in `ps`). The caller needs to close it once gpg was started
+        """
+        read_fd, write_fd = os.pipe()
+        try:
+            # Much smaller than the pipe's buffer (see __init__), so this does not block
+            os.write(write_fd, self.symmetric_key.encode("utf-8"))
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        return read_fd
+
+    def get_gpg_command(self, passphrase_fd: int) -> list[str]:
+        return [self.gpg_executeable, "--batch", "-d", "--pinentry-mode", "loopback", "--passphrase-fd", str(passphrase_fd)]
+
+    def start_gpg_decryption(self, expected_size: Optional[int] = None) -> GpgDecryption:
+        passphrase_fd = self.open_passphrase_pipe()
+        try:
+            return GpgDecryption(self.get_gpg_command(passphrase_fd), self.store, expected_size, (passphrase_fd,))
+        finally:
+            # gpg has its own copy
+            os.close(passphrase_fd)
+
+    def start_fallback_decryption(self, expected_size: Optional[int] = None) -> GpgDecryption:
+        """
+        Starts gpg for an in-process decryption that can not be completed without it.
+        The gpg process needs a worker like any other, but the upload was admitted already, so it is not rejected because of a full queue
+        """
+        slot = self.scheduler.acquire(admitted=True) if self.scheduler else None
+        try:
+            decryption = self.start_gpg_decryption(expected_size)
+        except BaseException:
+            if slot:
+                slot.release()
+            raise
+        decryption.slot = slot
+        return decryption
+
+    def finish_decryption(self, file_name: str, decryption: Decryption) -> str:
+        """
+        Stores the decrypted file and returns the SHA-256 digest of its contents
+        """
+        DECRYPT_DURATION.observe(time.perf_counter() - decryption.start_time)
+        if not decryption.succeeded:
+            DECRYPTION_FAILURES.inc()
+        else:
+            DECRYPTION_SUCCESSES.inc()
+        with STORE_DURATION.time():
+            path = decryption.save_as(file_name)
+        STORED_BYTES.inc(os.path.getsize(path))
+        return decryption.digest
+
+    def handle_file(self, file_name: str, contents: BinaryIO) -> str:
+        decryption = self.start_decryption()
+        try:
+            # Feed the file to gpg in chunks, so that it does not need to be loaded into memory
+            shutil.copyfileobj(contents, decryption, DEFAULT_CHUNK_SIZE)
+            decryption.finish()
+            return self.finish_decryption(file_name, decryption)
+        finally:
+            decryption.close()
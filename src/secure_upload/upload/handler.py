@@ -1,37 +1,112 @@
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler
-from typing import Callable
+from typing import Callable, Optional
 # local
-from . import ModuleResult, UploadModule, ModuleStatus
-from ..http_response import send_http_response
+from . import ModuleResult, ModuleStatus, Route, UploadModule, normalize_path
+from ..http_response import FieldSink, FieldValue, RequestHandler, send_http_response
+from ..metrics import MODULE_DURATION
+from ..multipart import MultipartPart
 
 
 class ModuleHandler:
+    """
+    Dispatches each request to the one module that registered its method and path (see UploadModule.get_routes)
+    """
+
     def __init__(self, modules: list[UploadModule]) -> None:
         if not modules:
             raise Exception("ModuleHandler has been given an empty list of upload modules")
         self.modules = modules
+        # Built once, so that finding the module for a request only takes (up to) two dictionary lookups
+        self.routes: dict[Route, UploadModule] = {}
+        for module in modules:
+            for route in module.get_routes():
+                if route in self.routes:
+                    raise Exception(f"Route {route.method} '{route.path}' is registered by both '{type(self.routes[route]).__name__}' and '{type(module).__name__}'")
+                self.routes[route] = module
+
+    def get_module(self, handler: RequestHandler) -> Optional[UploadModule]:
+        """
+        Returns the module responsible for the request or None if there is none
+        """
+        path = normalize_path(handler.path)
+        module = self.routes.get(Route(handler.command, path))
+        if module is None:
+            # '/gpg/file.txt' -> '/gpg/*'
+            first_segment, separator, _ = path[1:].partition("/")
+            if separator:
+                module = self.routes.get(Route(handler.command, f"/{first_segment}/*"))
+        return module
 
-    def handle_GET(self, handler: BaseHTTPRequestHandler) -> None:
+    def handle_GET(self, handler: RequestHandler) -> None:
         self.handle_generic(handler, lambda module, handler: module.handle_GET(handler))
 
-    def handle_POST(self, handler: BaseHTTPRequestHandler, post_data: dict[bytes,bytes]) -> ModuleResult:
+    def handle_HEAD(self, handler: RequestHandler) -> None:
+        self.handle_generic(handler, lambda module, handler: module.handle_HEAD(handler))
+
+    def handle_DELETE(self, handler: RequestHandler) -> None:
+        self.handle_generic(handler, lambda module, handler: module.handle_DELETE(handler))
+
+    def open_field(self, handler: RequestHandler, part: MultipartPart) -> Optional[FieldSink]:
+        module = self.get_module(handler)
+        return module.open_field(handler, part) if module else None
+
+    async def open_field_async(self, handler: RequestHandler, part: MultipartPart) -> Optional[FieldSink]:
+        module = self.get_module(handler)
+        return await module.open_field_async(handler, part) if module else None
+
+    def handle_POST(self, handler: RequestHandler, post_data: dict[bytes,FieldValue]) -> None:
         self.handle_generic(handler, lambda module, handler: module.handle_POST(handler, post_data))
 
+    def open_raw_upload(self, handler: RequestHandler) -> Optional[tuple[UploadModule, FieldSink]]:
+        """
+        Returns the module responsible for the raw upload and the sink it returned, or None if no module accepts it
+        """
+        module = self.get_module(handler)
+        if module is None:
+            return None
+        sink = module.open_raw_upload(handler)
+        return (module, sink) if sink is not None else None
+
+    async def open_raw_upload_async(self, handler: RequestHandler) -> Optional[tuple[UploadModule, FieldSink]]:
+        module = self.get_module(handler)
+        if module is None:
+            return None
+        sink = await module.open_raw_upload_async(handler)
+        return (module, sink) if sink is not None else None
+
+    def handle_raw_upload(self, handler: RequestHandler, module: UploadModule, upload: FieldSink) -> None:
+        """
+        Lets the module that opened the raw upload handle it, after the whole body was received
+        """
+        with MODULE_DURATION.time():
+            result = module.handle_raw_upload(handler, upload)
+        self.send_module_result(handler, module, result)
 
-    def handle_generic(self, handler: BaseHTTPRequestHandler, fn_let_module_handle_the_request: Callable[[UploadModule,BaseHTTPRequestHandler],ModuleResult]):
-        for module in self.modules:
-            result = fn_let_module_handle_the_request(module, handler)
-            if result.status == ModuleStatus.SUCCESS:
-                # Module processed the request successfully
-                send_http_response(handler, HTTPStatus.OK, headers=module.additional_headers, content=result.message)
-            elif result.status == ModuleStatus.ERROR:
-                # Module processed the request successfully
-                send_http_response(handler, HTTPStatus.INTERNAL_SERVER_ERROR, headers=module.additional_headers, content=result.message)
-            elif result.status == ModuleStatus.WRONG_MODULE:
-                # Module processed the request successfully
-                send_http_response(handler, HTTPStatus.NOT_FOUND, headers=module.additional_headers, content="Invalid request or the required module is not enabled")
-            else:
-                raise Exception(f"Unexpected status code returned by module '{type(module).__name__}'")
+    def counts_towards_quota(self, handler: RequestHandler) -> bool:
+        module = self.get_module(handler)
+        return module is None or module.counts_towards_quota(handler)
 
+    def handle_generic(self, handler: RequestHandler, fn_let_module_handle_the_request: Callable[[UploadModule,RequestHandler],ModuleResult]) -> None:
+        module = self.get_module(handler)
+        if module is None:
+            send_http_response(handler, HTTPStatus.NOT_FOUND, content="Invalid request or the required module is not enabled")
+        else:
+            with MODULE_DURATION.time():
+                result = fn_let_module_handle_the_request(module, handler)
+            self.send_module_result(handler, module, result)
 
+    def send_module_result(self, handler: RequestHandler, module: UploadModule, result: ModuleResult) -> None:
+        headers = [module.additional_headers, result.headers or {}]
+        if result.status == ModuleStatus.SUCCESS:
+            # Module processed the request successfully
+            send_http_response(handler, HTTPStatus.OK, headers=headers, content=result.message)
+        elif result.status == ModuleStatus.ERROR:
+            # Module failed to process the request
+            send_http_response(handler, HTTPStatus.INTERNAL_SERVER_ERROR, headers=headers, content=result.message)
+        elif result.status == ModuleStatus.CLIENT_ERROR:
+            send_http_response(handler, HTTPStatus.BAD_REQUEST, headers=headers, content=result.message)
+        elif result.status == ModuleStatus.WRONG_MODULE:
+            # Module is not responsible for the request
+            send_http_response(handler, HTTPStatus.NOT_FOUND, headers=headers, content="Invalid request or the required module is not enabled")
+        else:
+            raise Exception(f"Unexpected status code returned by module '{type(module).__name__}'")
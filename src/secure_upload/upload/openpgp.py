@@ -0,0 +1,566 @@
+import bz2
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from hmac import compare_digest
+from typing import Callable, NamedTuple, Optional, Union
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+    try:
+        # Newer versions of the cryptography package moved the CFB mode to the decrepit module
+        from cryptography.hazmat.decrepit.ciphers.modes import CFB
+    except ImportError:
+        from cryptography.hazmat.primitives.ciphers.modes import CFB
+except ImportError:
+    # The in-process decryption engine is optional. Without the cryptography package only gpg can be used
+    Cipher = None # type: ignore
+# local
+from ..http_response import RATIO_CHECK_THRESHOLD, DecodingLimits
+
+
+class UnsupportedMessageError(Exception):
+    """
+    The message uses a packet type or algorithm that is not implemented here, but gpg may still be able to decrypt it
+    """
+
+
+class DecryptionError(Exception):
+    """
+    The message could not be decrypted (wrong passphrase, corrupted or manipulated data)
+    """
+
+
+def is_available() -> bool:
+    return Cipher is not None
+
+
+# Packet tags (RFC 4880 section 4.3)
+TAG_SKESK = 3
+TAG_COMPRESSED = 8
+TAG_MARKER = 10
+TAG_LITERAL = 11
+TAG_SEIPD = 18
+
+# Symmetric algorithm id -> key size in bytes. Only AES is supported
+AES_KEY_SIZES = {7: 16, 8: 24, 9: 32}
+AES_BLOCK_SIZE = 16
+HASH_ALGORITHMS = {1: "md5", 2: "sha1", 3: "ripemd160", 8: "sha256", 9: "sha384", 10: "sha512", 11: "sha224"}
+
+# The modification detection code packet: header (0xD3, 0x14) + SHA-1 hash
+MDC_HEADER = b"\xd3\x14"
+MDC_LENGTH = len(MDC_HEADER) + 20
+# Limits to prevent abuse by malformed messages
+MAX_SKESK_SIZE = 1024
+MAX_COMPRESSION_DEPTH = 8
+# Maximum number of bytes that a decompressor may output in a single step
+DECOMPRESSION_CHUNK_SIZE = 64 * 1024
+
+WriteCallback = Callable[[bytes], None]
+
+
+class PacketHeader(NamedTuple):
+    tag: int
+
+
+class PacketBody(NamedTuple):
+    data: bytes
+
+
+class PacketEnd(NamedTuple):
+    pass
+
+
+PacketEvent = Union[PacketHeader, PacketBody, PacketEnd]
+
+
+class PacketStreamParser:
+    """
+    Incrementally splits a stream of OpenPGP packets (RFC 4880 section 4.2) into events.
+    Packet bodies are passed on in chunks, so arbitrarily large packets do not need to be buffered.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        # Bytes left in the current body chunk. None means that the next packet header is expected
+        self.remaining: Optional[int] = None
+        # Whether the current chunk is followed by another length field (partial body lengths)
+        self.partial = False
+        # Old format packets with an indeterminate length extend to the end of the stream
+        self.indeterminate = False
+
+    def feed(self, data: bytes) -> list[PacketEvent]:
+        self.buffer += data
+        events: list[PacketEvent] = []
+        while self._step(events):
+            pass
+        return events
+
+    def close(self) -> list[PacketEvent]:
+        if self.indeterminate:
+            self.indeterminate = False
+            return [PacketEnd()]
+        if self.remaining is not None or self.buffer:
+            raise DecryptionError("Message is truncated")
+        return []
+
+    def _step(self, events: list[PacketEvent]) -> bool:
+        if self.indeterminate:
+            if self.buffer:
+                events.append(PacketBody(bytes(self.buffer)))
+                self.buffer.clear()
+            return False
+
+        if self.remaining is None:
+            return self._parse_header(events)
+
+        if self.remaining > 0:
+            if not self.buffer:
+                return False
+            length = min(self.remaining, len(self.buffer))
+            events.append(PacketBody(bytes(self.buffer[:length])))
+            del self.buffer[:length]
+            self.remaining -= length
+            return True
+
+        # The current chunk is complete
+        if self.partial:
+            parsed = self._parse_new_format_length(0)
+            if parsed is None:
+                return False
+            self.remaining, self.partial, header_length = parsed
+            del self.buffer[:header_length]
+        else:
+            events.append(PacketEnd())
+            self.remaining = None
+        return True
+
+    def _parse_header(self, events: list[PacketEvent]) -> bool:
+        if not self.buffer:
+            return False
+        ctb = self.buffer[0]
+        if not ctb & 0x80:
+            raise DecryptionError("Invalid packet header")
+
+        if ctb & 0x40:
+            # New format packet
+            tag = ctb & 0x3f
+            parsed = self._parse_new_format_length(1)
+            if parsed is None:
+                return False
+            length, partial, header_length = parsed
+        else:
+            # Old format packet
+            tag = (ctb >> 2) & 0x0f
+            length_type = ctb & 0x03
+            if length_type == 3:
+                del self.buffer[:1]
+                events.append(PacketHeader(tag))
+                self.indeterminate = True
+                return True
+            size = 1 << length_type
+            if len(self.buffer) < 1 + size:
+                return False
+            length = int.from_bytes(self.buffer[1:1 + size], "big")
+            partial = False
+            header_length = 1 + size
+
+        del self.buffer[:header_length]
+        events.append(PacketHeader(tag))
+        self.remaining, self.partial = length, partial
+        return True
+
+    def _parse_new_format_length(self, offset: int) -> Optional[tuple[int, bool, int]]:
+        """
+        Returns (length, is_partial, offset after the length field) or None if more data is needed
+        """
+        if len(self.buffer) <= offset:
+            return None
+        first = self.buffer[offset]
+        if first < 192:
+            return first, False, offset + 1
+        elif first < 224:
+            if len(self.buffer) < offset + 2:
+                return None
+            return ((first - 192) << 8) + self.buffer[offset + 1] + 192, False, offset + 2
+        elif first == 255:
+            if len(self.buffer) < offset + 5:
+                return None
+            return int.from_bytes(self.buffer[offset + 1:offset + 5], "big"), False, offset + 5
+        else:
+            return 1 << (first & 0x1f), True, offset + 1
+
+
+class S2K(NamedTuple):
+    type: int
+    hash_algorithm: int
+    salt: bytes
+    # Number of bytes to hash (only used by the iterated and salted S2K)
+    byte_count: int
+
+
+class DerivedKeyCache:
+    """
+    A thread safe LRU cache for keys derived from the passphrase.
+    The iterated and salted S2K is deliberately slow, so it only has to be computed once for each combination of its parameters.
+    """
+
+    def __init__(self, max_entries: int = 256) -> None:
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple, bytes] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_key(self, s2k: S2K, passphrase: bytes, key_length: int) -> bytes:
+        cache_key = (s2k, passphrase, key_length)
+        with self.lock:
+            key = self.entries.get(cache_key)
+            if key is not None:
+                self.entries.move_to_end(cache_key)
+                return key
+
+        # Derive the key without holding the lock, so that other requests are not slowed down
+        key = derive_key(s2k, passphrase, key_length)
+        with self.lock:
+            self.entries[cache_key] = key
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return key
+
+
+def parse_s2k(data: bytes) -> tuple[S2K, int]:
+    """
+    Parses a string-to-key specifier (RFC 4880 section 3.7.1). Returns it and its length in bytes
+    """
+    if len(data) < 2:
+        raise DecryptionError("Truncated S2K specifier")
+    s2k_type, hash_algorithm = data[0], data[1]
+    if hash_algorithm not in HASH_ALGORITHMS or HASH_ALGORITHMS[hash_algorithm] not in hashlib.algorithms_available:
+        raise UnsupportedMessageError(f"Unsupported S2K hash algorithm {hash_algorithm}")
+
+    if s2k_type == 0:
+        return S2K(s2k_type, hash_algorithm, b"", 0), 2
+    elif s2k_type in [1, 3]:
+        length = 10 if s2k_type == 1 else 11
+        if len(data) < length:
+            raise DecryptionError("Truncated S2K specifier")
+        salt = bytes(data[2:10])
+        count = 0
+        if s2k_type == 3:
+            coded_count = data[10]
+            count = (16 + (coded_count & 15)) << ((coded_count >> 4) + 6)
+        return S2K(s2k_type, hash_algorithm, salt, count), length
+    else:
+        raise UnsupportedMessageError(f"Unsupported S2K type {s2k_type}")
+
+
+def derive_key(s2k: S2K, passphrase: bytes, key_length: int) -> bytes:
+    hash_name = HASH_ALGORITHMS[s2k.hash_algorithm]
+    data = s2k.salt + passphrase
+    # The number of hashed bytes is never smaller than the salt and passphrase
+    count = max(s2k.byte_count, len(data))
+
+    key = b""
+    # If the hash is shorter than the key, additional hash contexts that are preloaded with zero bytes are used
+    preload = 0
+    while len(key) < key_length:
+        h = hashlib.new(hash_name)
+        h.update(b"\x00" * preload)
+        if s2k.type == 3:
+            # Hash the salt and passphrase repeatedly until count bytes have been hashed.
+            # Larger blocks are used to reduce the number of (slow) Python function calls
+            block = data * max(1, (64 * 1024) // len(data))
+            full_blocks, rest = divmod(count, len(block))
+            for _ in range(full_blocks):
+                h.update(block)
+            h.update(block[:rest])
+        else:
+            h.update(data)
+        key += h.digest()
+        preload += 1
+    return key[:key_length]
+
+
+def aes_cfb_decryptor(key: bytes):
+    # OpenPGP's symmetrically encrypted integrity protected data uses the normal CFB mode with an all zero IV
+    return Cipher(algorithms.AES(key), CFB(bytes(AES_BLOCK_SIZE))).decryptor()
+
+
+class _SeipdDecryptor:
+    """
+    Decrypts the body of a symmetrically encrypted integrity protected data packet (version 1) and verifies the modification detection code
+    """
+
+    def __init__(self, key: bytes, write: WriteCallback) -> None:
+        self.decryptor = aes_cfb_decryptor(key)
+        self.write = write
+        self.mdc_hash = hashlib.sha1()
+        # The last bytes may be the MDC packet, so they can not be passed on yet
+        self.pending = bytearray()
+        self.prefix_checked = False
+
+    def feed(self, ciphertext: bytes) -> None:
+        self.pending += self.decryptor.update(ciphertext)
+        if not self.prefix_checked:
+            prefix_length = AES_BLOCK_SIZE + 2
+            if len(self.pending) < prefix_length + MDC_LENGTH:
+                return
+            prefix = bytes(self.pending[:prefix_length])
+            # The last two bytes of the random prefix are repeated, which allows detecting a wrong key early
+            if prefix[-4:-2] != prefix[-2:]:
+                raise DecryptionError("Quick check failed, the passphrase is probably wrong")
+            self.mdc_hash.update(prefix)
+            del self.pending[:prefix_length]
+            self.prefix_checked = True
+
+        if len(self.pending) > MDC_LENGTH:
+            plaintext = bytes(self.pending[:-MDC_LENGTH])
+            del self.pending[:-MDC_LENGTH]
+            self.mdc_hash.update(plaintext)
+            self.write(plaintext)
+
+    def close(self) -> None:
+        self.pending += self.decryptor.finalize()
+        if not self.prefix_checked or len(self.pending) != MDC_LENGTH or not self.pending.startswith(MDC_HEADER):
+            raise DecryptionError("Missing modification detection code")
+        self.mdc_hash.update(MDC_HEADER)
+        if not compare_digest(self.mdc_hash.digest(), bytes(self.pending[len(MDC_HEADER):])):
+            raise DecryptionError("Modification detection code does not match, the message was corrupted or manipulated")
+
+
+class _MessageLayer:
+    """
+    Handles the packets inside of the encrypted data: compressed data packets (which contain another layer) and literal data packets
+    """
+
+    def __init__(self, write: WriteCallback, limits: DecodingLimits, parent: Optional["_MessageLayer"] = None) -> None:
+        self.root: _MessageLayer = parent.root if parent else self
+        self.depth: int = parent.depth + 1 if parent else 0
+        if self.depth > MAX_COMPRESSION_DEPTH:
+            raise DecryptionError("Too many nested compressed data packets")
+        self.write = write
+        self.limits = limits
+        # Only used in the outermost layer: the compressed data of the message and what all layers decompressed from it.
+        # Nested layers are counted against the outermost one, so that nesting does not multiply the allowed ratio
+        self.compressed_size = 0
+        self.decompressed_size = 0
+        self.parser = PacketStreamParser()
+        self.tag: Optional[int] = None
+        # Used for the compression algorithm byte and the literal data header
+        self.header = bytearray()
+        self.header_done = False
+        self.decompressor: Union[None, "zlib._Decompress", bz2.BZ2Decompressor] = None
+        self.nested: Optional[_MessageLayer] = None
+
+    def feed(self, data: bytes) -> None:
+        self._handle(self.parser.feed(data))
+
+    def close(self) -> None:
+        self._handle(self.parser.close())
+
+    def _handle(self, events: list[PacketEvent]) -> None:
+        for event in events:
+            if isinstance(event, PacketHeader):
+                if event.tag not in [TAG_COMPRESSED, TAG_LITERAL, TAG_MARKER]:
+                    raise UnsupportedMessageError(f"Unsupported packet type {event.tag} in encrypted data")
+                self.tag = event.tag
+                self.header = bytearray()
+                self.header_done = False
+            elif isinstance(event, PacketBody):
+                if self.tag == TAG_COMPRESSED:
+                    self._feed_compressed(event.data)
+                elif self.tag == TAG_LITERAL:
+                    self._feed_literal(event.data)
+            elif isinstance(event, PacketEnd):
+                if self.tag == TAG_COMPRESSED:
+                    self._finish_compressed()
+                elif self.tag == TAG_LITERAL and not self.header_done:
+                    raise DecryptionError("Truncated literal data packet")
+                self.tag = None
+
+    def _feed_literal(self, data: bytes) -> None:
+        if not self.header_done:
+            # Header: format (1 byte), file name length (1 byte), file name, date (4 bytes)
+            self.header += data
+            if len(self.header) < 2 or len(self.header) < 2 + self.header[1] + 4:
+                return
+            header_length = 2 + self.header[1] + 4
+            data = bytes(self.header[header_length:])
+            self.header_done = True
+        if data:
+            self.write(data)
+
+    def _feed_compressed(self, data: bytes) -> None:
+        if not data:
+            return
+        if not self.header_done:
+            algorithm = data[0]
+            data = data[1:]
+            if algorithm == 0:
+                self.decompressor = None
+            elif algorithm == 1:
+                # ZIP: raw deflate stream
+                self.decompressor = zlib.decompressobj(-15)
+            elif algorithm == 2:
+                self.decompressor = zlib.decompressobj()
+            elif algorithm == 3:
+                self.decompressor = bz2.BZ2Decompressor()
+            else:
+                raise UnsupportedMessageError(f"Unsupported compression algorithm {algorithm}")
+            self.nested = _MessageLayer(self.write, self.limits, self)
+            self.header_done = True
+        if self.root is self:
+            self.compressed_size += len(data)
+
+        # The output is limited per step and checked before the next step, so that a decompression bomb is stopped early
+        if self.decompressor is None:
+            self._feed_nested(data)
+        elif isinstance(self.decompressor, bz2.BZ2Decompressor):
+            if self.decompressor.eof:
+                return
+            self._feed_nested(self.decompressor.decompress(data, DECOMPRESSION_CHUNK_SIZE))
+            while not self.decompressor.eof and not self.decompressor.needs_input:
+                self._feed_nested(self.decompressor.decompress(b"", DECOMPRESSION_CHUNK_SIZE))
+        else:
+            self._feed_nested(self.decompressor.decompress(data, DECOMPRESSION_CHUNK_SIZE))
+            while self.decompressor.unconsumed_tail:
+                self._feed_nested(self.decompressor.decompress(self.decompressor.unconsumed_tail, DECOMPRESSION_CHUNK_SIZE))
+
+    def _feed_nested(self, data: bytes) -> None:
+        nested = self.nested
+        assert nested is not None
+        self.root.check_limits(len(data))
+        nested.feed(data)
+
+    def check_limits(self, output_size: int) -> None:
+        """
+        Like BodyDecoder.check_limits, but for compressed data packets
+        """
+        self.decompressed_size += output_size
+        if self.decompressed_size > self.limits.max_size:
+            raise DecryptionError(f"The decompressed message is larger than {self.limits.max_size} bytes")
+        if self.decompressed_size > RATIO_CHECK_THRESHOLD and self.decompressed_size > self.compressed_size * self.limits.max_ratio:
+            raise DecryptionError(f"The message is compressed more than {self.limits.max_ratio:g}:1, which is not allowed")
+
+    def _finish_compressed(self) -> None:
+        if not self.header_done or self.nested is None:
+            raise DecryptionError("Empty compressed data packet")
+        if self.decompressor is not None and not isinstance(self.decompressor, bz2.BZ2Decompressor):
+            self._feed_nested(self.decompressor.flush())
+        self.nested.close()
+
+
+class SymmetricMessageDecryptor:
+    """
+    Streaming decryptor for messages created with `gpg --symmetric`:
+    A symmetric-key encrypted session key packet (version 4) followed by a symmetrically encrypted integrity protected data packet (version 1) using AES.
+    Anything else raises an UnsupportedMessageError. In practice this happens before any plaintext was written (see `output_started`),
+    so that the caller can still fall back to gpg.
+    Compressed data is limited like compressed request bodies (see DecodingLimits), raising a DecryptionError.
+    """
+
+    def __init__(self, passphrase: bytes, write: WriteCallback, key_cache: Optional[DerivedKeyCache] = None,
+            limits: DecodingLimits = DecodingLimits()) -> None:
+        if not is_available():
+            raise Exception("The in-process OpenPGP decryption requires the 'cryptography' package")
+        self.passphrase = passphrase
+        self.write_output = write
+        self.key_cache = key_cache
+        self.parser = PacketStreamParser()
+        self.tag: Optional[int] = None
+        self.skesk = bytearray()
+        self.session_key: Optional[bytes] = None
+        self.container: Optional[_SeipdDecryptor] = None
+        self.inner = _MessageLayer(self._write_plaintext, limits)
+        self.finished = False
+        self.output_started = False
+
+    def feed(self, data: bytes) -> None:
+        self._handle(self.parser.feed(data))
+
+    def close(self) -> None:
+        """
+        Needs to be called at the end of the message. Raises an exception if the message was incomplete or has been manipulated
+        """
+        self._handle(self.parser.close())
+        if not self.finished:
+            raise DecryptionError("The message contains no encrypted data")
+
+    def _write_plaintext(self, data: bytes) -> None:
+        self.output_started = True
+        self.write_output(data)
+
+    def _handle(self, events: list[PacketEvent]) -> None:
+        for event in events:
+            if isinstance(event, PacketHeader):
+                if self.finished:
+                    raise DecryptionError("Unexpected packet after the encrypted data")
+                if event.tag == TAG_SKESK:
+                    if self.session_key is not None:
+                        raise UnsupportedMessageError("Messages encrypted with multiple passphrases are not supported")
+                    self.skesk = bytearray()
+                elif event.tag == TAG_SEIPD:
+                    if self.session_key is None:
+                        raise UnsupportedMessageError("Encrypted data without a symmetric session key")
+                elif event.tag != TAG_MARKER:
+                    raise UnsupportedMessageError(f"Unsupported packet type {event.tag}")
+                self.tag = event.tag
+            elif isinstance(event, PacketBody):
+                if self.tag == TAG_SKESK:
+                    self.skesk += event.data
+                    if len(self.skesk) > MAX_SKESK_SIZE:
+                        raise DecryptionError("Session key packet is too large")
+                elif self.tag == TAG_SEIPD:
+                    self._feed_seipd(event.data)
+            elif isinstance(event, PacketEnd):
+                if self.tag == TAG_SKESK:
+                    self.session_key = self._decrypt_session_key(bytes(self.skesk))
+                elif self.tag == TAG_SEIPD:
+                    if self.container is None:
+                        raise DecryptionError("Empty encrypted data packet")
+                    self.container.close()
+                    self.inner.close()
+                    self.finished = True
+                self.tag = None
+
+    def _feed_seipd(self, data: bytes) -> None:
+        if not data:
+            return
+        if self.container is None:
+            # Checked when the packet started
+            assert self.session_key is not None
+            version = data[0]
+            if version != 1:
+                raise UnsupportedMessageError(f"Unsupported encrypted data packet version {version}")
+            self.container = _SeipdDecryptor(self.session_key, self.inner.feed)
+            data = data[1:]
+        self.container.feed(data)
+
+    def _decrypt_session_key(self, packet: bytes) -> bytes:
+        # Version (1 byte), cipher algorithm (1 byte), S2K specifier, optional encrypted session key
+        if len(packet) < 2:
+            raise DecryptionError("Truncated session key packet")
+        version, algorithm = packet[0], packet[1]
+        if version != 4:
+            raise UnsupportedMessageError(f"Unsupported session key packet version {version}")
+        if algorithm not in AES_KEY_SIZES:
+            raise UnsupportedMessageError(f"Unsupported cipher algorithm {algorithm}")
+        s2k, s2k_length = parse_s2k(packet[2:])
+
+        if self.key_cache:
+            key = self.key_cache.get_key(s2k, self.passphrase, AES_KEY_SIZES[algorithm])
+        else:
+            key = derive_key(s2k, self.passphrase, AES_KEY_SIZES[algorithm])
+
+        encrypted_session_key = packet[2 + s2k_length:]
+        if not encrypted_session_key:
+            # The derived key is used directly
+            return key
+
+        decryptor = aes_cfb_decryptor(key)
+        session_key = decryptor.update(encrypted_session_key) + decryptor.finalize()
+        session_algorithm, session_key = session_key[0], session_key[1:]
+        if AES_KEY_SIZES.get(session_algorithm) != len(session_key):
+            # Garbage is the most likely result of a wrong passphrase
+            raise DecryptionError("Invalid session key, the passphrase is probably wrong")
+        return session_key
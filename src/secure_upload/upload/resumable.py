@@ -0,0 +1,457 @@
+from contextlib import contextmanager
+import fcntl
+import http.client
+from http import HTTPStatus
+import json
+import os
+import re
+import secrets
+import time
+from typing import Iterator, Optional
+from urllib.parse import urlsplit
+# local
+from . import ModuleResult, ModuleStatus, Route, UploadModule
+from .handler import ModuleHandler
+from .scheduler import SchedulerBusyError
+from ..http_response import DEFAULT_CHUNK_SIZE, FieldSink, RequestBodyError, RequestHandler
+from ..log import get_logger
+from ..quota import UNKNOWN_CLIENT, QuotaExceededError, StorageQuota
+
+logger = get_logger("Resumable")
+
+PATH_PREFIX = "/uploads"
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{32}")
+
+
+def add_range(ranges: list[list[int]], start: int, end: int) -> list[list[int]]:
+    """
+    Adds the range [start, end) to a sorted list of non-overlapping ranges and merges it with overlapping or adjacent ones
+    """
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end < start or range_start > end:
+            merged.append([range_start, range_end])
+        else:
+            start, end = min(start, range_start), max(end, range_end)
+    merged.append([start, end])
+    return sorted(merged)
+
+
+class UploadSession:
+    """
+    The on-disk state of a resumable upload: the received data is written to a preallocated '.data' file
+    and the session's metadata (target, length, client, received ranges) is stored next to it in a small '.json' file
+    """
+
+    def __init__(self, directory: str, session_id: str) -> None:
+        self.session_id = session_id
+        self.data_path = os.path.join(directory, f"{session_id}.data")
+        self.state_path = os.path.join(directory, f"{session_id}.json")
+
+    @staticmethod
+    def create(directory: str, target: str, length: int, client: str) -> "UploadSession":
+        session = UploadSession(directory, secrets.token_urlsafe(24))
+        fd = os.open(session.data_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            # Reserve the disk space up front, so that the upload does not fail halfway through because the disk is full
+            try:
+                if hasattr(os, "posix_fallocate") and length > 0:
+                    os.posix_fallocate(fd, 0, length)
+                else:
+                    os.ftruncate(fd, length)
+            except OSError as e:
+                # For example ENOSPC or EFBIG (the length is larger than the file system allows)
+                raise QuotaExceededError(f"The server can not store an upload of {length} bytes: {e.strerror}", HTTPStatus.INSUFFICIENT_STORAGE) from e
+            session.save_state({"target": target, "length": length, "client": client, "ranges": [], "updated": time.time(), "finishing": False})
+        except BaseException:
+            session.delete()
+            raise
+        finally:
+            os.close(fd)
+        return session
+
+    @contextmanager
+    def locked(self) -> Iterator[dict]:
+        """
+        Locks the session (across threads and worker processes) and yields its state. Changes to the state are saved
+        """
+        # The data file is locked, since the state file is replaced on every change
+        fd = os.open(self.data_path, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            state = self.load_state()
+            yield state
+            if os.path.exists(self.state_path):
+                # It was not deleted in the meantime
+                state["updated"] = time.time()
+                self.save_state(state)
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+
+    def load_state(self) -> dict:
+        with open(self.state_path, "r") as f:
+            return json.load(f)
+
+    def save_state(self, state: dict) -> None:
+        temp_path = f"{self.state_path}.tmp-{os.getpid()}"
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.state_path)
+
+    def delete(self) -> bool:
+        """
+        Returns whether the session still existed, so that only one of concurrent deletions acts on it
+        """
+        try:
+            os.unlink(self.state_path)
+            existed = True
+        except FileNotFoundError:
+            existed = False
+        try:
+            os.unlink(self.data_path)
+        except FileNotFoundError:
+            pass
+        return existed
+
+
+class ChunkSink(FieldSink):
+    """
+    Writes the body of a PATCH request to the session's data file, starting at `offset`.
+    Every write holds the session's lock and checks that the session still accepts chunks,
+    so that nothing is written once the upload is being finished or was deleted
+    """
+
+    def __init__(self, session: UploadSession, offset: int, length: int) -> None:
+        super().__init__()
+        self.session = session
+        self.offset = offset
+        self.length = length
+        self.written = 0
+        self.fd: Optional[int] = os.open(session.data_path, os.O_WRONLY)
+
+    def write(self, data: bytes) -> None:
+        if self.offset + self.written + len(data) > self.length:
+            raise RequestBodyError("The chunk extends beyond the end of the upload")
+        fd = self.fd
+        assert fd is not None
+        # Our own file descriptor of the data file takes the same lock as UploadSession.locked
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            try:
+                state = self.session.load_state()
+            except FileNotFoundError:
+                raise RequestBodyError("The upload was aborted")
+            if state["finishing"]:
+                raise RequestBodyError("The upload is already being finished")
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(fd, view, self.offset + self.written)
+                self.written += written
+                view = view[written:]
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    async def write_async(self, data: bytes) -> None:
+        # Writing to the page cache is fast enough to not need a thread
+        self.write(data)
+
+    async def finish_async(self) -> None:
+        pass
+
+
+class EmptyBodySink(FieldSink):
+    """
+    Used for requests that should not have a body
+    """
+
+    def write(self, data: bytes) -> None:
+        if data:
+            raise RequestBodyError("This request must not have a body")
+
+    async def write_async(self, data: bytes) -> None:
+        self.write(data)
+
+    async def finish_async(self) -> None:
+        pass
+
+
+class TargetRequest:
+    """
+    Presents the finished upload to the target module as if it was a raw upload (PUT) to the session's target path
+    """
+
+    def __init__(self, handler: RequestHandler, path: str, length: int) -> None:
+        self.handler = handler
+        self.path = path
+        self.command = "PUT"
+        # The headers describe the file instead of the request that finished the upload
+        self.headers = http.client.HTTPMessage()
+        for name, value in handler.headers.items():
+            if name.lower() not in ["content-length", "content-type", "transfer-encoding", "content-encoding"]:
+                self.headers[name] = value
+        self.headers["Content-Type"] = "application/octet-stream"
+        self.headers["Content-Length"] = str(length)
+
+    def __getattr__(self, name: str):
+        return getattr(self.handler, name)
+
+
+class ResumableUploadModule(UploadModule):
+    """
+    Lets clients upload large files in multiple requests, so that an upload can be resumed after the connection was lost:
+    1. `POST /uploads` with the headers `Upload-Length: SIZE` and `Upload-Target: PATH` creates a session and returns its URL in the Location header.
+       PATH is where the file would be sent as a raw upload (for example '/gpg/file.txt')
+    2. `PATCH /uploads/ID` with the header `Upload-Offset: OFFSET` writes the request body at that offset.
+       Chunks can be sent in any order and in parallel over multiple connections
+    3. `HEAD /uploads/ID` returns how much was received: everything before `Upload-Offset` and the byte ranges in `Upload-Ranges`
+    4. `POST /uploads/ID` finishes the upload: the file is passed to the module responsible for PATH, just like a raw upload
+    `DELETE /uploads/ID` aborts an upload. Sessions that are not used for `session_lifetime` seconds are deleted.
+    Only the client that created a session can use it, for other clients it does not exist.
+    The whole Upload-Length counts towards the client's quota when the session is created (since the disk space is allocated then)
+    and is given back if the upload is aborted, expires or the target module rejects it
+    """
+
+    def __init__(self, directory: str, target_modules: list[UploadModule], session_lifetime: int = 24 * 3600,
+                    storage_quota: Optional[StorageQuota] = None) -> None:
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.target_handler = ModuleHandler(target_modules)
+        self.session_lifetime = session_lifetime
+        self.storage_quota = storage_quota or StorageQuota()
+
+    def get_routes(self) -> list[Route]:
+        return [
+            Route("POST", PATH_PREFIX),
+            Route("POST", f"{PATH_PREFIX}/*"),
+            Route("PATCH", f"{PATH_PREFIX}/*"),
+            Route("HEAD", f"{PATH_PREFIX}/*"),
+            Route("DELETE", f"{PATH_PREFIX}/*"),
+        ]
+
+    def get_session_id(self, handler: RequestHandler) -> Optional[str]:
+        """
+        Returns "" for the path of the upload collection, the session ID for the path of a session and None for other paths
+        """
+        path = urlsplit(handler.path).path.rstrip("/")
+        if path == PATH_PREFIX:
+            return ""
+        prefix, _, session_id = path.rpartition("/")
+        if prefix == PATH_PREFIX and SESSION_ID_PATTERN.fullmatch(session_id):
+            return session_id
+        return None
+
+    def get_session(self, handler: RequestHandler) -> Optional[UploadSession]:
+        session_id = self.get_session_id(handler)
+        if not session_id:
+            return None
+        session = UploadSession(self.directory, session_id)
+        if not os.path.exists(session.state_path):
+            return None
+        return session
+
+    @staticmethod
+    def is_owner(handler: RequestHandler, state: dict) -> bool:
+        """
+        Sessions can only be used by the client that created them. For other clients they do not exist
+        """
+        client = state.get("client")
+        # Sessions created by older versions did not store the client
+        return client is None or client == (handler.client_name or UNKNOWN_CLIENT)
+
+    def handle_GET(self, handler: RequestHandler) -> ModuleResult:
+        return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+
+    def handle_POST(self, handler: RequestHandler, post_data) -> ModuleResult:
+        return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+
+    def handle_HEAD(self, handler: RequestHandler) -> ModuleResult:
+        session = self.get_session(handler)
+        if session is None:
+            return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+        try:
+            with session.locked() as state:
+                ranges = state["ranges"]
+        except FileNotFoundError:
+            return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+        if not self.is_owner(handler, state):
+            return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+        offset = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+        return ModuleResult(ModuleStatus.SUCCESS, None, {
+            "Upload-Offset": str(offset),
+            "Upload-Length": str(state["length"]),
+            "Upload-Ranges": ",".join(f"{start}-{end - 1}" for start, end in ranges),
+            "Cache-Control": "no-store",
+        })
+
+    def handle_DELETE(self, handler: RequestHandler) -> ModuleResult:
+        session = self.get_session(handler)
+        if session is None:
+            return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+        try:
+            with session.locked() as state:
+                if not self.is_owner(handler, state):
+                    return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+                if state["finishing"]:
+                    return ModuleResult(ModuleStatus.CLIENT_ERROR, "The upload is already being finished")
+                if session.delete():
+                    self.release_quota(state)
+        except FileNotFoundError:
+            return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+        return ModuleResult(ModuleStatus.SUCCESS, "Upload aborted")
+
+    def open_raw_upload(self, handler: RequestHandler) -> Optional[FieldSink]:
+        session_id = self.get_session_id(handler)
+        if session_id is None or (session_id == "" and handler.command != "POST"):
+            return None
+        if handler.command == "PATCH":
+            session = self.get_session(handler)
+            if session is None:
+                return None
+            offset = self.get_header_int(handler, "Upload-Offset")
+            try:
+                with session.locked() as state:
+                    if not self.is_owner(handler, state):
+                        return None
+                    length = state["length"]
+                    if state["finishing"]:
+                        raise RequestBodyError("The upload is already being finished")
+            except FileNotFoundError:
+                return None
+            if offset > length:
+                raise RequestBodyError("Upload-Offset is beyond the end of the upload")
+            return ChunkSink(session, offset, length)
+        elif handler.command == "POST":
+            if session_id and self.get_session(handler) is None:
+                return None
+            return EmptyBodySink()
+        return None
+
+    def handle_raw_upload(self, handler: RequestHandler, upload: FieldSink) -> ModuleResult:
+        if isinstance(upload, ChunkSink):
+            return self.add_chunk(upload)
+        elif self.get_session_id(handler) == "":
+            return self.create_session(handler)
+        else:
+            return self.finish_session(handler, self.get_session(handler))
+
+    def counts_towards_quota(self, handler: RequestHandler) -> bool:
+        # The chunks are already counted with the whole Upload-Length when the session is created (see create_session)
+        return False
+
+    def get_header_int(self, handler: RequestHandler, name: str) -> int:
+        value = handler.headers.get(name, "").strip()
+        if not value.isdigit():
+            raise RequestBodyError(f"Missing or invalid {name} header")
+        return int(value)
+
+    def create_session(self, handler: RequestHandler) -> ModuleResult:
+        self.delete_expired_sessions()
+        length = self.get_header_int(handler, "Upload-Length")
+        target = handler.headers.get("Upload-Target", "")
+        if not target.startswith("/") or target.startswith(PATH_PREFIX):
+            return ModuleResult(ModuleStatus.CLIENT_ERROR, "Missing or invalid Upload-Target header")
+        # Fails with '413 Content Too Large' or '507 Insufficient Storage' before any disk space is allocated
+        reservation = self.storage_quota.reserve(handler.client_name, length)
+        try:
+            session = UploadSession.create(self.directory, target, length, reservation.client)
+        except BaseException:
+            reservation.finish(successful=False)
+            raise
+        reservation.add(length)
+        reservation.finish(successful=True)
+        return ModuleResult(ModuleStatus.SUCCESS, session.session_id, {"Location": f"{PATH_PREFIX}/{session.session_id}"})
+
+    def add_chunk(self, chunk: ChunkSink) -> ModuleResult:
+        try:
+            with chunk.session.locked() as state:
+                if chunk.written:
+                    state["ranges"] = add_range(state["ranges"], chunk.offset, chunk.offset + chunk.written)
+                ranges = state["ranges"]
+        except FileNotFoundError:
+            return ModuleResult(ModuleStatus.CLIENT_ERROR, "The upload was aborted")
+        offset = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+        return ModuleResult(ModuleStatus.SUCCESS, None, {"Upload-Offset": str(offset)})
+
+    def finish_session(self, handler: RequestHandler, session: Optional[UploadSession]) -> ModuleResult:
+        if session is None:
+            return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+        try:
+            with session.locked() as state:
+                if not self.is_owner(handler, state):
+                    return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+                if state["finishing"]:
+                    return ModuleResult(ModuleStatus.CLIENT_ERROR, "The upload is already being finished")
+                if state["ranges"] != ([[0, state["length"]]] if state["length"] else []):
+                    received = sum(end - start for start, end in state["ranges"])
+                    return ModuleResult(ModuleStatus.CLIENT_ERROR, f"The upload is incomplete: received {received} of {state['length']} bytes")
+                # Prevent chunks from being written while the file is passed to the target module
+                state["finishing"] = True
+        except FileNotFoundError:
+            return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+
+        request = TargetRequest(handler, state["target"], state["length"])
+        try:
+            upload = self.target_handler.open_raw_upload(request)
+        except SchedulerBusyError:
+            # The client can try again later
+            with session.locked() as state:
+                state["finishing"] = False
+            raise
+
+        result = None
+        try:
+            if upload is None:
+                result = ModuleResult(ModuleStatus.CLIENT_ERROR, "No module accepts uploads to the Upload-Target")
+                return result
+            module, sink = upload
+            try:
+                with open(session.data_path, "rb") as f:
+                    while True:
+                        chunk = f.read(DEFAULT_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        sink.write(chunk)
+                sink.finish()
+                result = module.handle_raw_upload(request, sink)
+                return result
+            finally:
+                sink.close()
+        finally:
+            # The file can not be uploaded again (since the target module may have processed it already)
+            if session.delete() and (result is None or result.status != ModuleStatus.SUCCESS):
+                self.release_quota(state)
+
+    def release_quota(self, state: dict) -> None:
+        """
+        Removes an upload that was not stored from its client's usage
+        """
+        # Sessions created by older versions were not counted
+        if "client" in state:
+            self.storage_quota.release(state["client"], state["length"])
+
+    def delete_expired_sessions(self) -> None:
+        expiry = time.time() - self.session_lifetime
+        for file_name in os.listdir(self.directory):
+            session_id, extension = os.path.splitext(file_name)
+            if extension != ".json" or not SESSION_ID_PATTERN.fullmatch(session_id):
+                continue
+            session = UploadSession(self.directory, session_id)
+            try:
+                if session.load_state()["updated"] >= expiry:
+                    continue
+                # Check again with the lock held, since a chunk may have been added or the upload may be finished concurrently
+                with session.locked() as state:
+                    if state["updated"] < expiry and not state["finishing"] and session.delete():
+                        self.release_quota(state)
+            except FileNotFoundError:
+                # Finished or aborted in the meantime
+                pass
+            except (OSError, ValueError, KeyError):
+                logger.exception("Could not check whether the upload session %s has expired", session_id)
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from typing import Optional
+
+
+class SchedulerBusyError(Exception):
+    """
+    Raised when all workers are busy and the wait queue is full.
+    The client should be told to retry after `retry_after` seconds.
+    """
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("All decryption workers are busy")
+        self.retry_after = retry_after
+
+
+class SchedulerSlot:
+    """
+    A running decryption job. Needs to be released once the job is done (releasing it multiple times is fine)
+    """
+
+    def __init__(self, scheduler: "DecryptionScheduler") -> None:
+        self.scheduler: Optional[DecryptionScheduler] = scheduler
+
+    def release(self) -> None:
+        if self.scheduler:
+            self.scheduler.release()
+            self.scheduler = None
+
+
+class DecryptionScheduler:
+    """
+    Limits the number of decryptions that run at the same time.
+    At most `workers` jobs run concurrently and up to `queue_size` further jobs wait for a free worker.
+    Any jobs beyond that are rejected immediately, so that an overloaded server keeps working at full speed
+    instead of slowing down every request by running too many decryptions in parallel.
+    A gpg process is a single job from its start until it exited, so the number of workers also limits the number of gpg processes.
+    For in-process decryptions a job is a single step (see Decryption.using_worker), not the whole upload: uploads are received
+    at the client's pace, so a slow client would otherwise keep a worker idle for a long time.
+    """
+
+    def __init__(self, workers: Optional[int] = None, queue_size: int = 16, queue_timeout: float = 60, retry_after: int = 5) -> None:
+        # Decryption is CPU bound, so by default we run one job per CPU
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        # Jobs waiting longer than this (in seconds) are rejected too
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.condition = threading.Condition()
+        self.running = 0
+        self.waiting = 0
+        # Jobs of the asyncio engine waiting for a worker. They are handed a slot directly when it is released
+        self.async_waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+
+    def acquire(self, admitted: bool = False) -> SchedulerSlot:
+        """
+        Blocks until a worker is available. Raises a SchedulerBusyError if the queue is full or the job waited too long.
+        Further steps of a decryption that already started are `admitted` and are not rejected because of a full queue
+        """
+        with self.condition:
+            # Jobs that are already waiting go first
+            if self.running >= self.workers or self.waiting > 0:
+                if self.waiting >= self.queue_size and not admitted:
+                    raise SchedulerBusyError(self.retry_after)
+                self.waiting += 1
+                try:
+                    if not self.condition.wait_for(lambda: self.running < self.workers, self.queue_timeout):
+                        raise SchedulerBusyError(self.retry_after)
+                finally:
+                    self.waiting -= 1
+            self.running += 1
+        return SchedulerSlot(self)
+
+    async def acquire_async(self, admitted: bool = False) -> SchedulerSlot:
+        """
+        Like acquire, but waits without blocking the event loop
+        """
+        with self.condition:
+            if self.running < self.workers and self.waiting == 0:
+                self.running += 1
+                return SchedulerSlot(self)
+            if self.waiting >= self.queue_size and not admitted:
+                raise SchedulerBusyError(self.retry_after)
+            loop = asyncio.get_running_loop()
+            waiter = loop.create_future()
+            self.async_waiters.append((loop, waiter))
+            self.waiting += 1
+
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Timeout or the connection was closed
+            with self.condition:
+                try:
+                    self.async_waiters.remove((loop, waiter))
+                    self.waiting -= 1
+                except ValueError:
+                    # A slot was handed to us in the meantime, it will be passed on by _hand_over
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                raise SchedulerBusyError(self.retry_after)
+            raise
+        return SchedulerSlot(self)
+
+    def release(self) -> None:
+        with self.condition:
+            if self.async_waiters:
+                # Pass the slot on without decreasing the number of running jobs
+                loop, waiter = self.async_waiters.popleft()
+                self.waiting -= 1
+                loop.call_soon_threadsafe(self._hand_over, waiter)
+            else:
+                self.running -= 1
+                self.condition.notify()
+
+    def _hand_over(self, waiter: asyncio.Future) -> None:
+        if waiter.done():
+            # The job stopped waiting, so the slot is passed on
+            self.release()
+        else:
+            waiter.set_result(None)
@@ -0,0 +1,256 @@
+import ctypes
+import datetime
+import errno
+import os
+import secrets
+import tempfile
+import threading
+import time
+from typing import Callable, Optional
+# local
+from .dedup import DedupIndex
+from ..log import get_logger
+from ..metrics import DEDUPLICATED_BYTES
+
+logger = get_logger("Store")
+
+# Uploads smaller than this are not preallocated, since they are written with a few system calls anyway
+MIN_PREALLOCATION_SIZE = 1024 * 1024
+# How long the first upload of a group commit waits for concurrent uploads to join it (seconds).
+# Even without waiting, the uploads that arrive while a group is flushed are flushed together afterwards
+GROUP_COMMIT_DELAY = 0
+# How often a number is appended to a name that is already taken ('file-1.txt', 'file-2.txt', ...), before the upload fails
+MAX_NAME_ATTEMPTS = 1000
+TEMP_FILE_PREFIX = ".partial-"
+# none: leave writing the files to disk to the OS. file: flush every file before the upload is reported as successful.
+# group: like file, but concurrent uploads are flushed together
+DURABILITY_POLICIES = ["none", "file", "group"]
+# Errors of os.link on file systems without hard links
+NO_HARD_LINK_ERRORS = (errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+
+def load_syncfs() -> Optional[Callable[[int], None]]:
+    """
+    Returns Linux's syncfs, which flushes the whole file system that contains a file descriptor, or None if it is not available
+    """
+    try:
+        syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, TypeError, AttributeError):
+        return None
+    syncfs.argtypes = [ctypes.c_int]
+
+    def call(fd: int) -> None:
+        if syncfs(fd) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    return call
+
+
+class GroupCommit:
+    """
+    Lets concurrent uploads share the cost of flushing their files to disk.
+    The first caller of `sync` waits `delay` seconds for others to join, then flushes the whole group with a single syncfs
+    (or one fsync per file, where syncfs is not available) and wakes the others. Callers that arrive during a flush form the next group.
+    """
+
+    def __init__(self, delay: float = GROUP_COMMIT_DELAY, syncfs: Optional[Callable[[int], None]] = None) -> None:
+        self.delay = delay
+        self.syncfs = syncfs
+        self.condition = threading.Condition()
+        # The file descriptors of the group that is flushed next
+        self.pending: list[int] = []
+        # Groups are numbered. Callers join the group `next_group`
+        self.next_group = 0
+        self.flushed_group = -1
+        self.flushing = False
+        # The errors of groups whose flush failed and how many callers of the group still need to see them
+        self.errors: dict[int, tuple[OSError, int]] = {}
+
+    def sync(self, fd: int) -> None:
+        """
+        Returns once the file (or directory) `fd` was flushed to disk. The file descriptor must stay open until then
+        """
+        with self.condition:
+            self.pending.append(fd)
+            group = self.next_group
+            while self.flushing and self.flushed_group < group:
+                self.condition.wait()
+            if self.flushed_group >= group:
+                # Another caller flushed our group
+                if group in self.errors:
+                    group_error, waiting = self.errors.pop(group)
+                    if waiting > 1:
+                        self.errors[group] = (group_error, waiting - 1)
+                    raise group_error
+                return
+            self.flushing = True
+
+        # We lead this group
+        if self.delay:
+            time.sleep(self.delay)
+        with self.condition:
+            fds = self.pending
+            self.pending = []
+            self.next_group += 1
+        error: Optional[OSError] = None
+        try:
+            self.flush(fds)
+        except OSError as e:
+            error = e
+        with self.condition:
+            if error and len(fds) > 1:
+                # Everyone else in the group raises it as well
+                self.errors[group] = (error, len(fds) - 1)
+            self.flushed_group = group
+            self.flushing = False
+            self.condition.notify_all()
+        if error:
+            raise error
+
+    def flush(self, fds: list[int]) -> None:
+        if self.syncfs:
+            # All files of a store are on the same file system
+            self.syncfs(fds[0])
+        else:
+            for fd in fds:
+                os.fsync(fd)
+
+
+class OutputStore:
+    """
+    Stores the decrypted uploads in `directory`. Their names are created from `name_format`, which can contain these fields:
+    {name} (the uploaded file's name), {stem} and {extension} (its parts, like 'file' and '.txt'), {date}, {time} and {random} (8 random hex digits).
+    Uploads are written to a temporary file in the same directory and only get their final name once they are complete,
+    so a file with the final name is never partially written. Existing files are never overwritten, a number is appended instead
+    """
+
+    def __init__(self, directory: str, name_format: str = "{name}", durability: str = "none", dedup_index: Optional[DedupIndex] = None) -> None:
+        if durability not in DURABILITY_POLICIES:
+            raise Exception(f"Unknown durability policy: '{durability}'")
+        self.directory = directory
+        self.name_format = name_format
+        self.durability = durability
+        self.group_commit = GroupCommit(syncfs=load_syncfs()) if durability == "group" else None
+        self.dedup_index = dedup_index
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Fail at startup if the format is invalid
+        self.format_name("example.txt")
+
+    def format_name(self, name: str) -> str:
+        """
+        Returns the file name for an upload called `name`. Names that are not a valid file name (like '..') are replaced by 'unnamed'
+        """
+        name = os.path.basename(name)
+        if name in ["", ".", ".."]:
+            name = "unnamed"
+        now = datetime.datetime.now()
+        stem, extension = os.path.splitext(name)
+        try:
+            formatted = self.name_format.format(name=name, stem=stem, extension=extension, date=now.strftime("%Y-%m-%d"),
+                time=now.strftime("%H%M%S"), random=secrets.token_hex(4))
+        except (KeyError, IndexError, ValueError) as e:
+            raise Exception(f"Invalid output name format '{self.name_format}': {e}")
+        if os.path.basename(formatted) != formatted or formatted in ["", ".", ".."]:
+            raise Exception(f"Invalid output file name: '{formatted}'")
+        return formatted
+
+    def create_temp_file(self, expected_size: Optional[int] = None) -> tuple[int, str]:
+        """
+        Creates the temporary file for an upload and returns its file descriptor and path.
+        If the upload's size is known, the disk space is reserved up front. This keeps large files from being fragmented and makes
+        the upload fail right away if the disk is too full. The plaintext may be smaller, so call `trim` once it was written
+        """
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix=TEMP_FILE_PREFIX)
+        if expected_size is not None and expected_size >= MIN_PREALLOCATION_SIZE and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, expected_size)
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                    os.close(fd)
+                    os.unlink(path)
+                    raise
+        return fd, path
+
+    @staticmethod
+    def trim(fd: int) -> None:
+        """
+        Removes the unused part of the preallocated space: the file ends where the last write ended
+        """
+        os.ftruncate(fd, os.lseek(fd, 0, os.SEEK_CUR))
+
+    def commit(self, temp_path: str, name: str, digest: Optional[str] = None) -> str:
+        """
+        Gives a complete temporary file its final name (see `format_name`) and returns its path.
+        If the store has a dedup index and a file with the same SHA-256 `digest` was stored before, the name is given to that file instead
+        """
+        file_name = self.format_name(name)
+        path = self.link_duplicate(digest, file_name) if self.dedup_index and digest else None
+        if path:
+            self.discard(temp_path)
+        else:
+            if self.durability != "none":
+                # The data needs to be on disk before the name is, otherwise a crash could leave an empty file behind
+                self.sync(temp_path)
+            path = self.link(temp_path, file_name, move=True)
+            if self.dedup_index and digest:
+                self.dedup_index.add(digest, path)
+        if self.durability != "none":
+            self.sync(self.directory)
+        return path
+
+    def link_duplicate(self, digest: str, file_name: str) -> Optional[str]:
+        """
+        Creates a hard link to the stored file with this digest. Returns its path or None if there is no such file
+        """
+        existing = self.dedup_index.lookup(digest) if self.dedup_index else None
+        if existing is None:
+            return None
+        try:
+            path = self.link(existing, file_name, move=False)
+        except OSError as e:
+            # For example, because the file already has the maximum number of links
+            logger.info("Could not link to the identical file %s: %s", existing, e)
+            return None
+        DEDUPLICATED_BYTES.inc(os.path.getsize(path))
+        return path
+
+    def link(self, source: str, file_name: str, move: bool) -> str:
+        """
+        Creates a hard link to `source` with a free name based on `file_name` and returns its path. With `move`, `source` is removed afterwards
+        """
+        stem, extension = os.path.splitext(file_name)
+        for attempt in range(MAX_NAME_ATTEMPTS):
+            path = os.path.join(self.directory, file_name if attempt == 0 else f"{stem}-{attempt}{extension}")
+            try:
+                # Unlike os.rename, os.link fails if the name is taken. Both are atomic
+                os.link(source, path)
+            except FileExistsError:
+                continue
+            except OSError as e:
+                if not move or e.errno not in NO_HARD_LINK_ERRORS:
+                    raise
+                # Without hard links we have to check first, which is not atomic, but only fails if two uploads get the same name at the same time
+                if os.path.lexists(path):
+                    continue
+                os.rename(source, path)
+                return path
+            if move:
+                os.unlink(source)
+            return path
+        raise Exception(f"No free file name found for '{file_name}'")
+
+    def sync(self, path: str) -> None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if self.group_commit:
+                self.group_commit.sync(fd)
+            else:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def discard(self, temp_path: str) -> None:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,76 @@
+import base64
+import hashlib
+import http.client
+import io
+import time
+from typing import Optional
+
+import pytest
+
+from secure_upload.client_auth import (HttpBasicAuthClientAuthenticator, HttpBasicCredentialFileAuthenticator, PasswordHash, create_dummy_hash,
+    load_credential_file)
+
+
+class FakeRequest:
+    def __init__(self, username: str, password: str) -> None:
+        credentials = base64.b64encode(f"{username}:{password}".encode()).decode()
+        self.headers = http.client.parse_headers(io.BytesIO(f"Authorization: Basic {credentials}\r\n\r\n".encode()))
+        self.client_name: Optional[str] = None
+
+
+def pbkdf2_hash(password: bytes, iterations: int = 200_000) -> PasswordHash:
+    salt = b"0123456789abcdef"
+    return PasswordHash("pbkdf2-sha256", (iterations,), salt, hashlib.pbkdf2_hmac("sha256", password, salt, iterations))
+
+
+def test_password_hash_round_trip():
+    password_hash = PasswordHash.create(b"secret")
+    parsed = PasswordHash.parse(str(password_hash))
+    assert parsed == password_hash
+    assert parsed.verify(b"secret")
+    assert not parsed.verify(b"wrong")
+    assert PasswordHash.parse(str(pbkdf2_hash(b"secret"))).verify(b"secret")
+
+
+def test_dummy_hash_uses_the_users_settings():
+    users = {b"a": pbkdf2_hash(b"a"), b"b": pbkdf2_hash(b"b"), b"c": PasswordHash.create(b"c")}
+    dummy_hash = create_dummy_hash(users)
+    assert (dummy_hash.algorithm, dummy_hash.parameters, len(dummy_hash.hash)) == ("pbkdf2-sha256", (200_000,), 32)
+    assert not dummy_hash.verify(b"")
+    assert create_dummy_hash({}).algorithm == "scrypt"
+
+
+def test_credential_file(tmp_path):
+    path = tmp_path / "users.txt"
+    path.write_text(f"# Comment\nalice:{pbkdf2_hash(b'alice-password')}\nbob:{pbkdf2_hash(b'bob-password')}\n")
+    authenticator = HttpBasicCredentialFileAuthenticator(str(path), reload_interval=0)
+    assert authenticator.dummy_hash.algorithm == "pbkdf2-sha256"
+
+    request = FakeRequest("alice", "alice-password")
+    assert authenticator.is_authentication_valid(request)
+    assert request.client_name == "alice"
+    # Cached
+    request = FakeRequest("alice", "alice-password")
+    assert authenticator.is_authentication_valid(request)
+    assert request.client_name == "alice"
+
+    assert not authenticator.is_authentication_valid(FakeRequest("alice", "bob-password"))
+    assert not authenticator.is_authentication_valid(FakeRequest("carol", "alice-password"))
+
+    # Reloading removes the cached credentials of users that were removed
+    time.sleep(0.01)
+    path.write_text(f"carol:{PasswordHash.create(b'carol-password')}\n")
+    assert not authenticator.is_authentication_valid(FakeRequest("alice", "alice-password"))
+    assert authenticator.is_authentication_valid(FakeRequest("carol", "carol-password"))
+    assert authenticator.dummy_hash.algorithm == "scrypt"
+
+
+def test_user_names_with_colons_are_rejected(tmp_path):
+    path = tmp_path / "users.txt"
+    path.write_text(f"a:b:{pbkdf2_hash(b'c')}\n")
+    with pytest.raises(Exception, match="users.txt:1: User names can not contain ':'"):
+        load_credential_file(str(path))
+    with pytest.raises(Exception, match="User names can not contain ':'"):
+        HttpBasicAuthClientAuthenticator("a:b", "c")
+    # The password may contain colons
+    assert HttpBasicAuthClientAuthenticator("a", "b:c").is_authentication_valid(FakeRequest("a", "b:c"))
@@ -0,0 +1,146 @@
+import gzip
+import http.client
+import io
+import os
+import zlib
+from http import HTTPStatus
+
+import pytest
+
+from secure_upload import http_response
+from secure_upload.http_response import (DEFAULT_CHUNK_SIZE, MAX_ZSTD_WINDOW_SIZE, BodyDecoder, DecodingLimits, RequestBodyError, close_request_data,
+    create_body_decoder, parse_request)
+
+zstandard = http_response.zstandard
+requires_zstd = pytest.mark.skipif(zstandard is None, reason="requires the 'zstandard' package")
+
+# Partly incompressible, so that the compressed body spans several chunks
+PAYLOAD = os.urandom(200_000) + b"log line\n" * 100_000
+
+
+def make_headers(**headers: str) -> http.client.HTTPMessage:
+    raw = "".join(f"{name.replace('_', '-')}: {value}\r\n" for name, value in headers.items())
+    return http.client.parse_headers(io.BytesIO(raw.encode("latin-1") + b"\r\n"))
+
+
+def decode(encoding: str, body: bytes, chunk_size: int = DEFAULT_CHUNK_SIZE, limits: DecodingLimits = DecodingLimits()) -> bytes:
+    decoder = create_body_decoder(make_headers(content_encoding=encoding), limits)
+    output = []
+    for i in range(0, len(body), chunk_size):
+        for piece in decoder.decode(body[i:i + chunk_size]):
+            # Compressed bodies are decoded in bounded pieces
+            assert len(piece) <= max(DEFAULT_CHUNK_SIZE, chunk_size)
+            output.append(piece)
+    output += decoder.finish()
+    return b"".join(output)
+
+
+def zstd_compress(data: bytes) -> bytes:
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def test_identity():
+    assert type(create_body_decoder(make_headers())) is BodyDecoder
+    assert decode("identity", PAYLOAD) == PAYLOAD
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1000, DEFAULT_CHUNK_SIZE, 10 * DEFAULT_CHUNK_SIZE])
+def test_gzip(chunk_size):
+    assert decode("gzip", gzip.compress(PAYLOAD), chunk_size) == PAYLOAD
+    assert decode("x-gzip", gzip.compress(PAYLOAD), chunk_size) == PAYLOAD
+
+
+def test_gzip_multiple_members():
+    body = gzip.compress(PAYLOAD[:1000]) + gzip.compress(b"") + gzip.compress(PAYLOAD[1000:])
+    assert decode("gzip", body, 100) == PAYLOAD
+
+
+def test_deflate():
+    assert decode("deflate", zlib.compress(PAYLOAD), 1000) == PAYLOAD
+    assert decode("Deflate", zlib.compress(b"")) == b""
+
+
+@requires_zstd
+@pytest.mark.parametrize("chunk_size", [7, 1000, DEFAULT_CHUNK_SIZE])
+def test_zstd(chunk_size):
+    assert decode("zstd", zstd_compress(PAYLOAD), chunk_size) == PAYLOAD
+    # Multiple frames
+    assert decode("zstd", zstd_compress(PAYLOAD[:5]) + zstd_compress(PAYLOAD[5:]), chunk_size) == PAYLOAD
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "deflate", pytest.param("zstd", marks=requires_zstd)])
+def test_decompression_bomb(encoding):
+    bomb = {"gzip": gzip.compress, "deflate": zlib.compress, "zstd": zstd_compress}[encoding](b"\0" * (64 * 1024 * 1024))
+    with pytest.raises(RequestBodyError, match="compressed more than") as error:
+        decode(encoding, bomb)
+    assert error.value.status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+
+
+def test_max_decoded_size():
+    with pytest.raises(RequestBodyError, match="larger than 1000 bytes") as error:
+        decode("gzip", gzip.compress(PAYLOAD), limits=DecodingLimits(max_size=1000, max_ratio=1e9))
+    assert error.value.status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    assert decode("gzip", gzip.compress(PAYLOAD), limits=DecodingLimits(max_size=len(PAYLOAD))) == PAYLOAD
+
+
+@pytest.mark.parametrize("encoding, body", [
+    ("gzip", gzip.compress(PAYLOAD)[:-10]),
+    ("gzip", gzip.compress(PAYLOAD)[:10]),
+    ("deflate", zlib.compress(PAYLOAD)[:-1]),
+    ("gzip", b"not gzip data"),
+    ("deflate", b"not deflate data"),
+    # Deflate has a single stream
+    ("deflate", zlib.compress(b"a") + b"x"),
+    ("gzip", gzip.compress(b"a") + b"trailing garbage"),
+])
+def test_invalid_body(encoding, body):
+    with pytest.raises(RequestBodyError) as error:
+        decode(encoding, body, 100)
+    assert error.value.status == HTTPStatus.BAD_REQUEST
+
+
+@requires_zstd
+def test_invalid_zstd_body():
+    with pytest.raises(RequestBodyError) as error:
+        decode("zstd", b"not zstd data")
+    assert error.value.status == HTTPStatus.BAD_REQUEST
+
+    # Would need too much memory
+    params = zstandard.ZstdCompressionParameters(window_log=MAX_ZSTD_WINDOW_SIZE.bit_length())
+    body = zstandard.ZstdCompressor(compression_params=params).compress(os.urandom(4 * MAX_ZSTD_WINDOW_SIZE))
+    with pytest.raises(RequestBodyError):
+        decode("zstd", body)
+
+
+@pytest.mark.parametrize("encoding", ["br", "compress", "gzip, deflate"])
+def test_unsupported_encoding(encoding):
+    with pytest.raises(RequestBodyError, match="Unsupported Content-Encoding") as error:
+        create_body_decoder(make_headers(content_encoding=encoding))
+    assert error.value.status == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+
+
+def test_parse_compressed_multipart():
+    body = b'--XX\r\nContent-Disposition: form-data; name="gpg"; filename="a"\r\n\r\n' + PAYLOAD + b"\r\n--XX--\r\n"
+    compressed = gzip.compress(body)
+    headers = make_headers(content_type="multipart/form-data; boundary=XX", content_length=str(len(compressed)), content_encoding="gzip")
+    # Only the Content-Length is read, the next request stays in the stream
+    stream = io.BytesIO(compressed + b"NEXT")
+    data = parse_request(headers, stream)
+    try:
+        assert data[b"gpg"].read() == PAYLOAD
+        assert stream.read() == b"NEXT"
+    finally:
+        close_request_data(data)
+
+
+def test_parse_compressed_urlencoded():
+    body = zlib.compress(b"a=1&b=x%20y")
+    headers = make_headers(content_type="application/x-www-form-urlencoded", content_length=str(len(body)), content_encoding="deflate")
+    assert parse_request(headers, io.BytesIO(body)) == {b"a": b"1", b"b": b"x y"}
+
+    # Urlencoded forms are decoded in memory and have a lower limit
+    body = gzip.compress(b"a=" + b"x" * (2 * http_response.MAX_URLENCODED_SIZE))
+    headers = make_headers(content_type="application/x-www-form-urlencoded", content_length=str(len(body)), content_encoding="gzip")
+    with pytest.raises(RequestBodyError) as error:
+        parse_request(headers, io.BytesIO(body))
+    assert error.value.status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
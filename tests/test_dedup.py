@@ -0,0 +1,103 @@
+import errno
+import hashlib
+import os
+
+import pytest
+
+from secure_upload.upload.dedup import DedupIndex
+from secure_upload.upload.store import OutputStore
+
+
+def store_file(output: OutputStore, name: str, data: bytes) -> str:
+    fd, temp_path = output.create_temp_file()
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    return output.commit(temp_path, name, hashlib.sha256(data).hexdigest())
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def index(tmp_path):
+    return DedupIndex(str(tmp_path / "index.db"))
+
+
+@pytest.fixture
+def output(tmp_path, index):
+    return OutputStore(str(tmp_path / "files"), dedup_index=index)
+
+
+def count_entries(index: DedupIndex) -> int:
+    with index.lock:
+        return index.connect().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+
+def test_duplicates_are_linked(output, index):
+    first = store_file(output, "a.txt", b"data")
+    second = store_file(output, "b.txt", b"data")
+    assert os.path.samefile(first, second)
+    assert not os.path.samefile(first, store_file(output, "c.txt", b"other data"))
+    assert sorted(os.listdir(output.directory)) == ["a.txt", "b.txt", "c.txt"]
+    # Shared with other processes through the database
+    assert DedupIndex(index.path).lookup(hashlib.sha256(b"data").hexdigest()) == first
+
+
+@pytest.mark.parametrize("change", ["append", "replace", "touch", "delete"])
+def test_stale_entries_are_dropped(output, index, change):
+    digest = hashlib.sha256(b"data").hexdigest()
+    first = store_file(output, "a.txt", b"data")
+    if change == "append":
+        with open(first, "ab") as f:
+            f.write(b"more")
+    elif change == "replace":
+        # Same size, but a different file
+        os.unlink(first)
+        with open(first, "wb") as f:
+            f.write(b"DATA")
+    elif change == "touch":
+        stat = os.stat(first)
+        os.utime(first, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    else:
+        os.unlink(first)
+
+    assert index.lookup(digest) is None
+    assert count_entries(index) == 0
+    # The next upload is a separate copy, which is indexed instead
+    second = store_file(output, "b.txt", b"data")
+    assert read(second) == b"data"
+    assert change == "delete" or not os.path.samefile(first, second)
+    assert index.lookup(digest) == second
+
+
+def test_copy_when_linking_the_duplicate_fails(output, index, monkeypatch):
+    first = store_file(output, "a.txt", b"data")
+    link = os.link
+
+    def failing_link(source: str, destination: str) -> None:
+        if source == first:
+            # For example, the file has the maximum number of links
+            raise OSError(errno.EMLINK, "Too many links")
+        link(source, destination)
+
+    monkeypatch.setattr(os, "link", failing_link)
+    second = store_file(output, "b.txt", b"data")
+    assert read(second) == b"data"
+    assert not os.path.samefile(first, second)
+    assert sorted(os.listdir(output.directory)) == ["a.txt", "b.txt"]
+
+
+def test_file_systems_without_hard_links(output, index, monkeypatch):
+    def failing_link(source: str, destination: str) -> None:
+        raise OSError(errno.EPERM, "Operation not permitted")
+
+    monkeypatch.setattr(os, "link", failing_link)
+    first = store_file(output, "a.txt", b"data")
+    # The temporary files are renamed instead, and duplicates are separate copies
+    second = store_file(output, "a.txt", b"data")
+    assert [read(first), read(second)] == [b"data", b"data"]
+    assert sorted(os.listdir(output.directory)) == ["a-1.txt", "a.txt"]
@@ -0,0 +1,65 @@
+import asyncio
+import os
+import shutil
+
+import pytest
+
+from secure_upload.upload.gpg import GpgUploadHandler
+from secure_upload.upload.store import OutputStore
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PASSPHRASE = "TODO_CHANGE_ME"
+
+pytestmark = pytest.mark.skipif(shutil.which("gpg") is None, reason="requires gpg")
+
+
+def read_test_file(name: str) -> bytes:
+    with open(os.path.join(TESTS_DIR, name), "rb") as f:
+        return f.read()
+
+
+def test_passphrase_is_not_on_the_command_line(tmp_path):
+    module = GpgUploadHandler(PASSPHRASE, store=OutputStore(str(tmp_path)))
+    passphrase_fd = module.open_passphrase_pipe()
+    try:
+        command = module.get_gpg_command(passphrase_fd)
+        assert not any(PASSPHRASE in argument for argument in command)
+        assert os.read(passphrase_fd, 1000) == PASSPHRASE.encode()
+    finally:
+        os.close(passphrase_fd)
+
+
+@pytest.mark.parametrize("passphrase", ["a\nb", "x" * 1000])
+def test_invalid_passphrase(passphrase):
+    with pytest.raises(Exception, match="GPG passphrase"):
+        GpgUploadHandler(passphrase)
+
+
+@pytest.mark.parametrize("passphrase, succeeded", [(PASSPHRASE, True), ("wrong", False)])
+def test_gpg_decryption(tmp_path, passphrase, succeeded):
+    module = GpgUploadHandler(passphrase, store=OutputStore(str(tmp_path)))
+    decryption = module.start_gpg_decryption()
+    try:
+        decryption.write(read_test_file("file.txt.gpg"))
+        decryption.finish()
+        assert decryption.succeeded == succeeded
+        if succeeded:
+            with open(decryption.save_as("file.txt"), "rb") as f:
+                assert f.read() == read_test_file("file.txt")
+    finally:
+        decryption.close()
+
+
+def test_async_gpg_decryption(tmp_path):
+    module = GpgUploadHandler(PASSPHRASE, store=OutputStore(str(tmp_path)))
+
+    async def main() -> None:
+        decryption = await module.start_decryption_async()
+        try:
+            await decryption.write_async(read_test_file("file.txt.gpg"))
+            await decryption.finish_async()
+            assert decryption.succeeded
+        finally:
+            decryption.close()
+
+    asyncio.run(main())
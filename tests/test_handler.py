@@ -0,0 +1,85 @@
+import io
+from typing import Optional
+
+import pytest
+
+from secure_upload.upload import ModuleResult, ModuleStatus, Route, UploadModule
+from secure_upload.upload.handler import ModuleHandler
+
+
+class FakeRequest:
+    """
+    Records the response instead of sending it
+    """
+
+    def __init__(self, command: str, path: str) -> None:
+        self.command = command
+        self.path = path
+        self.client_address = ("127.0.0.1", 12345)
+        self.status: Optional[int] = None
+        self.response_headers: dict[str, str] = {}
+        self.wfile = io.BytesIO()
+
+    def send_response(self, code: int, message: Optional[str] = None) -> None:
+        self.status = code
+
+    def send_header(self, keyword: str, value: str) -> None:
+        self.response_headers[keyword] = value
+
+    def end_headers(self) -> None:
+        pass
+
+
+class NamedModule(UploadModule):
+    """
+    Registers the given routes and answers GET requests with its name
+    """
+
+    def __init__(self, name: str, routes: list[Route]) -> None:
+        super().__init__()
+        self.name = name
+        self.routes = routes
+
+    def get_routes(self) -> list[Route]:
+        return self.routes
+
+    def handle_GET(self, handler) -> ModuleResult:
+        return ModuleResult(ModuleStatus.SUCCESS, self.name)
+
+
+def get(module_handler: ModuleHandler, path: str) -> tuple[Optional[int], bytes]:
+    request = FakeRequest("GET", path)
+    module_handler.handle_GET(request)
+    return request.status, request.wfile.getvalue()
+
+
+def test_duplicate_routes():
+    first = NamedModule("first", [Route("GET", "/a"), Route("GET", "/b/*")])
+    with pytest.raises(Exception, match="Route GET '/b/\\*' is registered by both"):
+        ModuleHandler([first, NamedModule("second", [Route("POST", "/b/*"), Route("GET", "/b/*")])])
+    with pytest.raises(Exception, match="empty list"):
+        ModuleHandler([])
+
+
+def test_exact_route_wins_over_prefix():
+    exact = NamedModule("exact", [Route("GET", "/seg/special")])
+    prefix = NamedModule("prefix", [Route("GET", "/seg/*"), Route("GET", "")])
+    module_handler = ModuleHandler([prefix, exact])
+
+    assert module_handler.get_module(FakeRequest("GET", "/seg/special")) is exact
+    # Paths are normalized before matching
+    assert module_handler.get_module(FakeRequest("GET", "/SEG/special/?x=1")) is exact
+    assert module_handler.get_module(FakeRequest("GET", "/seg/other")) is prefix
+    assert module_handler.get_module(FakeRequest("GET", "/seg/special/nested")) is prefix
+    assert module_handler.get_module(FakeRequest("GET", "/")) is prefix
+    # The prefix only matches paths below the segment and only for its method
+    assert module_handler.get_module(FakeRequest("GET", "/seg")) is None
+    assert module_handler.get_module(FakeRequest("GET", "/segment/x")) is None
+    assert module_handler.get_module(FakeRequest("POST", "/seg/other")) is None
+
+
+def test_dispatch():
+    module_handler = ModuleHandler([NamedModule("exact", [Route("GET", "/seg/special")]), NamedModule("prefix", [Route("GET", "/seg/*")])])
+    assert get(module_handler, "/seg/special") == (200, b"exact")
+    assert get(module_handler, "/seg/file.txt") == (200, b"prefix")
+    assert get(module_handler, "/other")[0] == 404
@@ -0,0 +1,200 @@
+import pytest
+
+from secure_upload.ip_blocking import IpAddressBlocker, IpRangeSet, SharedBlockTable, ip_network_range, load_ip_rules, pack_ip_address
+
+
+def test_pack_ip_address():
+    assert pack_ip_address("10.1.2.3") == pack_ip_address("::ffff:10.1.2.3")
+    assert pack_ip_address("fe80::1%eth0") == pack_ip_address("fe80::1")
+    assert len(pack_ip_address("2001:db8::1")) == 16
+    assert pack_ip_address("not an address") is None
+    assert pack_ip_address("10.1.2.300") is None
+
+
+def test_single_addresses():
+    ranges = IpRangeSet(["10.1.2.3", "2001:db8::1"])
+    assert "10.1.2.3" in ranges
+    assert "::ffff:10.1.2.3" in ranges
+    assert "2001:db8::1" in ranges
+    assert "10.1.2.4" not in ranges
+    assert "10.1.2.2" not in ranges
+    assert "2001:db8::2" not in ranges
+    assert "invalid" not in ranges
+
+
+def test_cidr_ranges():
+    ranges = IpRangeSet(["10.0.0.0/8", "192.168.1.128/25", "2001:db8::/32"])
+    assert "10.0.0.0" in ranges
+    assert "10.255.255.255" in ranges
+    assert "11.0.0.0" not in ranges
+    assert "9.255.255.255" not in ranges
+    assert "192.168.1.128" in ranges
+    assert "192.168.1.127" not in ranges
+    assert "2001:db8:ffff::1" in ranges
+    assert "2001:db9::" not in ranges
+
+
+def test_host_bits_are_ignored():
+    assert ip_network_range("10.1.2.3/8") == ip_network_range("10.0.0.0/8")
+
+
+def test_ipv4_ranges_do_not_match_ipv6():
+    ranges = IpRangeSet(["0.0.0.0/0"])
+    assert "1.2.3.4" in ranges
+    assert "255.255.255.255" in ranges
+    assert "::1" not in ranges
+    assert "2001:db8::1" not in ranges
+    assert "::" in IpRangeSet(["::/0"])
+
+
+def test_overlapping_and_adjacent_ranges_are_merged():
+    ranges = IpRangeSet(["10.0.0.0/24", "10.0.1.0/24", "10.0.0.5", "10.0.0.0/16", "10.2.0.0/16", "192.168.0.1"])
+    assert len(ranges) == 3
+    assert "10.0.200.1" in ranges
+    assert "10.1.0.0" not in ranges
+    assert "10.2.3.4" in ranges
+
+
+def test_empty():
+    ranges = IpRangeSet()
+    assert len(ranges) == 0
+    assert "10.0.0.1" not in ranges
+
+
+@pytest.mark.parametrize("network", ["10.0.0.0/33", "10.0.0.0/-1", "10.0.0.0/a", "2001:db8::/129", "example.com", ""])
+def test_invalid_networks(network):
+    with pytest.raises(Exception, match="Invalid IP address or network"):
+        IpRangeSet([network])
+
+
+def test_load_ip_rules(tmp_path):
+    path = tmp_path / "rules.txt"
+    path.write_text("# Internal networks\n10.0.0.0/8\n\n  192.168.0.1  # a single host\n2001:db8::/32\n")
+    assert load_ip_rules(str(path)) == ["10.0.0.0/8", "192.168.0.1", "2001:db8::/32"]
+
+
+def test_deny_takes_precedence():
+    blocker = IpAddressBlocker(["10.0.0.0/8"], ["10.1.0.0/16"], block_threshold=3, block_duration=60)
+    assert blocker.is_blocked("10.1.2.3")
+    assert not blocker.is_blocked("10.2.3.4")
+    assert not blocker.is_blocked("192.168.0.1")
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("secure_upload.ip_blocking.time", clock)
+    return clock
+
+
+def fail(blocker: IpAddressBlocker, ip_address: str, times: int = 1) -> None:
+    for _ in range(times):
+        blocker.increase_failed_auth_count(ip_address)
+
+
+def test_block_after_threshold(clock):
+    blocker = IpAddressBlocker([], [], block_threshold=3, block_duration=60)
+    fail(blocker, "10.0.0.1", 2)
+    clock.now += 30
+    assert not blocker.is_blocked("10.0.0.1")
+    fail(blocker, "10.0.0.1")
+    assert blocker.is_blocked("10.0.0.1")
+    assert not blocker.is_blocked("10.0.0.2")
+    clock.now += 59
+    assert blocker.is_blocked("10.0.0.1")
+    clock.now += 1
+    assert not blocker.is_blocked("10.0.0.1")
+    # The counter starts over once the block expired
+    fail(blocker, "10.0.0.1", 2)
+    assert not blocker.is_blocked("10.0.0.1")
+
+
+def test_static_rules_are_not_counted(clock):
+    blocker = IpAddressBlocker(["10.0.0.1"], [], block_threshold=1, block_duration=60)
+    fail(blocker, "10.0.0.1", 5)
+    assert not blocker.is_blocked("10.0.0.1")
+
+
+def test_sliding_window(clock):
+    blocker = IpAddressBlocker([], [], block_threshold=3, block_duration=60)
+    fail(blocker, "10.0.0.1", 2)
+    # The attempts of the previous window count less the longer ago the window was: 2 * (1 - 30 / 60) + 1 = 2
+    clock.now += 90
+    fail(blocker, "10.0.0.1")
+    assert not blocker.is_blocked("10.0.0.1")
+    # 2 * (1 - 40 / 60) + 2 = 2.67
+    clock.now += 10
+    fail(blocker, "10.0.0.1")
+    assert not blocker.is_blocked("10.0.0.1")
+    # 2 * (1 - 45 / 60) + 3 = 3.5
+    clock.now += 5
+    fail(blocker, "10.0.0.1")
+    assert blocker.is_blocked("10.0.0.1")
+
+
+def test_attempts_expire(clock):
+    blocker = IpAddressBlocker([], [], block_threshold=3, block_duration=60)
+    fail(blocker, "10.0.0.1", 2)
+    clock.now += 120
+    fail(blocker, "10.0.0.1", 2)
+    assert not blocker.is_blocked("10.0.0.1")
+
+
+def test_table_is_bounded(clock):
+    blocker = IpAddressBlocker([], [], block_threshold=100, block_duration=60, max_tracked_ips=16)
+    for i in range(200):
+        fail(blocker, f"10.0.{i // 256}.{i % 256}")
+    assert blocker.table.capacity == 16
+    assert blocker.evicted_entries == 200 - 16
+
+    # Expired entries are replaced without counting as evictions. No bucket can get more new addresses than it has entries
+    clock.now += 120
+    for i in range(SharedBlockTable.WAYS):
+        fail(blocker, f"10.1.0.{i}")
+    assert blocker.evicted_entries == 200 - 16
+
+
+def test_recently_used_entries_survive_eviction(clock):
+    # A single bucket, which is filled in order
+    blocker = IpAddressBlocker([], [], block_threshold=3, block_duration=60, max_tracked_ips=SharedBlockTable.WAYS)
+    for i in range(SharedBlockTable.WAYS):
+        fail(blocker, f"10.0.0.{i}", 2)
+    # All entries were used since the hand last passed them, so it goes around once and evicts the first one
+    fail(blocker, "10.0.1.0")
+    assert blocker.evicted_entries == 1
+    # Using the second entry makes the hand skip it and evict the third one instead
+    assert not blocker.is_blocked("10.0.0.1")
+    fail(blocker, "10.0.1.1")
+    assert blocker.evicted_entries == 2
+    fail(blocker, "10.0.0.1")
+    assert blocker.is_blocked("10.0.0.1")
+    fail(blocker, "10.0.0.2")
+    assert not blocker.is_blocked("10.0.0.2")
+
+
+def test_dropped_connections(clock):
+    blocker = IpAddressBlocker([], ["10.0.0.0/8"], block_threshold=1, block_duration=60)
+    assert blocker.should_drop_connection("10.0.0.1")
+    assert not blocker.should_drop_connection("192.168.0.1")
+    fail(blocker, "192.168.0.1")
+    assert blocker.should_drop_connection("192.168.0.1")
+    assert blocker.dropped_connections == 2
+
+
+def test_blocks_are_shared_with_forked_processes(clock):
+    multiprocessing = pytest.importorskip("multiprocessing")
+    blocker = IpAddressBlocker([], [], block_threshold=3, block_duration=60)
+    fail(blocker, "10.0.0.1", 2)
+    process = multiprocessing.get_context("fork").Process(target=fail, args=(blocker, "10.0.0.1"))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert blocker.is_blocked("10.0.0.1")
@@ -0,0 +1,140 @@
+import http.client
+import io
+from http import HTTPStatus
+
+import pytest
+
+from secure_upload.http_response import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_FIELD_SIZE, RequestBodyError, parse_request
+from secure_upload.multipart import MultipartError, MultipartParser, PartBegin, PartData, PartEnd
+
+BOUNDARY = b"----boundary1234"
+# Contains partial delimiters, which must not be mistaken for the boundary
+FILE_CONTENTS = b"first line\r\n--" + BOUNDARY[:-1] + b"\r\n\r\n--" + b"x" * 100 + b"\r\n"
+
+
+def build_body(parts: list[tuple[bytes, bytes]], boundary: bytes = BOUNDARY) -> bytes:
+    body = b"preamble, which is ignored\r\n"
+    for name, data in parts:
+        body += b"--" + boundary + b"\r\n"
+        body += b'Content-Disposition: form-data; name="' + name + b'"; filename="' + name + b'.txt"\r\n'
+        body += b"Content-Type: application/octet-stream\r\n\r\n"
+        body += data + b"\r\n"
+    return body + b"--" + boundary + b"--\r\nepilogue"
+
+
+def split(data: bytes, chunk_size: int) -> list[bytes]:
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def parse(chunks: list[bytes], boundary: bytes = BOUNDARY) -> list[tuple[bytes, str, bytes]]:
+    """
+    Feeds the chunks to a parser and returns the (name, filename, contents) of each part
+    """
+    parser = MultipartParser(boundary)
+    parts = []
+    for chunk in chunks:
+        for event in parser.feed(chunk):
+            if isinstance(event, PartBegin):
+                parts.append([event.part.name, event.part.filename, b""])
+            elif isinstance(event, PartData):
+                parts[-1][2] += event.data
+            elif isinstance(event, PartEnd):
+                parts[-1] = tuple(parts[-1])
+    parser.close()
+    return parts
+
+
+def make_headers(**headers: str) -> http.client.HTTPMessage:
+    raw = "".join(f"{name.replace('_', '-')}: {value}\r\n" for name, value in headers.items())
+    return http.client.parse_headers(io.BytesIO(raw.encode("latin-1") + b"\r\n"))
+
+
+def test_single_chunk():
+    body = build_body([(b"a", FILE_CONTENTS), (b"b", b"")])
+    assert parse([body]) == [(b"a", "a.txt", FILE_CONTENTS), (b"b", "b.txt", b"")]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 16, len(BOUNDARY) + 3, 64])
+def test_boundaries_split_across_chunks(chunk_size):
+    body = build_body([(b"a", FILE_CONTENTS), (b"b", b"second file")])
+    assert parse(split(body, chunk_size)) == [(b"a", "a.txt", FILE_CONTENTS), (b"b", "b.txt", b"second file")]
+
+
+def test_every_split_position():
+    body = build_body([(b"a", FILE_CONTENTS)])
+    for position in range(len(body) + 1):
+        assert parse([body[:position], body[position:]]) == [(b"a", "a.txt", FILE_CONTENTS)], position
+
+
+def test_large_part_is_not_buffered():
+    parser = MultipartParser(BOUNDARY)
+    parser.feed(build_body([(b"a", b"")]).split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n")
+    for _ in range(100):
+        parser.feed(b"x" * DEFAULT_CHUNK_SIZE)
+        assert len(parser.buffer) < len(parser.delimiter)
+
+
+@pytest.mark.parametrize("length", [10, 60, 100])
+def test_truncated_body(length):
+    body = build_body([(b"a", FILE_CONTENTS)])
+    with pytest.raises(MultipartError):
+        parse(split(body[:length], 7))
+
+
+def test_missing_closing_boundary():
+    body = build_body([(b"a", FILE_CONTENTS)])
+    body = body[:body.rindex(b"--" + BOUNDARY + b"--")]
+    with pytest.raises(MultipartError):
+        parse([body])
+
+
+def test_missing_name():
+    body = b"--" + BOUNDARY + b"\r\nContent-Disposition: form-data\r\n\r\nabc\r\n--" + BOUNDARY + b"--\r\n"
+    with pytest.raises(MultipartError):
+        parse([body])
+
+
+def test_headers_too_large():
+    parser = MultipartParser(BOUNDARY, max_header_size=100)
+    with pytest.raises(MultipartError):
+        parser.feed(b"--" + BOUNDARY + b"\r\nX-Long: " + b"a" * 200)
+
+
+def test_parse_request():
+    body = build_body([(b"gpg", FILE_CONTENTS)])
+    headers = make_headers(content_type="multipart/form-data; boundary=" + BOUNDARY.decode(), content_length=str(len(body)))
+    data = parse_request(headers, io.BytesIO(body), chunk_size=5)
+    assert data[b"gpg"].read() == FILE_CONTENTS
+
+
+def test_parse_request_field_too_large():
+    body = b"--" + BOUNDARY + b'\r\nContent-Disposition: form-data; name="a"\r\n\r\n' + b"x" * (DEFAULT_MAX_FIELD_SIZE + 1)
+    body += b"\r\n--" + BOUNDARY + b"--\r\n"
+    headers = make_headers(content_type="multipart/form-data; boundary=" + BOUNDARY.decode(), content_length=str(len(body)))
+    with pytest.raises(MultipartError):
+        parse_request(headers, io.BytesIO(body))
+
+
+def test_parse_request_truncated_body():
+    body = build_body([(b"gpg", FILE_CONTENTS)])
+    headers = make_headers(content_type="multipart/form-data; boundary=" + BOUNDARY.decode(), content_length=str(len(body) + 10))
+    with pytest.raises(RequestBodyError) as error:
+        parse_request(headers, io.BytesIO(body))
+    assert error.value.status == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.parametrize("headers, status", [
+    ({"content_type": "text/plain", "content_length": "3"}, HTTPStatus.UNSUPPORTED_MEDIA_TYPE),
+    ({"content_type": "multipart/form-data; boundary=x"}, HTTPStatus.LENGTH_REQUIRED),
+    ({"content_type": "application/x-www-form-urlencoded", "content_length": "-1"}, HTTPStatus.LENGTH_REQUIRED),
+    ({"content_type": "multipart/form-data", "content_length": "3"}, HTTPStatus.BAD_REQUEST),
+])
+def test_parse_request_invalid_headers(headers, status):
+    with pytest.raises(RequestBodyError) as error:
+        parse_request(make_headers(**headers), io.BytesIO(b"abc"))
+    assert error.value.status == status
+
+
+def test_parse_urlencoded():
+    headers = make_headers(content_type="application/x-www-form-urlencoded", content_length="13")
+    assert parse_request(headers, io.BytesIO(b"a=1&b=x%20y&c")) == {b"a": b"1", b"b": b"x y", b"c": b""}
@@ -0,0 +1,146 @@
+import os
+import struct
+import zlib
+
+import pytest
+
+from secure_upload.http_response import DecodingLimits
+from secure_upload.upload import openpgp
+from secure_upload.upload.openpgp import DecryptionError, DerivedKeyCache, SymmetricMessageDecryptor, UnsupportedMessageError
+
+pytestmark = pytest.mark.skipif(not openpgp.is_available(), reason="requires the 'cryptography' package")
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PASSPHRASE = b"TODO_CHANGE_ME"
+
+
+def read_test_file(name: str) -> bytes:
+    with open(os.path.join(TESTS_DIR, name), "rb") as f:
+        return f.read()
+
+
+def decrypt(message: bytes, passphrase: bytes = PASSPHRASE, chunk_size: int = 64 * 1024, key_cache=None) -> bytes:
+    output = []
+    decryptor = SymmetricMessageDecryptor(passphrase, output.append, key_cache)
+    for i in range(0, len(message), chunk_size):
+        decryptor.feed(message[i:i + chunk_size])
+    decryptor.close()
+    return b"".join(output)
+
+
+@pytest.fixture(scope="module")
+def key_cache():
+    # The test files use the (deliberately slow) iterated and salted S2K
+    return DerivedKeyCache()
+
+
+def test_decrypt(key_cache):
+    assert decrypt(read_test_file("file.txt.gpg"), key_cache=key_cache) == read_test_file("file.txt")
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 16, 17])
+def test_decrypt_in_small_chunks(key_cache, chunk_size):
+    assert decrypt(read_test_file("file.txt.gpg"), chunk_size=chunk_size, key_cache=key_cache) == read_test_file("file.txt")
+
+
+def test_wrong_passphrase():
+    with pytest.raises(DecryptionError):
+        decrypt(read_test_file("wrong-pass.txt.gpg"))
+
+
+def test_tampered_mdc(key_cache):
+    message = bytearray(read_test_file("file.txt.gpg"))
+    # The message ends with the (encrypted) hash of the modification detection code. In CFB mode flipping a ciphertext bit flips the same plaintext bit
+    message[-1] ^= 1
+    with pytest.raises(DecryptionError, match="Modification detection code does not match"):
+        decrypt(bytes(message), key_cache=key_cache)
+
+
+def test_missing_mdc(key_cache):
+    message = bytearray(read_test_file("file.txt.gpg"))
+    # Shorten the encrypted data packet, which follows the session key packet, by the MDC packet
+    index = 2 + message[1]
+    assert message[index] == 0xd2 and message[index + 1] < 192
+    message[index + 1] -= openpgp.MDC_LENGTH
+    with pytest.raises(DecryptionError, match="Missing modification detection code"):
+        decrypt(bytes(message[:-openpgp.MDC_LENGTH]), key_cache=key_cache)
+
+
+@pytest.mark.parametrize("length", [1, 10, 20, 40, 100, -1])
+def test_truncated_ciphertext(key_cache, length):
+    with pytest.raises(DecryptionError):
+        decrypt(read_test_file("file.txt.gpg")[:length], key_cache=key_cache)
+
+
+def test_trailing_garbage(key_cache):
+    with pytest.raises(DecryptionError):
+        decrypt(read_test_file("file.txt.gpg") + b"\xd2\x01\x01", key_cache=key_cache)
+
+
+@pytest.mark.parametrize("algorithm", [2, 3, 10])
+def test_unsupported_cipher(algorithm):
+    message = bytearray(read_test_file("file.txt.gpg"))
+    # The session key packet: header (0x8c), length, version, cipher algorithm (9 is AES-256)
+    assert message[3] == 9
+    message[3] = algorithm
+    with pytest.raises(UnsupportedMessageError):
+        decrypt(bytes(message))
+
+
+def test_unsupported_packet():
+    # A public-key encrypted session key packet
+    with pytest.raises(UnsupportedMessageError):
+        decrypt(b"\x84\x02\x03\x00")
+
+
+def test_no_encrypted_data():
+    with pytest.raises(DecryptionError):
+        decrypt(b"")
+
+
+def old_format_packet(tag: int, body: bytes) -> bytes:
+    # Old format header with a four byte length
+    return bytes([0x80 | tag << 2 | 2]) + struct.pack(">I", len(body)) + body
+
+
+def compressed_literal(data: bytes, depth: int = 1) -> bytes:
+    packet = old_format_packet(openpgp.TAG_LITERAL, b"b\x00\x00\x00\x00\x00" + data)
+    for _ in range(depth):
+        # Algorithm 2 is zlib
+        packet = old_format_packet(openpgp.TAG_COMPRESSED, b"\x02" + zlib.compress(packet))
+    return packet
+
+
+def decompress(message: bytes, limits: DecodingLimits = DecodingLimits()) -> bytes:
+    # The layer inside of the encrypted data, which is where compressed data packets are
+    output = []
+    layer = openpgp._MessageLayer(output.append, limits)
+    for i in range(0, len(message), 64 * 1024):
+        layer.feed(message[i:i + 64 * 1024])
+    layer.close()
+    return b"".join(output)
+
+
+def test_compressed_data():
+    data = os.urandom(100_000) + b"x" * 100_000
+    assert decompress(compressed_literal(data)) == data
+    assert decompress(compressed_literal(data, depth=3)) == data
+    with pytest.raises(DecryptionError, match="Too many nested"):
+        decompress(compressed_literal(data, depth=openpgp.MAX_COMPRESSION_DEPTH + 1))
+
+
+@pytest.mark.parametrize("depth", [1, 2])
+def test_decompression_bomb(depth):
+    bomb = compressed_literal(b"\0" * (64 * 1024 * 1024), depth)
+    with pytest.raises(DecryptionError, match="compressed more than"):
+        decompress(bomb)
+    # Nesting does not multiply the allowed ratio
+    with pytest.raises(DecryptionError, match="compressed more than 1000:1"):
+        decompress(bomb, DecodingLimits(max_ratio=1000))
+
+
+def test_max_decompressed_size():
+    data = os.urandom(100_000)
+    with pytest.raises(DecryptionError, match="larger than 1000 bytes"):
+        decompress(compressed_literal(data), DecodingLimits(max_size=1000))
+    assert decompress(compressed_literal(data), DecodingLimits(max_size=200_000)) == data
@@ -0,0 +1,235 @@
+import json
+from http import HTTPStatus
+
+import pytest
+
+from secure_upload.quota import QuotaExceededError, SharedUsageTable, StorageQuota, UncountedReservation
+
+
+def upload(quota: StorageQuota, client: str, size: int, announced: int = 0) -> None:
+    reservation = quota.reserve(client, announced)
+    try:
+        reservation.add(size)
+    except BaseException:
+        reservation.finish(False)
+        raise
+    reservation.finish(True)
+
+
+def get_usage(quota: StorageQuota, client: str) -> int:
+    with quota.lock:
+        return quota.get_usage(client)
+
+
+def get_total(quota: StorageQuota) -> int:
+    with quota.lock:
+        return quota.get_total()
+
+
+def test_max_upload_size():
+    quota = StorageQuota(max_upload_size=1000)
+    with pytest.raises(QuotaExceededError) as error:
+        quota.reserve("a", 1001)
+    assert error.value.status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    # Chunked bodies are checked while they are received
+    with pytest.raises(QuotaExceededError):
+        upload(quota, "a", 1001)
+    upload(quota, "a", 1000, announced=1000)
+    assert get_usage(quota, "a") == 1000
+
+
+def test_reservations_count_towards_the_quota():
+    quota = StorageQuota(client_quota=1500)
+    reservation = quota.reserve("a", 800)
+    with pytest.raises(QuotaExceededError) as error:
+        quota.reserve("a", 800)
+    assert error.value.status == HTTPStatus.INSUFFICIENT_STORAGE
+    # Other clients have their own quota
+    quota.reserve("b", 800).finish(False)
+    reservation.finish(False)
+    quota.reserve("a", 800).finish(False)
+
+
+def test_only_successful_uploads_count():
+    quota = StorageQuota(client_quota=1500)
+    reservation = quota.reserve("a", 800)
+    reservation.add(500)
+    reservation.finish(True)
+    reservation = quota.reserve("a", 800)
+    reservation.add(800)
+    reservation.finish(False)
+    assert get_usage(quota, "a") == 500
+    assert get_total(quota) == 500
+
+
+def test_chunked_body_over_quota():
+    quota = StorageQuota(client_quota=1500)
+    upload(quota, "a", 1000)
+    reservation = quota.reserve("a", 0)
+    with pytest.raises(QuotaExceededError):
+        for _ in range(10):
+            reservation.add(100)
+    assert reservation.received == 600 and reservation.reserved == 500
+    reservation.finish(False)
+    assert get_usage(quota, "a") == 1000
+
+
+def test_total_quota():
+    quota = StorageQuota(client_quota=1500, total_quota=2500)
+    upload(quota, "a", 1500)
+    upload(quota, "b", 900)
+    with pytest.raises(QuotaExceededError, match="does not have enough storage"):
+        quota.reserve("c", 101)
+    upload(quota, "c", 100)
+
+
+def test_release():
+    quota = StorageQuota(client_quota=1500)
+    upload(quota, "a", 1500)
+    quota.release("a", 1000)
+    upload(quota, "a", 1000)
+    assert get_usage(quota, "a") == 1500
+
+
+def test_uncounted_reservation():
+    quota = StorageQuota(max_upload_size=10, client_quota=10)
+    reservation = UncountedReservation(quota, "a")
+    reservation.add(100)
+    reservation.finish(True)
+    assert get_usage(quota, "a") == 0
+
+
+def test_persist(tmp_path):
+    path = str(tmp_path / "quota.json")
+    quota = StorageQuota(path, client_quota=1500)
+    upload(quota, "a", 1000)
+    upload(quota, "b", 10)
+    quota.persist()
+    with open(path) as f:
+        assert json.load(f) == {"a": 1000, "b": 10}
+    assert get_usage(quota, "a") == 1000 and get_total(quota) == 1010
+
+    # The usage survives a restart
+    quota = StorageQuota(path, client_quota=1500)
+    with pytest.raises(QuotaExceededError):
+        quota.reserve("a", 501)
+
+    # Deleting the file resets the usage. Releasing usage that was counted before can not make it negative
+    (tmp_path / "quota.json").unlink()
+    quota.release("a", 1000)
+    upload(quota, "b", 5)
+    quota.persist()
+    with open(path) as f:
+        assert json.load(f) == {"b": 5}
+
+
+def test_invalid_quota_file(tmp_path):
+    path = tmp_path / "quota.json"
+    path.write_text('{"a": "1000"}')
+    with pytest.raises(Exception, match="Invalid quota file"):
+        StorageQuota(str(path))
+
+
+def test_independent_servers_share_the_file(tmp_path):
+    # Like two servers that use the same quota file
+    path = str(tmp_path / "quota.json")
+    quota1 = StorageQuota(path)
+    quota2 = StorageQuota(path)
+    upload(quota1, "a", 100)
+    upload(quota2, "a", 20)
+    quota1.persist()
+    quota2.persist()
+    quota1.persist()
+    with open(path) as f:
+        assert json.load(f) == {"a": 120}
+    assert get_usage(quota1, "a") == get_usage(quota2, "a") == 120
+
+
+def run_in_forked_process(fn, *args) -> None:
+    multiprocessing = pytest.importorskip("multiprocessing")
+    process = multiprocessing.get_context("fork").Process(target=fn, args=args)
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+
+def test_usage_is_shared_with_forked_processes():
+    quota = StorageQuota(client_quota=1500, total_quota=2000)
+    upload(quota, "a", 1000)
+    run_in_forked_process(upload, quota, "a", 400)
+    assert get_usage(quota, "a") == 1400
+    with pytest.raises(QuotaExceededError):
+        quota.reserve("a", 101)
+    # A running upload in another process counts as well
+    run_in_forked_process(quota.reserve, "b", 550)
+    assert get_total(quota) == 1950
+
+
+def test_forked_processes_reload_the_file(tmp_path):
+    def upload_and_persist(quota: StorageQuota) -> None:
+        upload(quota, "a", 400)
+        quota.persist()
+
+    path = str(tmp_path / "quota.json")
+    quota = StorageQuota(path, client_quota=1500)
+    upload(quota, "a", 1000)
+    quota.persist()
+    run_in_forked_process(upload_and_persist, quota)
+    with pytest.raises(QuotaExceededError):
+        quota.reserve("a", 101)
+    assert quota.persisted == {"a": 1400}
+
+
+def test_full_bucket_counts_towards_every_client():
+    # A single bucket
+    table = SharedUsageTable(SharedUsageTable.WAYS)
+    for i in range(SharedUsageTable.WAYS):
+        assert table.add(f"client{i}", 10) == 0
+    assert table.add("overflow", 5) == 5
+    assert table.get("client0") == 15
+    assert table.get("overflow") == 5
+    assert table.total == SharedUsageTable.WAYS * 10 + 5
+
+    # Entries are free again once their value drops to 0
+    table.add("client0", -10)
+    assert table.add("new", 1) == 0
+    assert table.get("new") == 1 + 5
+    # Usage is taken from the overflow counter if it was added there, even if the client could have an entry now
+    assert table.add("overflow", -5, overflowed=5) == -5
+    assert table.get("new") == 1
+    assert table.get("client1") == 10
+    assert table.get("overflow") == 0
+    assert table.total == (SharedUsageTable.WAYS - 1) * 10 + 1
+
+
+def test_released_overflow_does_not_count_anymore(tmp_path):
+    quota = StorageQuota(str(tmp_path / "quota.json"), client_quota=100, max_clients=SharedUsageTable.WAYS)
+    for i in range(SharedUsageTable.WAYS):
+        upload(quota, f"client{i}", 10)
+    # The bucket is full, so these count towards every client until they are gone
+    reservation = quota.reserve("overflow", 50)
+    assert get_usage(quota, "client0") == 60
+    # Even if an entry became free in the meantime
+    quota.release("client7", 10)
+    reservation.finish(False)
+    assert get_usage(quota, "client0") == 10
+    upload(quota, "client7", 10)
+    upload(quota, "overflow", 20)
+    assert get_usage(quota, "client0") == 30
+    quota.release("overflow", 20)
+    assert get_usage(quota, "client0") == 10
+
+    # Repeated uploads and releases do not accumulate
+    for _ in range(10):
+        upload(quota, "overflow", 90, announced=90)
+        quota.release("overflow", 90)
+    assert get_usage(quota, "client0") == 10
+    upload(quota, "client0", 90)
+
+    # Writing the quota file moves the usage out of the table
+    upload(quota, "overflow", 30)
+    quota.persist()
+    assert quota.table.get("client1") == 0
+    assert get_usage(quota, "client1") == 10
+    assert get_usage(quota, "overflow") == 30
+    assert get_total(quota) == 100 + 7 * 10 + 30
@@ -0,0 +1,222 @@
+import http.client
+import io
+import os
+import time
+from typing import Optional
+
+import pytest
+
+from secure_upload.errors import RequestBodyError
+from secure_upload.http_response import FieldSink
+from secure_upload.quota import StorageQuota
+from secure_upload.upload import ModuleResult, ModuleStatus, Route, UploadModule
+from secure_upload.upload.resumable import ChunkSink, ResumableUploadModule, add_range
+
+
+class FakeRequest:
+    def __init__(self, command: str, path: str, client_name: Optional[str] = "alice", **headers: str) -> None:
+        self.command = command
+        self.path = path
+        raw = "".join(f"{name.replace('_', '-')}: {value}\r\n" for name, value in headers.items())
+        self.headers = http.client.parse_headers(io.BytesIO(raw.encode() + b"\r\n"))
+        self.client_name = client_name
+        self.client_address = ("127.0.0.1", 12345)
+
+
+class BufferSink(FieldSink):
+    def __init__(self) -> None:
+        super().__init__()
+        self.data = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self.data += data
+
+
+class TargetModule(UploadModule):
+    """
+    Accepts raw uploads to '/target/*' and keeps them in memory
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.files: dict[str, bytes] = {}
+
+    def get_routes(self) -> list[Route]:
+        return [Route("PUT", "/target/*")]
+
+    def open_raw_upload(self, handler) -> Optional[FieldSink]:
+        return BufferSink()
+
+    def handle_raw_upload(self, handler, upload: FieldSink) -> ModuleResult:
+        self.files[handler.path] = bytes(upload.data)
+        return ModuleResult(ModuleStatus.SUCCESS, "stored")
+
+
+@pytest.fixture
+def target():
+    return TargetModule()
+
+
+@pytest.fixture
+def quota():
+    return StorageQuota(client_quota=1000)
+
+
+@pytest.fixture
+def module(tmp_path, target, quota):
+    return ResumableUploadModule(str(tmp_path / "sessions"), [target], session_lifetime=3600, storage_quota=quota)
+
+
+def get_usage(quota: StorageQuota, client: str) -> int:
+    with quota.lock:
+        return quota.get_usage(client)
+
+
+def create(module: ResumableUploadModule, length: int, client_name: str = "alice") -> str:
+    request = FakeRequest("POST", "/uploads", client_name, upload_length=str(length), upload_target="/target/file.txt")
+    result = module.handle_raw_upload(request, module.open_raw_upload(request))
+    assert result.status == ModuleStatus.SUCCESS
+    return result.headers["Location"]
+
+
+def patch(module: ResumableUploadModule, location: str, offset: int, data: bytes, client_name: str = "alice") -> ModuleResult:
+    request = FakeRequest("PATCH", location, client_name, upload_offset=str(offset))
+    sink = module.open_raw_upload(request)
+    if sink is None:
+        return ModuleResult(ModuleStatus.WRONG_MODULE, None)
+    try:
+        sink.write(data)
+        sink.finish()
+        return module.handle_raw_upload(request, sink)
+    finally:
+        sink.close()
+
+
+def finish(module: ResumableUploadModule, location: str, client_name: str = "alice") -> ModuleResult:
+    request = FakeRequest("POST", location, client_name)
+    return module.handle_raw_upload(request, module.open_raw_upload(request))
+
+
+def test_add_range():
+    assert add_range([], 0, 10) == [[0, 10]]
+    # Adjacent and overlapping ranges are merged
+    assert add_range([[0, 10]], 10, 20) == [[0, 20]]
+    assert add_range([[0, 10], [20, 30]], 5, 25) == [[0, 30]]
+    assert add_range([[0, 10], [20, 30]], 12, 15) == [[0, 10], [12, 15], [20, 30]]
+    assert add_range([[20, 30]], 0, 5) == [[0, 5], [20, 30]]
+    assert add_range([[0, 10], [12, 15], [20, 30]], 10, 20) == [[0, 30]]
+
+
+def test_upload_in_any_order(module, target, quota):
+    location = create(module, 10)
+    assert get_usage(quota, "alice") == 10
+    assert patch(module, location, 5, b"56789").headers == {"Upload-Offset": "0"}
+
+    result = module.handle_HEAD(FakeRequest("HEAD", location))
+    assert result.headers["Upload-Offset"] == "0"
+    assert result.headers["Upload-Ranges"] == "5-9"
+
+    assert patch(module, location, 0, b"01234").headers == {"Upload-Offset": "10"}
+    assert finish(module, location).status == ModuleStatus.SUCCESS
+    assert target.files == {"/target/file.txt": b"0123456789"}
+    # Stored uploads keep counting
+    assert get_usage(quota, "alice") == 10
+    assert os.listdir(module.directory) == []
+
+
+def test_offset_beyond_length(module):
+    location = create(module, 10)
+    with pytest.raises(RequestBodyError, match="beyond the end"):
+        patch(module, location, 11, b"")
+    with pytest.raises(RequestBodyError, match="beyond the end"):
+        patch(module, location, 8, b"abc")
+
+
+def test_finish_with_holes(module, target, quota):
+    location = create(module, 10)
+    patch(module, location, 0, b"0123")
+    patch(module, location, 6, b"6789")
+    result = finish(module, location)
+    assert result.status == ModuleStatus.CLIENT_ERROR
+    assert result.message == "The upload is incomplete: received 8 of 10 bytes"
+    # The upload can still be completed
+    patch(module, location, 4, b"45")
+    assert finish(module, location).status == ModuleStatus.SUCCESS
+    assert target.files == {"/target/file.txt": b"0123456789"}
+
+
+def test_rejected_upload_is_released(module, target, quota):
+    location = create(module, 3)
+    patch(module, location, 0, b"abc")
+    target.handle_raw_upload = lambda handler, upload: ModuleResult(ModuleStatus.ERROR, "rejected")
+    assert finish(module, location).status == ModuleStatus.ERROR
+    assert get_usage(quota, "alice") == 0
+
+
+def test_no_chunks_after_finishing(module):
+    location = create(module, 10)
+    request = FakeRequest("PATCH", location, upload_offset="0")
+    sink = module.open_raw_upload(request)
+    try:
+        sink.write(b"01234")
+        with module.get_session(request).locked() as state:
+            state["finishing"] = True
+        with pytest.raises(RequestBodyError, match="already being finished"):
+            sink.write(b"56789")
+        assert sink.written == 5
+    finally:
+        sink.close()
+
+    with pytest.raises(RequestBodyError, match="already being finished"):
+        patch(module, location, 5, b"56789")
+
+
+def test_no_chunks_after_delete(module, quota):
+    location = create(module, 10)
+    request = FakeRequest("PATCH", location, upload_offset="0")
+    sink = module.open_raw_upload(request)
+    assert isinstance(sink, ChunkSink)
+    try:
+        assert module.handle_DELETE(FakeRequest("DELETE", location)).status == ModuleStatus.SUCCESS
+        with pytest.raises(RequestBodyError, match="aborted"):
+            sink.write(b"01234")
+    finally:
+        sink.close()
+    assert get_usage(quota, "alice") == 0
+    assert module.handle_DELETE(FakeRequest("DELETE", location)).status == ModuleStatus.WRONG_MODULE
+
+
+def test_sessions_belong_to_their_client(module, quota):
+    location = create(module, 10)
+    assert module.handle_HEAD(FakeRequest("HEAD", location, "mallory")).status == ModuleStatus.WRONG_MODULE
+    assert patch(module, location, 0, b"0123456789", "mallory").status == ModuleStatus.WRONG_MODULE
+    assert finish(module, location, "mallory").status == ModuleStatus.WRONG_MODULE
+    assert module.handle_DELETE(FakeRequest("DELETE", location, "mallory")).status == ModuleStatus.WRONG_MODULE
+    assert module.handle_DELETE(FakeRequest("DELETE", location, None)).status == ModuleStatus.WRONG_MODULE
+    assert get_usage(quota, "alice") == 10
+
+    assert module.handle_HEAD(FakeRequest("HEAD", location)).headers["Upload-Ranges"] == ""
+    # Without authentication every request counts as the same client
+    location = create(module, 10, None)
+    assert module.handle_HEAD(FakeRequest("HEAD", location, None)).status == ModuleStatus.SUCCESS
+
+
+def test_expiry(module, quota, monkeypatch):
+    expired = create(module, 10)
+    active = create(module, 20)
+    patch(module, active, 0, b"x")
+    finishing = create(module, 30)
+    with module.get_session(FakeRequest("POST", finishing)).locked() as state:
+        state["finishing"] = True
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 3000)
+    patch(module, active, 1, b"y")
+    monkeypatch.setattr(time, "time", lambda: now + 4000)
+    module.delete_expired_sessions()
+
+    assert module.handle_HEAD(FakeRequest("HEAD", expired)).status == ModuleStatus.WRONG_MODULE
+    assert module.handle_HEAD(FakeRequest("HEAD", active)).headers["Upload-Offset"] == "2"
+    # Uploads that are being finished are left to the request that finishes them
+    assert module.get_session(FakeRequest("HEAD", finishing)) is not None
+    assert get_usage(quota, "alice") == 50
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+from secure_upload.upload.gpg import GpgUploadHandler
+from secure_upload.upload.scheduler import DecryptionScheduler, SchedulerBusyError
+from secure_upload.upload.store import OutputStore
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+requires_gpg = pytest.mark.skipif(shutil.which("gpg") is None, reason="requires gpg")
+
+
+def acquire_in_thread(scheduler: DecryptionScheduler, **kwargs) -> tuple[threading.Thread, list]:
+    """
+    Returns the thread and a list that receives the slot or the error
+    """
+    result: list = []
+
+    def run() -> None:
+        try:
+            result.append(scheduler.acquire(**kwargs))
+        except SchedulerBusyError as e:
+            result.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, result
+
+
+def wait_until_waiting(scheduler: DecryptionScheduler, count: int) -> None:
+    deadline = time.monotonic() + 5
+    while scheduler.waiting < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_queue_full():
+    scheduler = DecryptionScheduler(workers=1, queue_size=1, retry_after=7)
+    slot = scheduler.acquire()
+    thread, result = acquire_in_thread(scheduler)
+    wait_until_waiting(scheduler, 1)
+
+    with pytest.raises(SchedulerBusyError) as error:
+        scheduler.acquire()
+    assert error.value.retry_after == 7
+
+    slot.release()
+    thread.join(5)
+    assert scheduler.running == 1 and scheduler.waiting == 0
+    result[0].release()
+    assert scheduler.running == 0
+
+
+def test_admitted_jobs_bypass_the_full_queue():
+    scheduler = DecryptionScheduler(workers=1, queue_size=0)
+    slot = scheduler.acquire()
+    with pytest.raises(SchedulerBusyError):
+        scheduler.acquire()
+    thread, result = acquire_in_thread(scheduler, admitted=True)
+    wait_until_waiting(scheduler, 1)
+    slot.release()
+    thread.join(5)
+    assert not isinstance(result[0], SchedulerBusyError)
+
+
+def test_queue_timeout():
+    scheduler = DecryptionScheduler(workers=1, queue_timeout=0.05)
+    slot = scheduler.acquire()
+    with pytest.raises(SchedulerBusyError):
+        scheduler.acquire()
+    assert scheduler.waiting == 0
+    slot.release()
+    scheduler.acquire().release()
+    assert scheduler.running == 0
+
+
+def test_release_is_idempotent():
+    scheduler = DecryptionScheduler(workers=2)
+    slot = scheduler.acquire()
+    scheduler.acquire()
+    slot.release()
+    slot.release()
+    assert scheduler.running == 1
+
+
+def test_async_handoff():
+    scheduler = DecryptionScheduler(workers=1)
+
+    async def main() -> None:
+        slot = scheduler.acquire()
+        waiter = asyncio.ensure_future(scheduler.acquire_async())
+        await asyncio.sleep(0)
+        assert scheduler.waiting == 1 and not waiter.done()
+
+        # Released by another thread, like a decryption running in an executor
+        threading.Thread(target=slot.release).start()
+        async_slot = await asyncio.wait_for(waiter, 5)
+        # The slot was passed on directly
+        assert scheduler.running == 1 and scheduler.waiting == 0
+        async_slot.release()
+        assert scheduler.running == 0
+
+    asyncio.run(main())
+
+
+def test_async_queue_full_and_timeout():
+    scheduler = DecryptionScheduler(workers=1, queue_size=1, queue_timeout=0.05)
+
+    async def main() -> None:
+        slot = scheduler.acquire()
+        waiter = asyncio.ensure_future(scheduler.acquire_async())
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerBusyError):
+            await scheduler.acquire_async()
+        with pytest.raises(SchedulerBusyError):
+            await waiter
+        assert scheduler.waiting == 0 and not scheduler.async_waiters
+        slot.release()
+        assert scheduler.running == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_async_waiter_passes_the_slot_on():
+    scheduler = DecryptionScheduler(workers=1)
+
+    async def main() -> None:
+        slot = scheduler.acquire()
+        cancelled = asyncio.ensure_future(scheduler.acquire_async())
+        waiter = asyncio.ensure_future(scheduler.acquire_async())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        slot.release()
+        (await asyncio.wait_for(waiter, 5)).release()
+        assert scheduler.running == 0 and scheduler.waiting == 0
+
+    asyncio.run(main())
+
+
+@requires_gpg
+def test_gpg_process_holds_a_worker_until_it_exited(tmp_path):
+    scheduler = DecryptionScheduler(workers=1, queue_size=0)
+    module = GpgUploadHandler("TODO_CHANGE_ME", scheduler=scheduler, store=OutputStore(str(tmp_path)))
+    decryption = module.start_decryption()
+    try:
+        with open(os.path.join(TESTS_DIR, "file.txt.gpg"), "rb") as f:
+            decryption.write(f.read())
+        # gpg is waiting for more data, but still counts as running
+        with pytest.raises(SchedulerBusyError):
+            module.start_decryption()
+        decryption.finish()
+        assert decryption.succeeded
+        assert scheduler.running == 0
+    finally:
+        decryption.close()
+
+    # An aborted upload frees its worker as well
+    decryption = module.start_decryption()
+    decryption.close()
+    assert scheduler.running == 0
@@ -0,0 +1,289 @@
+import asyncio
+import base64
+import hashlib
+import http.client
+import os
+import shutil
+import socket
+import threading
+from typing import BinaryIO, Iterator, NamedTuple
+
+import pytest
+
+from secure_upload.async_server import MAX_HEADER_SIZE, AsyncUploadServer
+from secure_upload.client_auth import HttpBasicAuthClientAuthenticator
+from secure_upload.ip_blocking import IpAddressBlocker
+from secure_upload.server import CustomRequestHandler, UploadHTTPServer
+from secure_upload.upload.gpg import GpgUploadHandler
+from secure_upload.upload.handler import ModuleHandler
+from secure_upload.upload.scheduler import DecryptionScheduler
+from secure_upload.upload.store import OutputStore
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PASSPHRASE = "TODO_CHANGE_ME"
+AUTHORIZATION = "Basic " + base64.b64encode(b"user:password").decode()
+
+pytestmark = pytest.mark.skipif(shutil.which("gpg") is None, reason="requires gpg")
+
+
+def read_test_file(name: str) -> bytes:
+    with open(os.path.join(TESTS_DIR, name), "rb") as f:
+        return f.read()
+
+
+CIPHERTEXT = read_test_file("file.txt.gpg")
+PLAINTEXT = read_test_file("file.txt")
+
+
+class RunningServer(NamedTuple):
+    port: int
+    output_dir: str
+    scheduler: DecryptionScheduler
+
+
+class Response(NamedTuple):
+    status: int
+    headers: http.client.HTTPMessage
+    body: bytes
+
+
+def start_threading_engine(handler_class, ip_address_blocker: IpAddressBlocker) -> Iterator[int]:
+    httpd = UploadHTTPServer(("127.0.0.1", 0), handler_class, ip_address_blocker)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield httpd.server_address[1]
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join(5)
+
+
+def start_asyncio_engine(server: AsyncUploadServer) -> Iterator[int]:
+    loop = asyncio.new_event_loop()
+    # Like AsyncUploadServer.serve_forever, but on a free port
+    listener = loop.run_until_complete(asyncio.start_server(server.handle_connection, "127.0.0.1", 0, limit=MAX_HEADER_SIZE))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    async def stop() -> None:
+        listener.close()
+        # Connections that are still open end like when the server is shut down
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    try:
+        yield listener.sockets[0].getsockname()[1]
+    finally:
+        asyncio.run_coroutine_threadsafe(stop(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
+        loop.close()
+
+
+@pytest.fixture(params=["threading", "asyncio"])
+def server(request, tmp_path) -> Iterator[RunningServer]:
+    authenticator = HttpBasicAuthClientAuthenticator("user", "password")
+    ip_address_blocker = IpAddressBlocker([], [], 1000, 60)
+    # Uploads are rejected while the test holds the only worker
+    scheduler = DecryptionScheduler(workers=1, queue_size=0)
+    module_handler = ModuleHandler([GpgUploadHandler(PASSPHRASE, scheduler=scheduler, store=OutputStore(str(tmp_path)))])
+    if request.param == "threading":
+        def handler_class(*args, **kwargs):
+            return CustomRequestHandler(*args, authenticator, ip_address_blocker, module_handler, idle_timeout=5, **kwargs)
+        ports = start_threading_engine(handler_class, ip_address_blocker)
+    else:
+        ports = start_asyncio_engine(AsyncUploadServer(authenticator, ip_address_blocker, module_handler, idle_timeout=5))
+    for port in ports:
+        yield RunningServer(port, str(tmp_path), scheduler)
+
+
+def connect(server: RunningServer) -> socket.socket:
+    return socket.create_connection(("127.0.0.1", server.port), timeout=10)
+
+
+def send_head(connection: socket.socket, method: str, path: str, **headers: str) -> None:
+    lines = [f"{method} {path} HTTP/1.1", "Host: localhost"] + [f"{name.replace('_', '-')}: {value}" for name, value in headers.items()]
+    connection.sendall(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+
+def read_response(file: BinaryIO) -> Response:
+    """
+    Reads one response from the connection. Our responses always have a Content-Length
+    """
+    status_line = file.readline()
+    assert status_line.startswith(b"HTTP/1.1 "), status_line
+    headers = http.client.parse_headers(file)
+    body = file.read(int(headers.get("Content-Length", 0)))
+    return Response(int(status_line.split()[1]), headers, body)
+
+
+def request(server: RunningServer, method: str, path: str, body: bytes = b"", **headers: str) -> Response:
+    with connect(server) as connection, connection.makefile("rb") as file:
+        send_head(connection, method, path, Authorization=AUTHORIZATION, Content_Length=str(len(body)), **headers)
+        connection.sendall(body)
+        return read_response(file)
+
+
+def chunked(data: bytes, chunk_size: int) -> bytes:
+    body = b""
+    for i in range(0, len(data), chunk_size):
+        chunk = data[i:i + chunk_size]
+        # Chunk extensions are allowed and ignored
+        body += f"{len(chunk):x};ext=1\r\n".encode() + chunk + b"\r\n"
+    return body + b"0\r\nX-Trailer: ignored\r\n\r\n"
+
+
+def read_output(server: RunningServer, name: str) -> bytes:
+    with open(os.path.join(server.output_dir, name), "rb") as f:
+        return f.read()
+
+
+def test_put_file_name(server):
+    response = request(server, "PUT", "/gpg/report%20final.txt", CIPHERTEXT)
+    assert response.status == 200
+    assert response.body.decode().endswith(hashlib.sha256(PLAINTEXT).hexdigest())
+    assert read_output(server, "report final.txt") == PLAINTEXT
+
+    # Only the last path segment is used
+    assert request(server, "PUT", "/gpg/..%2F..%2Fescape.txt", CIPHERTEXT).status == 200
+    assert read_output(server, "escape.txt") == PLAINTEXT
+    assert request(server, "PUT", "/gpg/", CIPHERTEXT).status == 200
+    assert read_output(server, "unnamed") == PLAINTEXT
+
+
+@pytest.mark.parametrize("chunk_size", [1, 100, 10_000])
+def test_chunked_upload(server, chunk_size):
+    with connect(server) as connection, connection.makefile("rb") as file:
+        send_head(connection, "PUT", "/gpg/chunked.txt", Authorization=AUTHORIZATION, Transfer_Encoding="chunked")
+        connection.sendall(chunked(CIPHERTEXT, chunk_size))
+        assert read_response(file).status == 200
+    assert read_output(server, "chunked.txt") == PLAINTEXT
+
+
+@pytest.mark.parametrize("body", [
+    b"zz\r\n",
+    # The chunk is longer than announced
+    b"2\r\nabc\r\n0\r\n\r\n",
+])
+def test_invalid_chunked_body(server, body):
+    with connect(server) as connection, connection.makefile("rb") as file:
+        send_head(connection, "PUT", "/gpg/invalid.txt", Authorization=AUTHORIZATION, Transfer_Encoding="chunked")
+        connection.sendall(body)
+        assert read_response(file).status == 400
+    assert not os.path.exists(os.path.join(server.output_dir, "invalid.txt"))
+
+
+def test_continue_is_sent_after_authentication(server):
+    with connect(server) as connection, connection.makefile("rb") as file:
+        send_head(connection, "PUT", "/gpg/file.txt", Authorization="Basic " + base64.b64encode(b"user:wrong").decode(),
+            Content_Length=str(len(CIPHERTEXT)), Expect="100-continue")
+        # Rejected without asking for the body
+        assert read_response(file).status == 401
+
+    with connect(server) as connection, connection.makefile("rb") as file:
+        send_head(connection, "PUT", "/gpg/file.txt", Authorization=AUTHORIZATION, Content_Length=str(len(CIPHERTEXT)), Expect="100-continue")
+        assert file.readline() == b"HTTP/1.1 100 Continue\r\n"
+        assert file.readline() == b"\r\n"
+        connection.sendall(CIPHERTEXT)
+        assert read_response(file).status == 200
+    assert read_output(server, "file.txt") == PLAINTEXT
+
+
+def build_form(fields: dict[str, bytes], boundary: str = "----boundary1234") -> tuple[bytes, str]:
+    """
+    Returns the multipart/form-data body and its Content-Type
+    """
+    body = b""
+    for name, value in fields.items():
+        body += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode() + value + b"\r\n"
+    return body + f"--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+
+def test_form_upload(server):
+    body, content_type = build_form({"filename": b"form.txt", "gpg": CIPHERTEXT})
+    response = request(server, "POST", "/gpg", body, Content_Type=content_type)
+    assert response.status == 200
+    assert response.body.decode().endswith(hashlib.sha256(PLAINTEXT).hexdigest())
+    assert read_output(server, "form.txt") == PLAINTEXT
+
+    body, content_type = build_form({"filename": b"missing.txt"})
+    assert request(server, "POST", "/gpg", body, Content_Type=content_type).status == 500
+
+
+def test_raw_upload(server):
+    # A raw POST works like a PUT
+    assert request(server, "POST", "/gpg/raw.txt", CIPHERTEXT, Content_Type="application/octet-stream").status == 200
+    assert read_output(server, "raw.txt") == PLAINTEXT
+
+    response = request(server, "PUT", "/gpg/wrong-pass.txt", read_test_file("wrong-pass.txt.gpg"))
+    assert response.status == 500
+    assert not os.path.exists(os.path.join(server.output_dir, "wrong-pass.txt"))
+
+
+@pytest.mark.parametrize("authorization", [None, "Basic " + base64.b64encode(b"user:wrong").decode(), "Bearer token"])
+def test_unauthorized(server, authorization):
+    headers = {"Authorization": authorization} if authorization else {}
+    with connect(server) as connection, connection.makefile("rb") as file:
+        send_head(connection, "PUT", "/gpg/file.txt", Content_Length=str(len(CIPHERTEXT)), **headers)
+        connection.sendall(CIPHERTEXT)
+        response = read_response(file)
+    assert response.status == 401
+    assert response.headers["WWW-Authenticate"] == "Basic"
+    assert os.listdir(server.output_dir) == []
+
+
+def assert_closed(file: BinaryIO) -> None:
+    # The server closed the connection after the response
+    assert file.read() == b""
+
+
+def test_keep_alive(server):
+    with connect(server) as connection, connection.makefile("rb") as file:
+        for name in ["first.txt", "second.txt"]:
+            send_head(connection, "PUT", f"/gpg/{name}", Authorization=AUTHORIZATION, Content_Length=str(len(CIPHERTEXT)))
+            connection.sendall(CIPHERTEXT)
+            response = read_response(file)
+            assert response.status == 200
+            assert response.headers.get("Connection", "keep-alive").lower() == "keep-alive"
+        # Chunked bodies are read completely as well
+        send_head(connection, "PUT", "/gpg/third.txt", Authorization=AUTHORIZATION, Transfer_Encoding="chunked")
+        connection.sendall(chunked(CIPHERTEXT, 100))
+        assert read_response(file).status == 200
+    assert read_output(server, "first.txt") == read_output(server, "second.txt") == read_output(server, "third.txt") == PLAINTEXT
+
+
+def test_connection_is_closed_after_unauthorized(server):
+    with connect(server) as connection, connection.makefile("rb") as file:
+        send_head(connection, "PUT", "/gpg/file.txt", Content_Length=str(len(CIPHERTEXT)), Expect="100-continue")
+        response = read_response(file)
+        assert response.status == 401
+        assert response.headers["Connection"] == "close"
+        assert_closed(file)
+
+
+def test_connection_is_closed_after_bad_request(server):
+    with connect(server) as connection, connection.makefile("rb") as file:
+        send_head(connection, "PUT", "/gpg/file.txt", Authorization=AUTHORIZATION, Transfer_Encoding="chunked")
+        connection.sendall(b"zz\r\n")
+        response = read_response(file)
+        assert response.status == 400
+        assert response.headers["Connection"] == "close"
+        assert_closed(file)
+
+
+def test_connection_is_closed_when_busy(server):
+    slot = server.scheduler.acquire()
+    try:
+        with connect(server) as connection, connection.makefile("rb") as file:
+            send_head(connection, "PUT", "/gpg/file.txt", Authorization=AUTHORIZATION, Content_Length=str(len(CIPHERTEXT)), Expect="100-continue")
+            response = read_response(file)
+            assert response.status == 503
+            assert response.headers["Connection"] == "close"
+            assert response.headers["Retry-After"]
+            assert_closed(file)
+    finally:
+        slot.release()
+    assert request(server, "PUT", "/gpg/file.txt", CIPHERTEXT).status == 200
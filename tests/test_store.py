@@ -0,0 +1,155 @@
+import errno
+import os
+import threading
+
+import pytest
+
+from secure_upload.upload import store
+from secure_upload.upload.store import MIN_PREALLOCATION_SIZE, GroupCommit, OutputStore
+
+
+def store_file(output: OutputStore, name: str, data: bytes, expected_size=None) -> str:
+    fd, temp_path = output.create_temp_file(expected_size)
+    try:
+        os.write(fd, data)
+        output.trim(fd)
+    finally:
+        os.close(fd)
+    return output.commit(temp_path, name)
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_existing_files_are_not_overwritten(tmp_path):
+    output = OutputStore(str(tmp_path))
+    paths = [store_file(output, "file.txt", str(i).encode()) for i in range(3)]
+    assert [os.path.basename(path) for path in paths] == ["file.txt", "file-1.txt", "file-2.txt"]
+    assert [read(path) for path in paths] == [b"0", b"1", b"2"]
+    # No temporary files are left behind
+    assert sorted(os.listdir(tmp_path)) == ["file-1.txt", "file-2.txt", "file.txt"]
+
+
+def test_name_format(tmp_path):
+    output = OutputStore(str(tmp_path), "{stem}-upload{extension}")
+    assert output.format_name("archive.tar.gz") == "archive.tar-upload.gz"
+    with pytest.raises(Exception, match="Invalid output name format"):
+        OutputStore(str(tmp_path), "{unknown}")
+    with pytest.raises(Exception, match="Invalid output file name"):
+        OutputStore(str(tmp_path), "../{name}")
+
+
+@pytest.mark.parametrize("name", ["", ".", "..", "x/", "../.."])
+def test_invalid_names_are_replaced(tmp_path, name):
+    output = OutputStore(str(tmp_path))
+    assert output.format_name(name) == "unnamed"
+    assert OutputStore(str(tmp_path), "{random}_{name}").format_name(name).endswith("_unnamed")
+    assert output.format_name("../a/b.txt") == "b.txt"
+
+
+def test_trim_after_preallocation(tmp_path):
+    output = OutputStore(str(tmp_path))
+    fd, temp_path = output.create_temp_file(4 * MIN_PREALLOCATION_SIZE)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            assert os.fstat(fd).st_size == 4 * MIN_PREALLOCATION_SIZE
+        os.write(fd, b"x" * 1000)
+        output.trim(fd)
+        assert os.fstat(fd).st_size == 1000
+    finally:
+        os.close(fd)
+    assert read(output.commit(temp_path, "file")) == b"x" * 1000
+
+
+def test_discard(tmp_path):
+    output = OutputStore(str(tmp_path))
+    fd, temp_path = output.create_temp_file()
+    os.close(fd)
+    output.discard(temp_path)
+    output.discard(temp_path)
+    assert os.listdir(tmp_path) == []
+
+
+def count_fsync_calls(monkeypatch) -> list:
+    calls = []
+    fsync = os.fsync
+
+    def counting_fsync(fd: int) -> None:
+        calls.append(fd)
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", counting_fsync)
+    return calls
+
+
+def test_durability_none(tmp_path, monkeypatch):
+    calls = count_fsync_calls(monkeypatch)
+    store_file(OutputStore(str(tmp_path)), "file", b"data")
+    assert calls == []
+
+
+def test_durability_file(tmp_path, monkeypatch):
+    calls = count_fsync_calls(monkeypatch)
+    store_file(OutputStore(str(tmp_path), durability="file"), "file", b"data")
+    # The file and then the directory
+    assert len(calls) == 2
+
+
+def test_durability_group(tmp_path, monkeypatch):
+    calls = count_fsync_calls(monkeypatch)
+    synced = []
+    monkeypatch.setattr(store, "load_syncfs", lambda: synced.append)
+    output = OutputStore(str(tmp_path), durability="group")
+    store_file(output, "file", b"data")
+    assert calls == [] and len(synced) == 2
+
+    # Without syncfs every file is flushed on its own
+    monkeypatch.setattr(store, "load_syncfs", lambda: None)
+    store_file(OutputStore(str(tmp_path), durability="group"), "file", b"data")
+    assert len(calls) == 2
+
+
+def test_unknown_durability(tmp_path):
+    with pytest.raises(Exception, match="Unknown durability policy"):
+        OutputStore(str(tmp_path), durability="always")
+
+
+def test_group_commit_shares_the_flush():
+    flushes = []
+    group_commit = GroupCommit(delay=0.2, syncfs=flushes.append)
+    threads = [threading.Thread(target=group_commit.sync, args=(fd,)) for fd in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    # All callers arrived during the first caller's delay
+    assert len(flushes) == 1
+
+
+def test_group_commit_errors():
+    def failing_syncfs(fd: int) -> None:
+        raise OSError(errno.EIO, "I/O error")
+
+    group_commit = GroupCommit(delay=0.2, syncfs=failing_syncfs)
+    errors = []
+
+    def sync(fd: int) -> None:
+        try:
+            group_commit.sync(fd)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=sync, args=(fd,)) for fd in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 5 and all(e.errno == errno.EIO for e in errors)
+    # Once every caller has seen the error it is forgotten
+    assert group_commit.errors == {}
+
+    with pytest.raises(OSError):
+        group_commit.sync(0)
+    assert group_commit.errors == {}